@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -113,6 +114,53 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Direct Redis access (recent-message buffers, counters); same server as the channel layer
+REDIS_URL = "redis://127.0.0.1:6379/0"
+CHAT_RECENT_BUFFER_SIZE = 50
+
+# Shared cache (all daphne workers): login-bonus guards, SiteConfig version token
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+        "KEY_PREFIX": "airspace",
+    }
+}
+
+# SiteConfig is cached per process; workers check the shared version token every CHECK seconds
+SITE_CONFIG_CACHE_TTL = 300
+SITE_CONFIG_VERSION_CHECK = 1.0
+
+# XP/aura rewards are buffered in Redis and flushed into Profile by `manage.py flush_counters`
+XP_WRITE_BEHIND = True
+XP_FLUSH_INTERVAL = 5  # seconds
+
+# Message side effects (streaks, daily counters, mention pushes) are queued and run by `manage.py run_outbox`.
+# Set to False to run them inline when no worker is running.
+OUTBOX_ENABLED = True
+
+# Dashboard message stats come from rollup tables refreshed by `manage.py refresh_rollups`
+ROLLUP_INTERVAL = 60  # seconds between refreshes
+ROLLUP_SETTLE = 60  # messages younger than this wait for the next refresh
+
+# Admin dashboards are served from cached snapshots, recomputed in the background once older than this
+DASHBOARD_SNAPSHOT_TTL = 60  # seconds (0 = compute on every request)
+
+# Offline IP -> city database, built with `manage.py import_geoip <ranges.csv>` (see chat/geoip.py)
+GEOIP_DB_PATH = os.path.join(BASE_DIR, 'geoip', 'cities.bin')
+
+# Live vote counts: updates to the same message within this window go out as one frame (0 = send every vote)
+CHAT_VOTE_COALESCE_MS = 250
+
+# Per-worker request / socket / DB metrics, served in Prometheus format at /metrics/ to these addresses only,
+# and there only to staff sessions or a scraper sending "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Encoder used for chat socket frames: 'json' (stdlib) or 'orjson' (faster, from requirements-optional.txt)
+CHAT_FRAME_ENCODER = 'json'
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -159,6 +207,11 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # ---------------------------------
 
+# Chunked chat media uploads (see chat/uploads.py)
+CHAT_UPLOAD_MAX_BYTES = {'image': 8 * 1024 * 1024, 'audio': 5 * 1024 * 1024}
+CHAT_UPLOAD_CHUNK_BYTES = 256 * 1024
+CHAT_UPLOAD_SPOOL_DIR = os.path.join(MEDIA_ROOT, 'upload_spool')
+
 STATIC_URL = 'static/'
 
 # This tells Django to look in the folder shown in your screenshot
@@ -166,6 +219,9 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+# Service worker cache version; unset = hash of the files in STATICFILES_DIRS (see chat/assets.py)
+ASSET_BUILD_HASH = os.environ.get('ASSET_BUILD_HASH')
+
 
 LOGIN_URL = '/'
 LOGIN_REDIRECT_URL = '/'
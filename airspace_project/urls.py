@@ -16,6 +16,8 @@ urlpatterns = [
     # Redirect root to Chat
     path('', chat_views.home, name='root_home'), 
     path('', include('chat.urls')),
+    path('sw.js', chat_views.service_worker, name='service_worker'), # Root path so the worker controls the whole site
+    path('metrics/', chat_views.metrics_view, name='metrics'), # METRICS_ALLOWED_IPS plus staff or METRICS_TOKEN
     path('favicon.ico', RedirectView.as_view(url='/static/images/logo.png', permanent=True)),
     
  
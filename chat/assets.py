@@ -0,0 +1,25 @@
+# Build hash and precache list for the service worker (views.service_worker); ASSET_BUILD_HASH skips hashing
+import hashlib
+from functools import lru_cache
+from django.conf import settings
+from django.contrib.staticfiles.finders import FileSystemFinder
+from django.templatetags.static import static
+
+SKIP = ['sw.js', '*.map'] # The worker itself is served by a view
+
+def _files():
+    return sorted(FileSystemFinder().list(SKIP), key=lambda item: item[0])
+
+@lru_cache(maxsize=1)
+def build_hash():
+    configured = getattr(settings, 'ASSET_BUILD_HASH', None)
+    if configured: return str(configured)[:12]
+    digest = hashlib.sha1()
+    for path, storage in _files():
+        digest.update(path.encode())
+        with storage.open(path) as f: digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+@lru_cache(maxsize=1)
+def precache_urls():
+    return [static(path.replace('\\', '/')) for path, _ in _files()]
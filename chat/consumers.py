@@ -1,10 +1,19 @@
+import asyncio
 import json
-import base64
-from django.core.files.base import ContentFile
+import time
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.db import transaction
 from django.utils import timezone
-from .models import Message, Room, Profile, SiteConfig
+from .models import Message, Room, Profile, SiteConfig, HistoryClear
+from .frames import encode_frame
+from .uploads import claim_upload
+from . import counters, presence, metrics, vote_feed
+from .history import serialize_message, fetch_page, recent_page, is_locked, buffer_new, buffer_update
+
+PRESENCE_EVERY = 30 # seconds
+COMMANDS = {'new_message', 'delete_me', 'delete_everyone', 'edit_message', 'load_older', 'clear_history'} # Metric labels
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -12,42 +21,112 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_group_name = f'chat_{self.room_name}'
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
+        loop = asyncio.get_running_loop()
+        metrics.note_loop(loop) # For the thread pool depth gauge
+        vote_feed.note_loop(loop) # Vote broadcasts are coalesced on it
+        await self.touch_presence()
+        await self.join_presence()
 
     async def disconnect(self, close_code):
+        await self.leave_presence()
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
 
     async def receive(self, text_data):
-        try:
-            data = json.loads(text_data)
-            command = data.get('command')
-
-            if command == 'new_message':
-                msg_data = await self.save_message(data)
-                if msg_data:
-                    await self.channel_layer.group_send(self.room_group_name, {'type': 'chat_message', 'message_data': msg_data})
+        await self.touch_presence()
+        with metrics.track(metrics.ws_latency, metrics.ws_queries, metrics.ws_db_time) as scope:
+            try:
+                data = json.loads(text_data)
+                command = data.get('command')
+                scope.label = command if command in COMMANDS else 'other'
+
+                if command == 'new_message':
+                    msg_data = await self.save_message(data)
+                    if msg_data:
+                        frame = encode_frame({'type': 'chat_message', **msg_data})
+                        await self.group_send({'type': 'chat_message', 'frame': frame})
             
-            elif command == 'delete_me':
-                await self.delete_message_db(data['msg_id'], 'me')
+                elif command == 'delete_me':
+                    await self.delete_message_db(data['msg_id'], 'me')
             
-            elif command == 'delete_everyone':
-                if await self.delete_message_db(data['msg_id'], 'everyone'):
-                    await self.channel_layer.group_send(self.room_group_name, {'type': 'message_deleted', 'msg_id': data['msg_id']})
-
-            elif command == 'edit_message':
-                if await self.edit_message_db(data['msg_id'], data['new_content']):
-                    await self.channel_layer.group_send(self.room_group_name, {'type': 'message_edited', 'msg_id': data['msg_id'], 'new_content': data['new_content']})
+                elif command == 'delete_everyone':
+                    if await self.delete_message_db(data['msg_id'], 'everyone'):
+                        frame = encode_frame({'type': 'message_deleted', 'msg_id': data['msg_id']})
+                        await self.group_send({'type': 'message_deleted', 'frame': frame})
+
+                elif command == 'edit_message':
+                    if await self.edit_message_db(data['msg_id'], data['new_content']):
+                        frame = encode_frame({'type': 'message_edited', 'msg_id': data['msg_id'], 'new_content': data['new_content']})
+                        await self.group_send({'type': 'message_edited', 'frame': frame})
+
+                elif command == 'load_older':
+                    page = await self.load_history_page(data.get('before'))
+                    await self.send(text_data=encode_frame({'type': 'history_page', **page}))
+
+                # Add this block inside receive() method
+                elif command == 'clear_history':
+                    await self.clear_history_for_user()
+                    await self.send(text_data=encode_frame({'type': 'history_cleared'}))
+
+            except Exception as e:
+                print(f"WS Error: {e}")
+
+    # Sockets count as presence too; at most one touch per PRESENCE_EVERY seconds per socket
+    async def touch_presence(self):
+        user = self.scope.get('user')
+        now = time.monotonic()
+        if not (user and user.is_authenticated) or now - getattr(self, '_presence_at', -PRESENCE_EVERY) < PRESENCE_EVERY: return
+        self._presence_at = now
+        try: await sync_to_async(presence.touch)(user.id)
+        except Exception as e: print(f"Presence error: {e}")
+
+    # --- LIVE ROOM PRESENCE (see presence.py) ---
+    async def join_presence(self):
+        self.heartbeat_task = None
+        user = self.scope.get('user')
+        if not (user and user.is_authenticated): return
+        try:
+            joined, count = await sync_to_async(presence.join, thread_sensitive=False)(self.room_name, user.id, self.channel_name)
+        except Exception as e:
+            print(f"Presence error: {e}"); return
+        if joined: await self.broadcast_presence('join', user.username, count)
+        else: await self.send(text_data=encode_frame({'type': 'presence', 'event': 'count', 'count': count})) # Another tab already counted us
+        self.heartbeat_task = asyncio.create_task(self.heartbeat_presence(user))
+
+    async def heartbeat_presence(self, user):
+        while True:
+            await asyncio.sleep(presence.HEARTBEAT)
+            try:
+                joined, count = await sync_to_async(presence.heartbeat, thread_sensitive=False)(self.room_name, user.id, self.channel_name)
+                if joined: await self.broadcast_presence('join', user.username, count) # Expired (e.g. a stalled worker) and came back
+            except Exception as e:
+                print(f"Presence error: {e}")
+
+    async def leave_presence(self):
+        task = getattr(self, 'heartbeat_task', None)
+        if not task: return
+        task.cancel()
+        user = self.scope['user']
+        try:
+            left, count = await sync_to_async(presence.leave, thread_sensitive=False)(self.room_name, user.id, self.channel_name)
+            if left: await self.broadcast_presence('leave', user.username, count)
+        except Exception as e:
+            print(f"Presence error: {e}")
 
-            # Add this block inside receive() method
-            elif command == 'clear_history':
-                await self.clear_history_for_user()
-                await self.send(text_data=json.dumps({'type': 'history_cleared'}))
+    async def broadcast_presence(self, event, username, count):
+        frame = encode_frame({'type': 'presence', 'event': event, 'username': username, 'count': count})
+        await self.group_send({'type': 'presence_update', 'frame': frame})
 
-        except Exception as e:
-            print(f"WS Error: {e}")
+    async def group_send(self, event):
+        start = time.perf_counter()
+        await self.channel_layer.group_send(self.room_group_name, event)
+        metrics.group_send_latency.observe(time.perf_counter() - start, event['type'])
 
-    async def chat_message(self, event): await self.send(text_data=json.dumps({'type': 'chat_message', **event['message_data']}))
-    async def message_deleted(self, event): await self.send(text_data=json.dumps(event))
-    async def message_edited(self, event): await self.send(text_data=json.dumps(event))
+    # Group events carry a pre-encoded frame (see frames.py), forwarded verbatim
+    async def chat_message(self, event): await self.send(text_data=event['frame'])
+    async def message_deleted(self, event): await self.send(text_data=event['frame'])
+    async def message_edited(self, event): await self.send(text_data=event['frame'])
+    async def vote_update(self, event): await self.send(text_data=event['frame'])
+    async def presence_update(self, event): await self.send(text_data=event['frame'])
 
     @database_sync_to_async
     def save_message(self, data):
@@ -57,42 +136,40 @@ class ChatConsumer(AsyncWebsocketConsumer):
         profile, _ = Profile.objects.get_or_create(user=user)
         
         content = data.get('message', '')
-        image_data = data.get('image'); audio_data = data.get('audio'); reply_id = data.get('reply_id')
-
-        if not content and not image_data and not audio_data: return None
+        upload_token = data.get('upload_token'); reply_id = data.get('reply_id')
 
+        if not content and not upload_token: return None
         new_msg = Message(user=user, room=room, content=content)
         if reply_id:
             try: new_msg.reply_to = Message.objects.get(id=reply_id)
             except: pass
 
-        if image_data:
-            try:
-                fmt, imgstr = image_data.split(';base64,'); ext = fmt.split('/')[-1]
-                new_msg.image.save(f"img_{user.id}_{int(timezone.now().timestamp())}.{ext}", ContentFile(base64.b64decode(imgstr)), save=False)
-            except: pass
+        with transaction.atomic(): # Message + its outbox jobs + the claimed upload commit together
+            # Media arrives through the chunked upload endpoint; the socket only carries the finished token
+            media = claim_upload(user, upload_token) if upload_token else None
+            if not content and not media: return None
+            if media:
+                kind, stored_name = media
+                setattr(new_msg, kind, stored_name)
+            new_msg.save()
         
-        if audio_data:
-            try:
-                if "base64," in audio_data: fmt, audiostr = audio_data.split(';base64,')
-                else: audiostr = audio_data
-                new_msg.audio.save(f"voice_{user.id}_{int(timezone.now().timestamp())}.webm", ContentFile(base64.b64decode(audiostr)), save=False)
-            except: pass
+        try: xp_gain = SiteConfig.get_solo().xp_per_message
+        except: xp_gain = 2
+        counters.add_xp(user.id, xp_gain)
+        counters.merge_pending([profile]) # Tier badge reflects XP not flushed to the row yet
 
-        new_msg.save()
-        
-        try:
-            config = SiteConfig.get_solo(); profile.xp += config.xp_per_message
-        except: profile.xp += 2
-        profile.save()
-
-        return {
-            'id': new_msg.id, 'username': user.username, 'message': new_msg.content, 'tier': profile.get_tier(), 'aura': profile.aura,
-            'timestamp': timezone.now().strftime('%H:%M'), 'image_url': new_msg.image.url if new_msg.image else None,
-            'audio_url': new_msg.audio.url if new_msg.audio else None, 'user_avatar': profile.profile_picture.url if profile.profile_picture else None,
-            'reply_context': {'username': new_msg.reply_to.user.username, 'message': new_msg.reply_to.content} if new_msg.reply_to else None,
-            'likes': 0, 'dislikes': 0
-        }
+        msg_data = serialize_message(new_msg, profile=profile)
+        buffer_new(self.room_name, msg_data)
+        return msg_data
+
+    @database_sync_to_async
+    def load_history_page(self, before):
+        user = self.scope['user']
+        if not user.is_authenticated: return {'messages': [], 'next_cursor': None}
+        profile, _ = Profile.objects.get_or_create(user=user)
+        if is_locked(user, profile, self.room_name, SiteConfig.get_solo()): return {'messages': [], 'next_cursor': None}
+        if not before: return recent_page(self.room_name, user) # Reconnect / first page: one buffer read
+        return fetch_page(self.room_name, user, before=before)
 
     @database_sync_to_async
     def delete_message_db(self, msg_id, type):
@@ -100,7 +177,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             msg = Message.objects.get(id=msg_id)
             user = self.scope['user']
             if type == 'everyone' and (msg.user == user or user.is_staff):
-                msg.is_deleted = True; msg.content = "🚫 Message deleted"; msg.image = None; msg.audio = None; msg.save(); return True
+                msg.is_deleted = True; msg.content = "🚫 Message deleted"; msg.image = None; msg.audio = None; msg.save()
+                buffer_update(msg.room.name, msg.id, message=msg.content, image_url=None, audio_url=None); return True
             elif type == 'me':
                 msg.hidden_by.add(user); msg.save(); return True
         except: return False
@@ -109,11 +187,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
     def edit_message_db(self, msg_id, new_text):
         try:
             msg = Message.objects.get(id=msg_id, user=self.scope['user'])
-            if not msg.is_deleted: msg.content = new_text; msg.save(); return True
+            if not msg.is_deleted:
+                msg.content = new_text; msg.save()
+                buffer_update(msg.room.name, msg.id, message=new_text); return True
         except: return False
 
     @database_sync_to_async
     def clear_history_for_user(self):
-        user = self.scope['user']; room = Room.objects.get(name=self.room_name)
-        messages = Message.objects.filter(room=room)
-        for m in messages: m.hidden_by.add(user)
\ No newline at end of file
+        # One upsert of the user's watermark instead of a hidden_by row per message
+        user = self.scope['user']; room, _ = Room.objects.get_or_create(name=self.room_name)
+        HistoryClear.objects.bulk_create(
+            [HistoryClear(user=user, room=room, cleared_at=timezone.now())],
+            update_conflicts=True, unique_fields=['user', 'room'], update_fields=['cleared_at'],
+        )
@@ -1,4 +1,5 @@
-from .models import SiteConfig, MusicTrack, Profile, UserStreak, DailyActivity
+from .models import SiteConfig, UserStreak, DailyActivity
+from . import music_catalog
 from .retention_engine import get_streak_multiplier
 from django.utils import timezone
 import json
@@ -7,38 +8,22 @@ def global_config(request):
     return {'config': SiteConfig.get_solo()}
 
 def layout_data(request):
+    """
+    Player shell only: the catalog itself is fetched by the browser from the versioned
+    /music/catalog/ document and favorites from /music/favorites/ (see music_catalog.py).
+    """
     config = SiteConfig.get_solo()
-    tracks = MusicTrack.objects.all().order_by('-timestamp')
+    catalog = music_catalog.meta()
     
-    # NEW CATEGORIES MAP
-    library = { 'love': [], 'sad': [], 'peaceful': [], 'travel': [], 'mashup': [], 'favorites': [] }
-    
-    fav_ids = []
-    if request.user.is_authenticated:
-        try:
-            profile = request.user.profile
-            fav_tracks = profile.favorites.all()
-            for t in fav_tracks:
-                fav_ids.append(t.id)
-                library['favorites'].append({'id': t.id, 'title': t.title, 'artist': t.artist, 'url': t.audio_url, 'cover': t.cover_image.url if t.cover_image else ''})
-        except: pass
-
-    for t in tracks:
-        track_data = {'id': t.id, 'title': t.title, 'artist': t.artist, 'url': t.audio_url, 'cover': t.cover_image.url if t.cover_image else ''}
-        if t.category in library:
-            library[t.category].append(track_data)
-            
-    counts = {k: len(v) for k, v in library.items()}
     default_song = None
     if config.default_track:
         default_song = {'id': config.default_track.id, 'title': config.default_track.title, 'artist': config.default_track.artist, 'url': config.default_track.audio_url, 'category': config.default_track.category}
 
     return {
         'config': config,
-        'music_library': json.dumps(library),
-        'playlist_counts': counts,
+        'music_catalog_version': catalog['version'],
+        'playlist_counts': catalog['counts'],
         'default_music': json.dumps(default_song),
-        'fav_ids': json.dumps(fav_ids)
     }
 
 # --- 🔥 NEW ADDITION: RETENTION METRICS ---
@@ -0,0 +1,193 @@
+# Write-behind XP / aura: deltas pile up in a Redis hash and `manage.py flush_counters` applies them in batches
+import uuid
+from datetime import date, timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
+from redis import RedisError
+from .models import Profile, CounterFlush, DailyGain
+from .redis_client import get_redis
+
+PENDING_KEY = "counters:pending"
+PROCESSING_KEY = "counters:processing" # Deltas taken by a flush that has not been dropped yet
+BATCH_KEY = "counters:processing:batch" # Id of that batch, recorded in CounterFlush when applied
+LOCK_KEY = "counters:flush:lock"
+LOCK_TTL = 120 # seconds; a crashed flusher blocks others at most this long
+FIELDS = ('xp', 'aura')
+GAIN_KEEP = timedelta(days=40) # DailyGain rows older than the longest window are purged
+
+rewarded = Signal() # Sent with user_id, xp, aura once a committed reward has been stored
+
+def write_behind(): return getattr(settings, 'XP_WRITE_BEHIND', False)
+
+# --- WRITES ---
+def apply_now(user_id, xp=0, aura=0):
+    """ Immediate atomic increment, no read-modify-write """
+    if xp or aura: Profile.objects.filter(user_id=user_id).update(xp=F('xp') + xp, aura=F('aura') + aura)
+
+def add_gain(user_id, day, xp=0, aura=0):
+    """ Adds one user's gains onto their DailyGain row, creating it on first use """
+    if not (xp or aura): return
+    rows = DailyGain.objects.filter(user_id=user_id, day=day)
+    if rows.update(xp=F('xp') + xp, aura=F('aura') + aura): return
+    try:
+        with transaction.atomic(): DailyGain.objects.create(user_id=user_id, day=day, xp=xp, aura=aura)
+    except IntegrityError: # Created concurrently
+        rows.update(xp=F('xp') + xp, aura=F('aura') + aura)
+
+def add(user_id, xp=0, aura=0):
+    """ Credits a reward. Redis only hears of it after the caller's transaction commits, so a rolled-back grant pays nothing """
+    if not (xp or aura): return
+    day = timezone.localdate()
+    if write_behind():
+        transaction.on_commit(lambda: _stage(user_id, day, xp, aura))
+    else:
+        apply_now(user_id, xp, aura) # Rolls back with the caller
+        transaction.on_commit(lambda: _committed(user_id, day, xp, aura))
+
+def _committed(user_id, day, xp, aura):
+    add_gain(user_id, day, max(xp, 0), max(aura, 0))
+    rewarded.send(sender=None, user_id=user_id, xp=xp, aura=aura)
+
+def _stage(user_id, day, xp, aura):
+    try:
+        pipe = get_redis().pipeline()
+        if xp: pipe.hincrby(PENDING_KEY, f"xp:{user_id}", xp)
+        if aura: pipe.hincrby(PENDING_KEY, f"aura:{user_id}", aura)
+        if xp > 0: pipe.hincrby(PENDING_KEY, f"gxp:{user_id}:{day}", xp) # Gains for DailyGain, flushed with the deltas
+        if aura > 0: pipe.hincrby(PENDING_KEY, f"gaura:{user_id}:{day}", aura)
+        pipe.execute()
+    except RedisError as e:
+        print(f"Counter store unavailable, writing through: {e}")
+        apply_now(user_id, xp, aura)
+        add_gain(user_id, day, max(xp, 0), max(aura, 0))
+    rewarded.send(sender=None, user_id=user_id, xp=xp, aura=aura)
+
+def add_xp(user_id, amount): add(user_id, xp=amount)
+def add_aura(user_id, amount): add(user_id, aura=amount)
+
+# --- READS ---
+def _parse(raw):
+    """ {b'xp:12': b'40', b'gxp:12:2026-10-18': b'40'} -> ({12: {'xp': 40, 'aura': 0}}, {(12, date): {'xp': 40, 'aura': 0}}) """
+    deltas, gains = {}, {}
+    for field_key, value in raw.items():
+        field, user_id, *day = field_key.decode().split(':')
+        if day: gains.setdefault((int(user_id), date.fromisoformat(day[0])), {'xp': 0, 'aura': 0})[field[1:]] += int(value)
+        else: deltas.setdefault(int(user_id), {'xp': 0, 'aura': 0})[field] += int(value)
+    return deltas, gains
+
+def _batch_applied(batch):
+    return bool(batch) and CounterFlush.objects.filter(batch_id=batch.decode()).exists()
+
+def pending_many(user_ids):
+    """ Unflushed deltas for the given users: {user_id: {'xp': n, 'aura': n}} """
+    user_ids = list(user_ids)
+    if not user_ids or not write_behind(): return {}
+    fields = [f"{f}:{uid}" for uid in user_ids for f in FIELDS]
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hmget(PENDING_KEY, fields); pipe.hmget(PROCESSING_KEY, fields); pipe.get(BATCH_KEY)
+        pending, processing, batch = pipe.execute()
+    except RedisError:
+        return {}
+    # Only while a flush is in flight: a batch already committed is in the rows, don't count it twice
+    if _batch_applied(batch): processing = [None] * len(fields)
+    deltas = {}
+    for i, field_key in enumerate(fields):
+        total = int(pending[i] or 0) + int(processing[i] or 0)
+        if total:
+            field, uid = field_key.split(':')
+            deltas.setdefault(int(uid), {'xp': 0, 'aura': 0})[field] += total
+    return deltas
+
+def pending_gains():
+    """ Unflushed gains of every user: {(user_id, day): {'xp': n, 'aura': n}} """
+    if not write_behind(): return {}
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hgetall(PENDING_KEY); pipe.hgetall(PROCESSING_KEY); pipe.get(BATCH_KEY)
+        pending, processing, batch = pipe.execute()
+    except RedisError:
+        return {}
+    gains = _parse(pending)[1]
+    if not _batch_applied(batch):
+        for key, g in _parse(processing)[1].items():
+            total = gains.setdefault(key, {'xp': 0, 'aura': 0})
+            total['xp'] += g['xp']; total['aura'] += g['aura']
+    return gains
+
+def merge_pending(profiles):
+    """ Adds unflushed deltas onto in-memory Profile instances (never saved back) """
+    profiles = list(profiles)
+    deltas = pending_many(p.user_id for p in profiles)
+    for p in profiles:
+        d = deltas.get(p.user_id)
+        if d: p.xp += d['xp']; p.aura += d['aura']
+    return profiles
+
+# --- FLUSH ---
+def _apply_batch(deltas):
+    xp_cases = [When(user_id=uid, then=Value(d['xp'])) for uid, d in deltas.items() if d['xp']]
+    aura_cases = [When(user_id=uid, then=Value(d['aura'])) for uid, d in deltas.items() if d['aura']]
+    updates = {}
+    if xp_cases: updates['xp'] = F('xp') + Case(*xp_cases, default=Value(0), output_field=IntegerField())
+    if aura_cases: updates['aura'] = F('aura') + Case(*aura_cases, default=Value(0), output_field=IntegerField())
+    if updates: Profile.objects.filter(user_id__in=list(deltas)).update(**updates)
+
+def _apply_gains(gains):
+    """ Adds {(user_id, day): {'xp': n, 'aura': n}} onto DailyGain: one read, two writes (flushes are serialized by the lock) """
+    if not gains: return
+    users = set(Profile.objects.filter(user_id__in={u for u, _ in gains}).values_list('user_id', flat=True))
+    gains = {k: g for k, g in gains.items() if k[0] in users} # Users deleted since their reward
+    if not gains: return
+    existing = {(g.user_id, g.day): g for g in DailyGain.objects.filter(user_id__in=users, day__in={d for _, d in gains})}
+    to_update, to_create = [], []
+    for (uid, day), g in gains.items():
+        row = existing.get((uid, day))
+        if row:
+            row.xp += g['xp']; row.aura += g['aura']; to_update.append(row)
+        else: to_create.append(DailyGain(user_id=uid, day=day, xp=g['xp'], aura=g['aura']))
+    if to_update: DailyGain.objects.bulk_update(to_update, ['xp', 'aura'], batch_size=1000)
+    if to_create: DailyGain.objects.bulk_create(to_create, batch_size=1000)
+
+# Takes the pending hash as a new batch unless an earlier one is still there (it is retried first)
+# KEYS = pending, processing, batch id; ARGV = new batch id. Returns the batch id or false
+_TAKE_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then return false end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('SET', KEYS[3], ARGV[1])
+end
+return redis.call('GET', KEYS[3])
+"""
+# Releases the lock only if we still own it
+_UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+def flush(batch_size=500):
+    """ Moves all pending deltas into Profile. Returns the number of users touched (0 if another flush runs) """
+    r = get_redis()
+    token = uuid.uuid4().hex
+    if not r.set(LOCK_KEY, token, nx=True, ex=LOCK_TTL): return 0
+    try:
+        batch = r.eval(_TAKE_LUA, 3, PENDING_KEY, PROCESSING_KEY, BATCH_KEY, uuid.uuid4().hex)
+        if not batch: return 0
+        batch = batch.decode() if isinstance(batch, bytes) else batch
+        deltas, gains = _parse(r.hgetall(PROCESSING_KEY))
+        items = list(deltas.items())
+        with transaction.atomic():
+            _, created = CounterFlush.objects.get_or_create(batch_id=batch, defaults={'users': len(deltas)})
+            if created: # Otherwise a flush that crashed after committing already applied it
+                for i in range(0, len(items), batch_size):
+                    _apply_batch(dict(items[i:i + batch_size]))
+                _apply_gains(gains)
+        r.delete(PROCESSING_KEY, BATCH_KEY)
+        CounterFlush.objects.filter(applied_at__lt=timezone.now() - timedelta(days=1)).delete()
+        DailyGain.objects.filter(day__lt=timezone.localdate() - GAIN_KEEP).delete()
+        return len(deltas) if created else 0
+    finally:
+        r.eval(_UNLOCK_LUA, 1, LOCK_KEY, token)
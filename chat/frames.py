@@ -0,0 +1,29 @@
+# Socket frames are encoded once by the sender, so every consumer in the room forwards the same string
+import json
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # Optional speed-up, plain json works fine without it
+    orjson = None
+
+
+def _encode_json(payload):
+    return json.dumps(payload)
+
+def _encode_orjson(payload):
+    return orjson.dumps(payload).decode('utf-8')
+
+ENCODERS = {'json': _encode_json}
+if orjson is not None:
+    ENCODERS['orjson'] = _encode_orjson
+
+
+def get_encoder(name=None):
+    """ Returns the configured encoder, falling back to json if it is not installed """
+    name = name or getattr(settings, 'CHAT_FRAME_ENCODER', 'json')
+    return ENCODERS.get(name, _encode_json)
+
+def encode_frame(payload):
+    """ Encode a socket payload once; the result is forwarded verbatim by every consumer """
+    return get_encoder()(payload)
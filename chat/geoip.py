@@ -0,0 +1,86 @@
+# Local IP -> city lookup over a memory-mapped range file built by `manage.py import_geoip`
+import ipaddress
+import mmap
+import os
+import struct
+import threading
+from django.conf import settings
+
+# File layout: header, names ('\n'-joined UTF-8), then the v4 and v6 tables sorted by start.
+# A row is start, end (big-endian, so raw bytes compare like addresses) and a <I name index.
+MAGIC = b'ASGEO1'
+HEADER = struct.Struct('<6sIII')
+NAME_INDEX = struct.Struct('<I')
+ADDR_BYTES = {4: 4, 6: 16}
+
+def db_path(): return getattr(settings, 'GEOIP_DB_PATH', os.path.join(settings.BASE_DIR, 'geoip', 'cities.bin'))
+
+class GeoDB:
+    def __init__(self, path):
+        with open(path, 'rb') as f: self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4_count, v6_count, names_len = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC: raise ValueError(f"{path} is not a GeoIP range file")
+        names_start = HEADER.size
+        self.names = self.mm[names_start:names_start + names_len].decode().split('\n')
+        v4_start = names_start + names_len
+        self.tables = {
+            4: (v4_start, v4_count),
+            6: (v4_start + v4_count * (2 * ADDR_BYTES[4] + NAME_INDEX.size), v6_count),
+        }
+
+    def lookup(self, ip):
+        try: addr = ipaddress.ip_address(ip)
+        except ValueError: return None
+        if addr.version == 6 and addr.ipv4_mapped: addr = addr.ipv4_mapped
+        width = ADDR_BYTES[addr.version]
+        record = 2 * width + NAME_INDEX.size
+        base, count = self.tables[addr.version]
+        key = addr.packed
+        # Last range whose start <= key
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * record
+            if self.mm[offset:offset + width] <= key: lo = mid + 1
+            else: hi = mid
+        if lo == 0: return None
+        offset = base + (lo - 1) * record
+        if key > self.mm[offset + width:offset + 2 * width]: return None # In a gap between ranges
+        return self.names[NAME_INDEX.unpack_from(self.mm, offset + 2 * width)[0]]
+
+_db = None
+_lock = threading.Lock()
+
+def get_db():
+    """ The process-wide mapped database, or None if no file has been imported """
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None and os.path.exists(db_path()): _db = GeoDB(db_path())
+    return _db
+
+def city_for(ip):
+    db = get_db()
+    return db.lookup(ip) if db else None
+
+# --- BUILD (used by import_geoip) ---
+def write_db(path, ranges):
+    """ ranges: iterable of (start_ip, end_ip, city) as ipaddress objects. Written atomically. """
+    names, name_ids, tables = [], {}, {4: [], 6: []}
+    for start, end, city in ranges:
+        if start.version == 6 and start.ipv4_mapped and end.ipv4_mapped: start, end = start.ipv4_mapped, end.ipv4_mapped
+        if start.version != end.version or start > end: continue
+        if city not in name_ids: name_ids[city] = len(names); names.append(city)
+        tables[start.version].append((start.packed, end.packed, name_ids[city]))
+    for table in tables.values(): table.sort()
+    blob = '\n'.join(names).encode()
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(tables[4]), len(tables[6]), len(blob)))
+        f.write(blob)
+        for version in (4, 6):
+            for start, end, idx in tables[version]: f.write(start + end + NAME_INDEX.pack(idx))
+    os.replace(tmp, path) # Running processes keep their old mapping until restart
+    return len(tables[4]), len(tables[6])
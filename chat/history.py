@@ -0,0 +1,113 @@
+from datetime import datetime, timezone as dt_timezone
+from django.db.models import Q, Subquery
+from django.utils import timezone
+from redis import RedisError
+from .models import Message, Room, HistoryClear
+from . import recent
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+# --- CURSORS ---
+# A cursor is the (timestamp, id) of the oldest message already on screen.
+# Paging with "older than this key" instead of OFFSET keeps every page O(page size)
+# on the (room, timestamp, id) index, however deep the scroll-back goes.
+def encode_cursor(msg):
+    return f"{int(msg.timestamp.timestamp() * 1_000_000)}_{msg.id}"
+
+def decode_cursor(cursor):
+    """ Returns (timestamp, id) or None for a malformed cursor """
+    try:
+        micros, msg_id = cursor.split('_')
+        return datetime.fromtimestamp(int(micros) / 1_000_000, tz=dt_timezone.utc), int(msg_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+# --- SERIALIZATION ---
+def serialize_message(msg, profile=None):
+    """ Compact socket/JSON shape shared by live broadcasts and history pages """
+    profile = profile or msg.user.profile
+    return {
+        'id': msg.id, 'username': msg.user.username, 'message': msg.content, 'tier': profile.get_tier(), 'aura': profile.aura,
+        'timestamp': timezone.localtime(msg.timestamp).strftime('%H:%M'), 'image_url': msg.image.url if msg.image else None,
+        'audio_url': msg.audio.url if msg.audio else None, 'user_avatar': profile.profile_picture.url if profile.profile_picture else None,
+        'reply_context': {'username': msg.reply_to.user.username, 'message': msg.reply_to.content} if msg.reply_to else None,
+        'likes': msg.like_count, 'dislikes': msg.dislike_count, 'cursor': encode_cursor(msg),
+    }
+
+# --- ACCESS ---
+def is_locked(user, profile, room_name, config):
+    """ Announcements is read-gated by XP for non-staff users """
+    return room_name == "Announcements" and not user.is_staff and profile.xp < config.announcement_min_xp
+
+# --- PAGES ---
+def fetch_page(room_name, user, before=None, limit=PAGE_SIZE):
+    """
+    Newest `limit` visible messages older than the `before` cursor (or the newest page).
+    Returns {'messages': [...oldest first], 'next_cursor': str|None}
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    room = Room.objects.filter(name=room_name).first()
+    if not room: return {'messages': [], 'next_cursor': None}
+
+    qs = Message.objects.filter(room=room).exclude(hidden_by=user)
+    cleared_at = HistoryClear.objects.filter(user=user, room=room).values_list('cleared_at', flat=True).first()
+    if cleared_at: qs = qs.filter(timestamp__gt=cleared_at)
+    if before:
+        key = decode_cursor(before)
+        if not key: return {'messages': [], 'next_cursor': None}
+        ts, msg_id = key
+        qs = qs.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=msg_id))
+
+    rows, has_more = _newest(qs, limit)
+    return {
+        'messages': [serialize_message(m) for m in rows],
+        'next_cursor': encode_cursor(rows[0]) if has_more else None,
+    }
+
+def _newest(qs, limit):
+    """ Newest `limit` rows of qs, oldest first, plus whether older rows exist """
+    rows = list(qs.select_related('user__profile', 'reply_to__user').order_by('-timestamp', '-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+def recent_page(room_name, user):
+    """
+    Newest page for the room page and reconnecting sockets, served from the room's
+    ring buffer. The database is only hit to warm a cold buffer; per-user visibility
+    (clear watermark, "delete for me") is one small id-bounded lookup.
+    """
+    try:
+        entries = recent.read(room_name)
+        if entries is None:
+            room = Room.objects.filter(name=room_name).first()
+            if not room: return {'messages': [], 'next_cursor': None}
+            rows, _ = _newest(Message.objects.filter(room=room), recent.RECENT_SIZE)
+            entries = [serialize_message(m) for m in rows]
+            recent.fill(room_name, entries)
+    except RedisError:
+        return fetch_page(room_name, user)
+
+    if not entries: return {'messages': [], 'next_cursor': None}
+    ids = [e['id'] for e in entries]
+    cleared_at = HistoryClear.objects.filter(user=user, room__name=room_name).values('cleared_at')[:1]
+    hidden = set(
+        Message.objects.filter(id__in=ids)
+        .filter(Q(hidden_by=user) | Q(timestamp__lte=Subquery(cleared_at)))
+        .values_list('id', flat=True)
+    )
+    return {
+        'messages': [e for e in entries if e['id'] not in hidden],
+        'next_cursor': entries[0]['cursor'] if len(entries) >= recent.RECENT_SIZE else None,
+    }
+
+# --- BUFFER HOOKS (called from ChatConsumer) ---
+def buffer_new(room_name, msg_data):
+    try: recent.push(room_name, msg_data)
+    except RedisError as e: print(f"Recent buffer error: {e}")
+
+def buffer_update(room_name, msg_id, **changes):
+    try: recent.update(room_name, msg_id, **changes)
+    except RedisError as e: print(f"Recent buffer error: {e}")
@@ -0,0 +1,220 @@
+# Ranked XP / aura (and day / week / month gains) in Redis sorted sets, trusted once rebuild() has warmed them
+import threading
+from datetime import timedelta
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from redis import RedisError
+from .models import Profile, DailyGain
+from .redis_client import get_redis
+from . import counters
+
+KEYS = {'xp': "lb:xp", 'aura': "lb:aura"}
+WARM_KEY = "lb:warm"
+REBUILD_LOCK = "lb:rebuilding"
+REBUILD_TIMEOUT = 300 # seconds; a rebuild that died holds off the next one this long
+
+class Rebuilding(RedisError):
+    """ The index is cold and being refilled in the background; callers fall back as if Redis were down """
+
+# Windowed boards: gains per calendar day / ISO week / month, one sorted set per bucket.
+# Buckets start empty by definition, so they need no warm-up and simply expire.
+WINDOWS = {'day': timedelta(days=2), 'week': timedelta(days=8), 'month': timedelta(days=32)} # bucket -> TTL after last gain
+
+def bucket_key(field, window, day=None):
+    day = day or timezone.localdate()
+    if window == 'day': label = day.isoformat()
+    elif window == 'week': label = "%d-W%02d" % day.isocalendar()[:2]
+    else: label = day.strftime('%Y-%m')
+    return f"lb:{field}:{window}:{label}"
+
+# All-time sets are bumped only while warm (a cold set must be rebuilt, not patched
+# with deltas) and take losses too; the current window buckets take gains only
+# (a downvote doesn't cancel today's gains) and have their TTL refreshed
+_BUMP_LUA = """
+local uid, xp, aura = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    if xp ~= '0' then redis.call('ZINCRBY', KEYS[1], xp, uid) end
+    if aura ~= '0' then redis.call('ZINCRBY', KEYS[2], aura, uid) end
+end
+for i = 0, 2 do
+    if tonumber(xp) > 0 then redis.call('ZINCRBY', KEYS[4 + i], xp, uid); redis.call('EXPIRE', KEYS[4 + i], ARGV[4 + i]) end
+    if tonumber(aura) > 0 then redis.call('ZINCRBY', KEYS[7 + i], aura, uid); redis.call('EXPIRE', KEYS[7 + i], ARGV[4 + i]) end
+end
+return 1
+"""
+_bump_script = None
+
+# --- WRITES ---
+def bump(user_id, xp=0, aura=0):
+    global _bump_script
+    try:
+        if _bump_script is None: _bump_script = get_redis().register_script(_BUMP_LUA)
+        today = timezone.localdate()
+        buckets = [bucket_key(field, window, today) for field in ('xp', 'aura') for window in WINDOWS]
+        ttls = [int(ttl.total_seconds()) for ttl in WINDOWS.values()]
+        _bump_script(keys=[KEYS['xp'], KEYS['aura'], WARM_KEY, *buckets], args=[user_id, xp, aura, *ttls])
+    except RedisError as e:
+        print(f"Leaderboard bump failed: {e}")
+
+def forget(user_id):
+    """ Drops the user from the all-time sets and the current window buckets """
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for key in [*KEYS.values(), *(bucket_key(field, window) for field in KEYS for window in WINDOWS)]: pipe.zrem(key, user_id)
+        pipe.execute()
+    except RedisError: pass
+
+def _expected(batch_size=2000):
+    """ Yields (user_id, xp, aura) from the database plus pending deltas """
+    rows = Profile.objects.order_by('user_id').values_list('user_id', 'xp', 'aura')
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield from _with_pending(batch); batch = []
+    yield from _with_pending(batch)
+
+def _with_pending(batch):
+    deltas = counters.pending_many(uid for uid, _, _ in batch)
+    for uid, xp, aura in batch:
+        d = deltas.get(uid, {'xp': 0, 'aura': 0})
+        yield uid, xp + d['xp'], aura + d['aura']
+
+def rebuild(batch_size=2000):
+    """
+    Refills both sets from Profile into temporary keys and swaps them in with
+    RENAME, so readers never see a half-built board. Bumps that land while it
+    runs can be lost; run it when quiet or follow with --check. Returns users indexed.
+    """
+    r = get_redis()
+    tmp = {field: f"{key}:rebuild" for field, key in KEYS.items()}
+    r.delete(*tmp.values())
+    total = 0
+    pipe = r.pipeline(transaction=False)
+    for uid, xp, aura in _expected(batch_size):
+        pipe.zadd(tmp['xp'], {uid: xp}); pipe.zadd(tmp['aura'], {uid: aura})
+        total += 1
+        if total % batch_size == 0: pipe.execute()
+    pipe.execute()
+    pipe = r.pipeline()
+    for field, key in KEYS.items():
+        if total: pipe.rename(tmp[field], key)
+        else: pipe.delete(key)
+    pipe.set(WARM_KEY, 1)
+    pipe.execute()
+    rebuild_windows() # Lost with the all-time sets when Redis was flushed or restarted
+    return total
+
+def rebuild_windows():
+    """ Refills the current day/week/month buckets from DailyGain and unflushed gains. Returns buckets written """
+    today = timezone.localdate()
+    starts = {'day': today, 'week': today - timedelta(days=today.weekday()), 'month': today.replace(day=1)}
+    rows = DailyGain.objects.filter(day__gte=min(starts.values()), day__lte=today).values_list('user_id', 'day', 'xp', 'aura')
+    pending = ((uid, day, g['xp'], g['aura']) for (uid, day), g in counters.pending_gains().items())
+    scores = {} # (field, window) -> {user_id: gain}
+    for uid, day, xp, aura in [*rows, *pending]:
+        for window, start in starts.items():
+            if not start <= day <= today: continue
+            for field, gain in (('xp', xp), ('aura', aura)):
+                if gain:
+                    bucket = scores.setdefault((field, window), {})
+                    bucket[uid] = bucket.get(uid, 0) + gain
+    pipe = get_redis().pipeline()
+    for field in KEYS:
+        for window, ttl in WINDOWS.items():
+            key, bucket = bucket_key(field, window, today), scores.get((field, window))
+            if not bucket: pipe.delete(key); continue
+            pipe.delete(f"{key}:rebuild"); pipe.zadd(f"{key}:rebuild", bucket)
+            pipe.rename(f"{key}:rebuild", key); pipe.expire(key, int(ttl.total_seconds()))
+    pipe.execute()
+    return len(scores)
+
+def check(batch_size=2000):
+    """ Users whose indexed scores differ from the database: [(user_id, field, indexed, expected)] """
+    r = get_redis()
+    drift = []
+    expected = list(_expected(batch_size))
+    for i in range(0, len(expected), batch_size):
+        chunk = expected[i:i + batch_size]
+        ids = [uid for uid, _, _ in chunk]
+        pipe = r.pipeline(transaction=False)
+        pipe.zmscore(KEYS['xp'], ids); pipe.zmscore(KEYS['aura'], ids)
+        xp_scores, aura_scores = pipe.execute()
+        for (uid, xp, aura), got_xp, got_aura in zip(chunk, xp_scores, aura_scores):
+            if got_xp is None or int(got_xp) != xp: drift.append((uid, 'xp', got_xp, xp))
+            if got_aura is None or int(got_aura) != aura: drift.append((uid, 'aura', got_aura, aura))
+    extra = r.zcard(KEYS['xp']) - len(expected)
+    if extra > 0: drift.append((None, 'xp', extra, 0)) # Members with no Profile row
+    return drift
+
+# --- READS ---
+def _rebuild_in_background(r):
+    try: rebuild()
+    except Exception as e: print(f"Leaderboard rebuild failed: {e}")
+    finally:
+        r.delete(REBUILD_LOCK)
+        connection.close() # No request cycle will close this thread's connection
+
+def _ensure_warm(r):
+    """ Never rebuilds in the request: starts one background rebuild and sends this reader to the database """
+    if r.exists(WARM_KEY): return
+    if r.set(REBUILD_LOCK, 1, nx=True, ex=REBUILD_TIMEOUT):
+        threading.Thread(target=_rebuild_in_background, args=(r,), daemon=True).start()
+    raise Rebuilding("leaderboard index is being rebuilt")
+
+def top(field, n):
+    """ [(user_id, score)] best first """
+    r = get_redis()
+    _ensure_warm(r)
+    return [(int(uid), int(score)) for uid, score in r.zrevrange(KEYS[field], 0, n - 1, withscores=True)]
+
+def top_window(field, window, n):
+    """ [(user_id, gain)] best first for the current bucket of `window` """
+    return [(int(uid), int(score)) for uid, score in get_redis().zrevrange(bucket_key(field, window), 0, n - 1, withscores=True)]
+
+def rank(field, user_id):
+    """ 1-based rank, or None if the user has no profile """
+    r = get_redis()
+    _ensure_warm(r)
+    pos = r.zrevrank(KEYS[field], user_id)
+    if pos is None: # Signed up after the last rebuild and never scored: index their stored value
+        row = Profile.objects.filter(user_id=user_id).values_list('user_id', 'xp', 'aura').first()
+        if not row: return None
+        _, xp, aura = next(_with_pending([row])) # Unflushed XP counts, as it does for top()
+        r.zadd(KEYS['xp'], {user_id: xp}, nx=True); r.zadd(KEYS['aura'], {user_id: aura}, nx=True)
+        pos = r.zrevrank(KEYS[field], user_id)
+    return pos + 1
+
+def around(field, user_id, radius=5):
+    """ (rank, [(rank, user_id, score)]) for up to `radius` users either side """
+    my_rank = rank(field, user_id)
+    if my_rank is None: return None, []
+    start = max(my_rank - 1 - radius, 0)
+    entries = get_redis().zrevrange(KEYS[field], start, my_rank - 1 + radius, withscores=True)
+    return my_rank, [(start + i + 1, int(uid), int(score)) for i, (uid, score) in enumerate(entries)]
+
+def profiles(entries, field, attr=None):
+    """
+    Profiles for [(user_id, score)] in board order, one query. The score is copied
+    onto the instance as `attr` (default: the field itself).
+    """
+    by_id = Profile.objects.select_related('user').in_bulk([uid for uid, _ in entries], field_name='user_id')
+    counters.merge_pending(by_id.values()) # The other counter column should be live too
+    ranked = []
+    for uid, score in entries:
+        p = by_id.get(uid)
+        if p: setattr(p, attr or field, score); ranked.append(p)
+    return ranked
+
+def top_profiles(field, n, window=None):
+    """
+    Top-n Profiles, all-time or for a window (gain in `.window_score`).
+    All-time falls back to the ORDER BY when Redis is down; windows have no fallback.
+    """
+    if window:
+        try: return profiles(top_window(field, window, n), field, attr='window_score')
+        except RedisError: return []
+    try: return profiles(top(field, n), field)
+    except RedisError:
+        return counters.merge_pending(Profile.objects.select_related('user').order_by(F(field).desc())[:n])
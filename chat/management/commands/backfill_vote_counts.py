@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from redis import RedisError
+from chat import recent
+from chat.votes import backfill
+
+
+class Command(BaseCommand):
+    help = "Recomputes Message.like_count/dislike_count from the likes/dislikes tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Messages per UPDATE statement")
+
+    def handle(self, *args, **options):
+        updated = backfill(options['batch_size'])
+        try: recent.forget_all() # Buffered entries carry the old counts; next read re-warms from the DB
+        except RedisError as e: self.stderr.write(f"Could not reset recent buffers: {e}")
+        self.stdout.write(self.style.SUCCESS(f"Recounted votes on {updated} messages"))
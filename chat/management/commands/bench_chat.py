@@ -0,0 +1,180 @@
+import asyncio
+import json
+import math
+import os
+import subprocess
+import time
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+from redis import RedisError
+from chat import counters, leaderboard, metrics
+from chat.models import Message, OutboxJob, Room
+from chat.redis_client import get_redis
+from chat.routing import websocket_urlpatterns
+
+PREFIX = "bench_" # Users and rooms created for the run; deleted afterwards with everything they left behind
+LAYERS = {
+    'memory': lambda o: {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}},
+    'redis': lambda o: {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [o['redis_url']], 'capacity': 10000}},
+}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values: return None
+    return sorted_values[max(math.ceil(q * len(sorted_values)) - 1, 0)]
+
+
+def git_commit():
+    """ (short hash, dirty) of the working tree, or (None, None) outside git """
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR, capture_output=True, text=True).stdout.strip())
+        return head, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+class Command(BaseCommand):
+    help = "Drives ChatConsumer with N rooms x M sockets through the real routing and reports throughput, end-to-end latency and DB queries per message."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=4, help="Rooms to spread clients over")
+        parser.add_argument('--clients', type=int, default=25, help="Sockets per room (senders included)")
+        parser.add_argument('--senders', type=int, default=5, help="Sockets per room that send")
+        parser.add_argument('--messages', type=int, default=20, help="Messages per sender")
+        parser.add_argument('--rate', type=float, default=0, help="Messages per second per sender (0 = as fast as possible)")
+        parser.add_argument('--layer', choices=['memory', 'redis', 'settings'], default='memory', help="Channel layer: in-memory, a local Redis, or CHANNEL_LAYERS as configured")
+        parser.add_argument('--redis-url', default='redis://127.0.0.1:6379/3', help="Redis for --layer redis (keep it off the production db)")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for every delivery")
+        parser.add_argument('--output', help="JSON result path (default: bench_results/chat-<commit>-<time>.json)")
+        parser.add_argument('--compare', help="Earlier JSON result to print deltas against")
+
+    def handle(self, *args, **options):
+        if options['senders'] > options['clients']: raise CommandError("--senders cannot exceed --clients")
+        if User.objects.filter(username__startswith=PREFIX).exists():
+            raise CommandError(f"Leftover '{PREFIX}*' users from an interrupted run; delete them first")
+
+        layer = settings.CHANNEL_LAYERS['default'] if options['layer'] == 'settings' else LAYERS[options['layer']](options)
+        users, rooms = self.seed(options)
+        try:
+            with override_settings(CHANNEL_LAYERS={'default': layer}):
+                results = async_to_sync(self.run)(users, rooms, options)
+        finally:
+            self.cleanup(rooms)
+
+        commit, dirty = git_commit()
+        report = {
+            'commit': commit, 'dirty': dirty, 'at': timezone.now().isoformat(),
+            'config': {k: options[k] for k in ('rooms', 'clients', 'senders', 'messages', 'rate', 'layer')}
+                      | {'outbox': getattr(settings, 'OUTBOX_ENABLED', False), 'write_behind': getattr(settings, 'XP_WRITE_BEHIND', False),
+                         'db': settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1]},
+            'results': results,
+        }
+        self.print_report(report, options.get('compare'))
+        path = options['output'] or os.path.join(settings.BASE_DIR, 'bench_results', f"chat-{commit or 'nogit'}-{timezone.now():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f: json.dump(report, f, indent=2)
+        self.stdout.write(f"Saved {path}")
+
+    # --- SETUP ---
+    def seed(self, options):
+        users = [User.objects.create_user(f"{PREFIX}{i}", password=None) for i in range(options['rooms'] * options['clients'])]
+        rooms = [f"{PREFIX}{r}" for r in range(options['rooms'])]
+        Room.objects.bulk_create([Room(name=name) for name in rooms])
+        return users, rooms
+
+    def cleanup(self, rooms):
+        user_ids = list(User.objects.filter(username__startswith=PREFIX).values_list('id', flat=True))
+        message_ids = list(Message.objects.filter(room__name__in=rooms).values_list('id', flat=True))
+        # Queued side effects of the run (streaks, daily counts, mentions) would otherwise be worked off later
+        OutboxJob.objects.filter(payload__user_id__in=user_ids).delete()
+        OutboxJob.objects.filter(payload__message_id__in=message_ids).delete()
+        User.objects.filter(id__in=user_ids).delete() # Messages cascade
+        Room.objects.filter(name__in=rooms).delete()
+        for uid in user_ids: leaderboard.forget(uid)
+        try: # Recent-message buffers of the bench rooms and unflushed XP of the bench users
+            r = get_redis()
+            keys = [k for name in rooms for k in r.scan_iter(f"chat:recent:{name}*")]
+            if keys: r.delete(*keys)
+            fields = [f"{field}:{uid}" for uid in user_ids for field in counters.FIELDS]
+            if fields: r.hdel(counters.PENDING_KEY, *fields); r.hdel(counters.PROCESSING_KEY, *fields)
+        except RedisError: pass
+
+    # --- RUN ---
+    async def run(self, users, rooms, options):
+        app = URLRouter(websocket_urlpatterns)
+        clients = [] # (room index, communicator)
+        for i, user in enumerate(users):
+            room = i // options['clients']
+            c = WebsocketCommunicator(app, f"/ws/chat/{rooms[room]}/")
+            c.scope['user'] = user
+            connected, _ = await c.connect()
+            if not connected: raise CommandError(f"Socket {i} was refused")
+            clients.append((room, c))
+
+        expected = options['senders'] * options['messages'] # chat frames each socket should see
+        latencies, received = [], [0]
+        count_before, queries_before = metrics.ws_queries.get('new_message') # Counted by chat.metrics around each command
+
+        async def receiver(c):
+            seen = 0
+            while seen < expected:
+                frame = json.loads(await c.receive_from(options['timeout']))
+                if frame.get('type') != 'chat_message' or not frame.get('message', '').startswith('bench '): continue
+                latencies.append(time.perf_counter() - float(frame['message'].split()[-1]))
+                seen += 1; received[0] += 1
+
+        async def sender(c, index):
+            gap = 1 / options['rate'] if options['rate'] else 0
+            for seq in range(options['messages']):
+                await c.send_to(text_data=json.dumps({'command': 'new_message', 'message': f"bench {index} {seq} {time.perf_counter()}"}))
+                await asyncio.sleep(gap) # 0 still yields, so senders interleave
+
+        senders = [c for i, (room, c) in enumerate(clients) if i % options['clients'] < options['senders']]
+        start = time.perf_counter()
+        receiving = [asyncio.ensure_future(receiver(c)) for _, c in clients]
+        await asyncio.gather(*(sender(c, i) for i, c in enumerate(senders)))
+        sent_at = time.perf_counter()
+        lost = 0
+        try: await asyncio.wait_for(asyncio.gather(*receiving), options['timeout'])
+        except (asyncio.TimeoutError, AssertionError):
+            lost = expected * len(clients) - received[0]
+            for task in receiving: task.cancel()
+        elapsed = time.perf_counter() - start
+        for _, c in clients: await c.disconnect()
+
+        count_after, queries_after = metrics.ws_queries.get('new_message')
+        handled = count_after - count_before
+        latencies.sort()
+        ms = lambda v: None if v is None else round(v * 1000, 2)
+        return {
+            'messages': len(senders) * options['messages'], 'deliveries': received[0], 'lost_deliveries': lost,
+            'elapsed_s': round(elapsed, 3), 'send_phase_s': round(sent_at - start, 3),
+            'messages_per_s': round(len(senders) * options['messages'] / elapsed, 1),
+            'deliveries_per_s': round(received[0] / elapsed, 1),
+            'latency_ms': {'p50': ms(percentile(latencies, 0.5)), 'p95': ms(percentile(latencies, 0.95)),
+                           'p99': ms(percentile(latencies, 0.99)), 'max': ms(latencies[-1] if latencies else None)},
+            'db_queries_per_message': round((queries_after - queries_before) / handled, 2) if handled and metrics.ENABLED else None,
+        }
+
+    # --- REPORT ---
+    def print_report(self, report, compare_path):
+        res, cfg = report['results'], report['config']
+        self.stdout.write(f"{cfg['rooms']} rooms x {cfg['clients']} sockets, {cfg['senders']} senders/room x {cfg['messages']} msgs, {cfg['layer']} layer, commit {report['commit']}{' (dirty)' if report['dirty'] else ''}")
+        before = None
+        if compare_path:
+            with open(compare_path) as f: before = json.load(f)['results']
+        rows = [('messages/s', res['messages_per_s'], before and before['messages_per_s']),
+                ('deliveries/s', res['deliveries_per_s'], before and before['deliveries_per_s'])]
+        rows += [(f"latency {q} ms", res['latency_ms'][q], before and before['latency_ms'][q]) for q in ('p50', 'p95', 'p99', 'max')]
+        rows += [('queries/message', res['db_queries_per_message'], before and before['db_queries_per_message']),
+                 ('lost deliveries', res['lost_deliveries'], before and before['lost_deliveries'])]
+        for label, value, old in rows:
+            delta = f"  ({value - old:+.2f} vs {old})" if before and value is not None and old is not None else ''
+            self.stdout.write(f"{label:>18} {value if value is not None else '-':>10}{delta}")
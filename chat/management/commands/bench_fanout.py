@@ -0,0 +1,51 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from chat.frames import ENCODERS
+
+
+SAMPLE_MESSAGE = {
+    'id': 128734, 'username': 'Pilot-4821', 'message': 'Anyone up for the late night lofi session? 🎧 @Pilot-1024',
+    'tier': 'PLATINUM', 'aura': 1450, 'timestamp': '23:41', 'image_url': None, 'audio_url': None,
+    'user_avatar': '/media/profile_pics/pilot_4821.png',
+    'reply_context': {'username': 'Pilot-1024', 'message': 'Who is still awake?'},
+    'likes': 0, 'dislikes': 0,
+}
+
+
+class Command(BaseCommand):
+    help = "Measures per-broadcast CPU cost of encoding chat frames versus room size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,500,1000,2000', help="Comma separated room sizes")
+        parser.add_argument('--repeat', type=int, default=50, help="Broadcasts per measurement")
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        repeat = options['repeat']
+
+        self.stdout.write(f"{'room size':>10} {'per-consumer json':>18} " + " ".join(f"{'once/' + n:>14}" for n in ENCODERS))
+        for size in sizes:
+            row = [self.per_consumer(size, repeat)]
+            for encoder in ENCODERS.values():
+                row.append(self.encode_once(encoder, size, repeat))
+            self.stdout.write(f"{size:>10} " + " ".join(f"{us:>15.1f}us" if i == 0 else f"{us:>12.1f}us" for i, us in enumerate(row)))
+        self.stdout.write("CPU time per broadcast (process time), lower is better.")
+
+    def per_consumer(self, size, repeat):
+        """ Old path: every consumer re-encodes the group event """
+        event = {'type': 'chat_message', 'message_data': SAMPLE_MESSAGE}
+        start = time.process_time()
+        for _ in range(repeat):
+            for _ in range(size):
+                json.dumps({'type': 'chat_message', **event['message_data']})
+        return (time.process_time() - start) / repeat * 1e6
+
+    def encode_once(self, encoder, size, repeat):
+        """ New path: the sender encodes once, consumers forward the frame """
+        start = time.process_time()
+        for _ in range(repeat):
+            event = {'type': 'chat_message', 'frame': encoder({'type': 'chat_message', **SAMPLE_MESSAGE})}
+            for _ in range(size):
+                event['frame']
+        return (time.process_time() - start) / repeat * 1e6
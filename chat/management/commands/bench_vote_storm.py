@@ -0,0 +1,62 @@
+import asyncio
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from redis import RedisError
+from chat.redis_client import get_redis
+from chat.vote_feed import VoteCoalescer, WINDOW, vote_frame
+
+BENCH_KEY = "votes:pending:bench" # Kept apart from the live rooms' pending counts
+
+
+class Command(BaseCommand):
+    help = "Simulates a like storm through the Redis-backed coalescer and compares room frames per second with and without per-message coalescing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--votes', type=int, default=5000, help="Total votes in the storm")
+        parser.add_argument('--seconds', type=float, default=2.0, help="Storm duration")
+        parser.add_argument('--messages', type=int, default=1, help="Distinct messages being voted on")
+        parser.add_argument('--threads', type=int, default=4, help="Concurrent voters (request threads)")
+        parser.add_argument('--room-size', type=int, default=200, help="Sockets in the room, for the fan-out column")
+        parser.add_argument('--window-ms', type=float, default=WINDOW * 1000, help="Coalescing window to compare against")
+
+    def handle(self, *args, **options):
+        try: get_redis().ping()
+        except RedisError as e: raise CommandError(f"The coalescer stages votes in Redis, which is unavailable: {e}")
+        self.stdout.write(f"{'mode':>16} {'votes':>7} {'frames':>7} {'frames/s':>10} {'socket writes/s':>16}")
+        for label, window in (('no coalescing', 0), (f"{options['window_ms']:g}ms window", options['window_ms'] / 1000)):
+            votes, frames, elapsed = self.storm(window, options)
+            self.stdout.write(
+                f"{label:>16} {votes:>7} {frames:>7} {frames / elapsed:>10.1f} {frames * options['room_size'] / elapsed:>16.0f}"
+            )
+
+    def storm(self, window, options):
+        """ Runs the storm through a VoteCoalescer whose sink only encodes and counts frames """
+        sent = [0]
+        lock = threading.Lock()
+
+        def sink(batch):
+            for (room_name, msg_id), counts in batch.items(): vote_frame(msg_id, *counts)
+            with lock: sent[0] += len(batch)
+
+        loop = asyncio.new_event_loop() # Stands in for the server loop that schedules the flushes
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        coalescer = VoteCoalescer(window=window, send=sink, key=BENCH_KEY, loop=loop)
+        per_thread = options['votes'] // options['threads']
+        gap = options['seconds'] / max(per_thread, 1)
+
+        def voter(offset):
+            for i in range(per_thread):
+                msg_id = (offset + i) % options['messages']
+                coalescer.publish('bench', msg_id, offset + i, 0)
+                time.sleep(gap)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=voter, args=(t * per_thread,)) for t in range(options['threads'])]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        time.sleep(window) # Let the last window's scheduled flush run
+        coalescer.flush()
+        elapsed = time.perf_counter() - start
+        loop.call_soon_threadsafe(loop.stop)
+        return per_thread * options['threads'], sent[0], elapsed
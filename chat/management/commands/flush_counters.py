@@ -0,0 +1,27 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from redis import RedisError
+from chat.counters import flush
+from chat import presence
+
+
+class Command(BaseCommand):
+    help = "Flushes write-behind XP/aura deltas and last-seen stamps from Redis into Profile rows (runs forever unless --once)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'XP_FLUSH_INTERVAL', 5), help="Seconds between flushes")
+        parser.add_argument('--batch-size', type=int, default=500, help="Users per UPDATE statement")
+        parser.add_argument('--once', action='store_true', help="Flush once and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                touched = flush(options['batch_size'])
+                if touched: self.stdout.write(f"Flushed counters for {touched} users")
+                seen = presence.flush(options['batch_size'])
+                if seen: self.stdout.write(f"Flushed presence for {seen} users")
+            except RedisError as e:
+                self.stderr.write(f"Counter flush failed: {e}")
+            if options['once']: break
+            time.sleep(options['interval'])
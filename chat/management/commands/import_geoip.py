@@ -0,0 +1,42 @@
+import csv
+import ipaddress
+from django.core.management.base import BaseCommand, CommandError
+from chat.geoip import db_path, write_db
+
+
+class Command(BaseCommand):
+    help = "Compiles an IP range CSV (start, end, ..., city) into the memory-mapped GeoIP file used by ActiveUserMiddleware."
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_path')
+        parser.add_argument('--start-col', type=int, default=0, help="Column holding the range start (dotted/colon IP or integer)")
+        parser.add_argument('--end-col', type=int, default=1, help="Column holding the range end")
+        parser.add_argument('--city-col', type=int, default=-1, help="Column holding the city name (default: last)")
+        parser.add_argument('--skip-header', action='store_true')
+        parser.add_argument('--output', default=None, help="Defaults to settings.GEOIP_DB_PATH")
+
+    def handle(self, *args, **options):
+        skipped = 0
+
+        def parse(value):
+            value = value.strip()
+            return ipaddress.ip_address(int(value)) if value.isdigit() else ipaddress.ip_address(value)
+
+        def rows():
+            nonlocal skipped
+            with open(options['csv_path'], newline='', encoding='utf-8') as f:
+                reader = csv.reader(f)
+                if options['skip_header']: next(reader, None)
+                for row in reader:
+                    try:
+                        city = row[options['city_col']].strip().replace('\n', ' ')
+                        if not city or city == '-': skipped += 1; continue
+                        yield parse(row[options['start_col']]), parse(row[options['end_col']]), city
+                    except (IndexError, ValueError):
+                        skipped += 1
+
+        output = options['output'] or db_path()
+        try: v4, v6 = write_db(output, rows())
+        except OSError as e: raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Wrote {v4} IPv4 and {v6} IPv6 ranges to {output} ({skipped} rows skipped)"))
+        self.stdout.write("Restart web and worker processes to map the new file.")
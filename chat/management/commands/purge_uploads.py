@@ -0,0 +1,15 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.uploads import purge_stale
+
+
+class Command(BaseCommand):
+    help = "Deletes abandoned chunked media uploads and their spool files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help="Age after which an unclaimed upload is removed")
+
+    def handle(self, *args, **options):
+        removed = purge_stale(timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} stale uploads."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from chat import leaderboard
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the Redis XP/aura leaderboard from Profile, or with --check reports where it has drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Compare against the database without rebuilding")
+        parser.add_argument('--batch-size', type=int, default=2000, help="Profiles per read / pipeline")
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            total = leaderboard.rebuild(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Indexed {total} profiles"))
+            return
+
+        drift = leaderboard.check(options['batch_size'])
+        for user_id, field, indexed, expected in drift[:50]:
+            if user_id is None: self.stdout.write(f"  {indexed} indexed users have no profile")
+            else: self.stdout.write(f"  user {user_id}: {field} indexed={indexed} expected={expected}")
+        if drift: self.stdout.write(self.style.WARNING(f"{len(drift)} mismatches; run without --check to rebuild"))
+        else: self.stdout.write(self.style.SUCCESS("Leaderboard matches the database"))
@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from chat.outbox import process_batch, queue_stats, purge_done
+
+
+class Command(BaseCommand):
+    help = "Processes queued side effects (streaks, daily counters, mention pushes) from the outbox table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Jobs claimed per poll")
+        parser.add_argument('--interval', type=float, default=0.5, help="Idle sleep between polls, in seconds")
+        parser.add_argument('--stats-every', type=float, default=30, help="Seconds between queue lag reports")
+        parser.add_argument('--keep-days', type=int, default=3, help="Finished jobs older than this are deleted")
+        parser.add_argument('--once', action='store_true', help="Drain what is due and exit")
+
+    def handle(self, *args, **options):
+        last_stats = 0
+        while True:
+            close_old_connections()
+            done, failed = process_batch(options['batch_size'])
+            if done or failed: self.stdout.write(f"Outbox: {done} done, {failed} failed")
+
+            if time.monotonic() - last_stats >= options['stats_every']:
+                stats = queue_stats()
+                purged = purge_done(timezone.now() - timedelta(days=options['keep_days']))
+                self.stdout.write(f"Outbox lag {stats['lag_seconds']:.1f}s, {stats['pending']} pending, {stats['dead']} dead, {purged} purged")
+                last_stats = time.monotonic()
+
+            if options['once'] and not (done or failed): break
+            if not (done or failed): time.sleep(options['interval'])
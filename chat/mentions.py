@@ -0,0 +1,27 @@
+# @mention resolution: one `username__in` query on the unique index, deliberately uncached
+import asyncio
+import re
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+
+MENTION_RE = re.compile(r'@(\w+)')
+
+def extract(content):
+    """ Unique @usernames in order of appearance """
+    return list(dict.fromkeys(MENTION_RE.findall(content or '')))
+
+def resolve(usernames):
+    """ {username: user_id} for the names that exist, in one query """
+    if not usernames: return {}
+    return dict(get_user_model().objects.filter(username__in=list(usernames)).values_list('username', 'id'))
+
+def notify(user_ids, sender_name):
+    """ One blocking hop into the event loop for all targets, instead of one per mention """
+    if not user_ids: return
+    channel_layer = get_channel_layer()
+    event = {"type": "send_notification", "message": f"@{sender_name} mentioned you!", "sender": sender_name}
+
+    async def dispatch():
+        await asyncio.gather(*(channel_layer.group_send(f"user_{uid}", event) for uid in user_ids))
+    async_to_sync(dispatch)()
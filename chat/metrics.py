@@ -0,0 +1,229 @@
+# Per-worker metrics in Prometheus text format, served by /metrics/ to METRICS_ALLOWED_IPS
+import contextvars
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.backends.signals import connection_created
+
+ENABLED = getattr(settings, 'METRICS_ENABLED', True)
+ALLOWED_IPS = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+TOKEN = getattr(settings, 'METRICS_TOKEN', None)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_lock = threading.Lock()
+_metrics = []
+
+def _escape(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values): return ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help, tuple(labels), buckets
+        self.series = {} # label values -> [bucket counts..., sum, count]
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        with _lock:
+            s = self.series.get(label_values)
+            if s is None: s = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: s[i] += 1
+            s[-2] += value; s[-1] += 1
+
+    def get(self, *label_values):
+        """ (count, sum) for one series """
+        with _lock:
+            s = self.series.get(label_values)
+            return (s[-1], s[-2]) if s else (0, 0)
+
+    def totals(self):
+        """ (count, sum) over every series """
+        with _lock: return sum(s[-1] for s in self.series.values()), sum(s[-2] for s in self.series.values())
+
+    def quantile(self, q):
+        """ Bucket upper bound below which a fraction q of all observations fall (None if empty) """
+        with _lock:
+            totals = [sum(s[i] for s in self.series.values()) for i in range(len(self.buckets) + 2)]
+        if not totals[-1]: return None
+        for i, bound in enumerate(self.buckets):
+            if totals[i] >= q * totals[-1]: return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock: series = {k: list(v) for k, v in self.series.items()}
+        for values, s in sorted(series.items()):
+            base = _labels(self.label_names, values)
+            sep = ',' if base else ''
+            for i, bound in enumerate(self.buckets):
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {s[i]}')
+            lines.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {s[-1]}')
+            suffix = f"{{{base}}}" if base else ''
+            lines.append(f"{self.name}_sum{suffix} {round(s[-2], 6)}")
+            lines.append(f"{self.name}_count{suffix} {s[-1]}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.series = {}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with _lock: self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock: series = dict(self.series)
+        for values, total in sorted(series.items()):
+            base = _labels(self.label_names, values)
+            lines.append(f"{self.name}{{{base}}} {total}" if base else f"{self.name} {total}")
+        return lines
+
+class Gauge:
+    """ Read when scraped from `func() -> {label value tuple: number}` """
+    def __init__(self, name, help, func, labels=()):
+        self.name, self.help, self.func, self.label_names = name, help, func, tuple(labels)
+        _metrics.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try: series = self.func()
+        except Exception as e: # A broken gauge must not take the whole scrape down
+            print(f"Gauge {self.name} unavailable: {e}")
+            series = {}
+        for values, value in sorted(series.items()):
+            base = _labels(self.label_names, values)
+            lines.append(f"{self.name}{{{base}}} {value}" if base else f"{self.name} {value}")
+        return lines
+
+# --- DB QUERY ATTRIBUTION ---
+_scope = contextvars.ContextVar('metrics_scope', default=None)
+
+class Scope:
+    def __init__(self, label):
+        self.label, self.queries, self.db_time = label, 0, 0.0
+
+def _count_query(execute, sql, params, many, context):
+    scope = _scope.get()
+    if scope is None: return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try: return execute(sql, params, many, context)
+    finally:
+        scope.queries += 1; scope.db_time += time.perf_counter() - start
+
+def _install(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers: connection.execute_wrappers.append(_count_query)
+
+if ENABLED:
+    connection_created.connect(_install, dispatch_uid="chat.metrics.install")
+    for conn in connections.all(initialized_only=True): _install(None, conn) # Opened before this module was imported
+
+@contextmanager
+def track(latency, queries, db_time, label=None):
+    """
+    Times the block and the DB queries it causes (in any thread it awaits). The
+    yielded Scope's label can be set inside the block, e.g. once the view is known.
+    """
+    scope = Scope(label)
+    token = _scope.set(scope)
+    start = time.perf_counter()
+    try: yield scope
+    finally:
+        _scope.reset(token)
+        label = scope.label or 'unknown'
+        latency.observe(time.perf_counter() - start, label)
+        queries.observe(scope.queries, label); db_time.observe(scope.db_time, label)
+
+# --- THREAD POOL ---
+_loop = None # The server's event loop, noted by the first socket (see note_loop)
+
+def note_loop(loop):
+    global _loop
+    _loop = loop
+
+def _queued(executor):
+    """ Waiting work items, or None if the executor doesn't expose its queue """
+    qsize = getattr(getattr(executor, '_work_queue', None), 'qsize', None)
+    return qsize() if callable(qsize) else None
+
+def _pool_depth():
+    """
+    Work items waiting for a thread. Under ASGI each HTTP request gets its own
+    thread-sensitive executor (ThreadSensitiveContext), so those are summed;
+    sockets use the process-wide one and thread_sensitive=False calls the loop's default.
+    These are asgiref / asyncio internals: a series they no longer expose is left out.
+    """
+    from asgiref.sync import SyncToAsync
+    per_request = getattr(SyncToAsync, 'context_to_thread_executor', None)
+    try: per_request = [_queued(e) for e in list(per_request.values())] if per_request is not None else [None]
+    except RuntimeError: per_request = [0] # Changed size while copying: a request just started or ended
+    depth = {
+        ('request',): None if None in per_request else sum(per_request),
+        ('thread_sensitive',): _queued(getattr(SyncToAsync, 'single_thread_executor', None)),
+        ('default',): _queued(getattr(_loop, '_default_executor', None)) if _loop is not None else 0,
+    }
+    return {k: v for k, v in depth.items() if v is not None}
+
+# --- OUTBOX ---
+def _outbox_stats():
+    from .outbox import queue_stats # Imported late: the outbox pulls in the models
+    try: return queue_stats()
+    except DatabaseError as e:
+        print(f"Outbox stats unavailable: {e}")
+        return {}
+
+def _outbox_lag():
+    stats = _outbox_stats()
+    return {(): stats['lag_seconds']} if stats else {}
+
+def _outbox_jobs():
+    stats = _outbox_stats()
+    return {(status,): stats[status] for status in ('pending', 'dead') if status in stats}
+
+# --- METRICS ---
+http_latency = Histogram('airspace_http_request_duration_seconds', "Request latency by view", ['view'])
+http_queries = Histogram('airspace_http_request_db_queries', "DB queries per request by view", ['view'], QUERY_BUCKETS)
+http_db_time = Histogram('airspace_http_request_db_seconds', "DB time per request by view", ['view'])
+http_responses = Counter('airspace_http_responses_total', "Responses by view and status class", ['view', 'status'])
+ws_latency = Histogram('airspace_ws_command_duration_seconds', "Socket command handling time", ['command'])
+ws_queries = Histogram('airspace_ws_command_db_queries', "DB queries per socket command", ['command'], QUERY_BUCKETS)
+ws_db_time = Histogram('airspace_ws_command_db_seconds', "DB time per socket command", ['command'])
+group_send_latency = Histogram('airspace_channel_group_send_seconds', "Channel layer group_send latency", ['event'])
+pool_depth = Gauge('airspace_threadpool_queue_depth', "Calls waiting for a sync_to_async thread", _pool_depth, ['executor'])
+outbox_lag = Gauge('airspace_outbox_lag_seconds', "Age of the oldest pending outbox job", _outbox_lag)
+outbox_jobs = Gauge('airspace_outbox_jobs', "Outbox jobs waiting or parked", _outbox_jobs, ['status'])
+
+def health():
+    """ This worker's numbers for the dashboard's System Health panel """
+    def ms(seconds): return None if seconds is None else ('>10000' if seconds == float('inf') else round(seconds * 1000))
+    http_p95, ws_p95 = http_latency.quantile(0.95), ws_latency.quantile(0.95)
+    requests, queries = http_queries.totals()
+    depth = _pool_depth()
+    backlog = sum(depth.values()) if depth else None # None: not measurable on this asgiref
+    worst = max(http_p95 or 0, ws_p95 or 0)
+    if http_p95 is None and ws_p95 is None: load = "No data"
+    elif worst >= 1 or (backlog or 0) >= 10: load = "Critical"
+    elif worst >= 0.25 or backlog: load = "Heavy"
+    else: load = "Normal"
+    return {
+        'system_load': load, 'latency_ms': ms(http_p95), 'ws_latency_ms': ms(ws_p95),
+        'queries_per_request': round(queries / requests, 1) if requests else None, 'pool_backlog': backlog,
+    }
+
+def authorized(request):
+    """ /metrics/ access: an allowed address plus a staff session or the bearer token """
+    if request.META.get('REMOTE_ADDR') not in ALLOWED_IPS: return False
+    if request.user.is_authenticated and request.user.is_staff: return True
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(TOKEN) and header.startswith('Bearer ') and hmac.compare_digest(header[7:].encode(), TOKEN.encode())
+
+def render():
+    lines = []
+    for metric in _metrics: lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -1,8 +1,7 @@
-import requests
-from django.utils import timezone
 from django.core.cache import cache
-from .models import Profile, DailyActivity  # DailyActivity add kiya
-from .retention_engine import grant_xp      # XP Engine add kiya
+from .models import Profile, SiteConfig
+from .retention_engine import grant_reward, claim_daily_flag      # XP Engine add kiya
+from . import outbox, presence, metrics
 
 class ActiveUserMiddleware:
     def __init__(self, get_response):
@@ -15,51 +14,28 @@ class ActiveUserMiddleware:
             
             if not cache.get(cache_key):
                 try:
-                    # --- PART 1: PROFILE UPDATES (Existing) ---
-                    profile = request.user.profile
-                    
-                    # 1. Update Time
-                    profile.last_activity = timezone.now()
-                    
-                    # 2. DEVICE DETECTION
+                    # --- PART 1: PRESENCE + PROFILE ---
+                    # 1 + 2. Last seen & DEVICE DETECTION: one write to the shared presence hash, flushed to Profile in batches
                     user_agent = request.META.get('HTTP_USER_AGENT', '').lower()
                     is_mobile = 'mobile' in user_agent or 'android' in user_agent or 'iphone' in user_agent
-                    profile.is_mobile = is_mobile
+                    presence.touch(request.user.id, is_mobile)
 
-                    # 3. CITY DETECTION
-                    if profile.city == "Unknown" or not profile.city:
+                    # 3. CITY DETECTION (local GeoIP file via the outbox worker; never blocks the request)
+                    city = Profile.objects.filter(user_id=request.user.id).values_list('city', flat=True).first()
+                    if city == "Unknown" or not city:
                         ip = request.META.get('REMOTE_ADDR')
                         
                         # Localhost Fix
                         if ip == '127.0.0.1': 
-                            profile.city = "Rawalpindi (Local)"
-                        else:
-                            try:
-                                response = requests.get(f'http://ip-api.com/json/{ip}', timeout=2)
-                                data = response.json()
-                                if data.get('status') == 'success':
-                                    profile.city = data.get('city', 'Unknown')
-                            except:
-                                pass 
-
-                    # Save Profile Changes
-                    profile.save()
+                            Profile.objects.filter(user_id=request.user.id).update(city="Rawalpindi (Local)")
+                        elif ip:
+                            outbox.enqueue([('resolve_city', {'user_id': request.user.id, 'ip': ip}, f"city:{request.user.id}:{ip}")])
 
                     # --- PART 2: DAILY LOGIN BONUS (NEW) ---
                     # Hum isay bhi cache block mein rakhenge taake har second DB check na ho
-                    today = timezone.now().date()
-                    
-                    # Check/Create today's activity row
-                    daily, created = DailyActivity.objects.get_or_create(
-                        user=request.user, 
-                        date=today
-                    )
-                    
-                    # Agar aaj ka bonus nahi mila, to de do
-                    if not daily.login_claimed:
-                        grant_xp(request.user, 5, source="Daily Login")
-                        daily.login_claimed = True
-                        daily.save()
+                    # Agar aaj ka bonus nahi mila, to de do (conditional claim: two tabs can't both get it)
+                    if claim_daily_flag(request.user, 'login_claimed'):
+                        grant_reward(request.user, xp=SiteConfig.get_solo().daily_login_xp, source="Daily Login")
                     
                     # Cache set kar do 60 seconds ke liye (Profile + Bonus checks won't run again for 1 min)
                     cache.set(cache_key, True, 60) 
@@ -70,4 +46,18 @@ class ActiveUserMiddleware:
                     pass
 
         response = self.get_response(request)
-        return response
\ No newline at end of file
+        return response
+
+# Request latency / DB queries per view (see metrics.py); listed first so it covers the other middleware too
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not metrics.ENABLED: return self.get_response(request)
+        with metrics.track(metrics.http_latency, metrics.http_queries, metrics.http_db_time) as scope:
+            response = self.get_response(request)
+            match = request.resolver_match # Route names keep the label set small (no raw paths)
+            scope.label = match.view_name if match else 'unresolved'
+        metrics.http_responses.inc(scope.label, f"{response.status_code // 100}xx")
+        return response
@@ -0,0 +1,75 @@
+# Generated by Django 6.0 on 2026-10-18 18:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Exists, Max, OuterRef, Subquery
+
+
+def collapse_hidden_rows(apps, schema_editor):
+    """
+    "Clear history" used to add a hidden_by row for every message in the room.
+    For each (user, room), the run of hidden messages from the start of the room
+    becomes a single watermark; rows after the first visible message are real
+    "delete for me" hides and are left alone. One grouped query over the through
+    table finds every watermark, one insert stores them and one delete drops the
+    rows they cover.
+    """
+    Message = apps.get_model('chat', 'Message')
+    HistoryClear = apps.get_model('chat', 'HistoryClear')
+    Hidden = Message.hidden_by.through
+
+    # Oldest message of the room this user can still see, and the newest one before it
+    visible = Message.objects.filter(room_id=OuterRef('message__room_id')).exclude(
+        Exists(Hidden.objects.filter(user_id=OuterRef(OuterRef('user_id')), message_id=OuterRef('id'))))
+    pairs = (Hidden.objects.values('user_id', 'message__room_id')
+             .annotate(last_hidden=Max('message__timestamp'),
+                       first_visible=Subquery(visible.order_by('timestamp').values('timestamp')[:1]))
+             .annotate(before_visible=Subquery(
+                 Message.objects.filter(room_id=OuterRef('message__room_id'), timestamp__lt=OuterRef('first_visible'))
+                 .order_by('-timestamp').values('timestamp')[:1])))
+
+    clears = []
+    for row in pairs.iterator():
+        # Everything up to the last hidden message is hidden, unless a visible message comes first;
+        # then the watermark stops short of it (a visible message sharing its timestamp stays visible)
+        if row['first_visible'] is None or row['last_hidden'] < row['first_visible']: watermark = row['last_hidden']
+        else: watermark = row['before_visible']
+        if watermark: clears.append(HistoryClear(user_id=row['user_id'], room_id=row['message__room_id'], cleared_at=watermark))
+    HistoryClear.objects.bulk_create(clears, batch_size=1000)
+    Hidden.objects.filter(Exists(HistoryClear.objects.filter(
+        user_id=OuterRef('user_id'), room_id=OuterRef('message__room_id'), cleared_at__gte=OuterRef('message__timestamp')))).delete()
+
+
+def expand_watermarks(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    HistoryClear = apps.get_model('chat', 'HistoryClear')
+    Hidden = Message.hidden_by.through
+
+    for clear in HistoryClear.objects.all():
+        ids = Message.objects.filter(room_id=clear.room_id, timestamp__lte=clear.cleared_at).values_list('id', flat=True)
+        Hidden.objects.bulk_create([Hidden(user_id=clear.user_id, message_id=i) for i in ids], ignore_conflicts=True, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_room_timestamp_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoryClear',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cleared_at', models.DateTimeField()),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history_clears', to='chat.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history_clears', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'room')},
+            },
+        ),
+        migrations.RunPython(collapse_hidden_rows, expand_watermarks),
+    ]
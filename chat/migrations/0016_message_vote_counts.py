@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-18 19:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counts(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+
+    def total(through):
+        return Coalesce(Subquery(
+            through.objects.filter(message_id=OuterRef('pk')).values('message_id')
+            .annotate(n=Count('id')).values('n')[:1]
+        ), 0)
+
+    Message.objects.update(like_count=total(Message.likes.through), dislike_count=total(Message.dislikes.through))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_outboxjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='dislike_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
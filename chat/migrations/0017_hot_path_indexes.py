@@ -0,0 +1,41 @@
+# Generated by Django 6.0 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_message_vote_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['timestamp'], name='chat_msg_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['xp'], name='chat_profile_xp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['aura'], name='chat_profile_aura_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['last_activity'], name='chat_profile_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['subscription_tier', 'last_activity'], name='chat_profile_tier_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(('city', 'Unknown'), _negated=True), fields=['city'], name='chat_profile_city_known_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(('subscription_tier', 'Free'), _negated=True), fields=['subscription_tier'], name='chat_profile_paid_idx'),
+        ),
+    ]
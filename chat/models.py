@@ -1,9 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from datetime import date
+from . import tiers
+from .solo_cache import SoloCache
 
 
 # 1. TRACKS LONG TERM HABITS
@@ -79,13 +82,22 @@ class Profile(models.Model):
     
     # Tracks exactly when they were last clicking links
     last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # Leaderboard fallback / tier queries, activity windows and the dashboard breakdowns
+        indexes = [
+            models.Index(fields=['xp'], name='chat_profile_xp_idx'),
+            models.Index(fields=['aura'], name='chat_profile_aura_idx'),
+            models.Index(fields=['last_activity'], name='chat_profile_active_idx'),
+            models.Index(fields=['subscription_tier', 'last_activity'], name='chat_profile_tier_active_idx'),
+            # Partial: most users sit at the default, which the dashboards exclude
+            models.Index(fields=['city'], condition=~models.Q(city='Unknown'), name='chat_profile_city_known_idx'),
+            models.Index(fields=['subscription_tier'], condition=~models.Q(subscription_tier='Free'), name='chat_profile_paid_idx'),
+        ]
+
     def __str__(self): return self.user.username
-    def get_tier_data(self):
-        tiers = [("LEGEND", 500000), ("CONQUEROR", 200000), ("DOMINATOR", 100000), ("MASTER", 50000), ("ACE", 25000), ("CROWN", 10000), ("DIAMOND", 5000), ("PLATINUM", 1000), ("GOLD", 100), ("BRONZE", 0)]
-        for name, threshold in tiers:
-            if self.xp >= threshold: return {"name": name, "full": name, "next_xp": 100 if name=="BRONZE" else "MAX", "progress": 100}
-        return {"name": "BRONZE", "full": "BRONZE", "next_xp": 100, "progress": self.xp}
-    def get_tier(self): return self.get_tier_data()['full']
+    def get_tier_data(self): return tiers.tier_data(self.xp)
+    def get_tier(self): return tiers.tier_name(self.xp)
 
 class Room(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -101,11 +113,85 @@ class Message(models.Model):
     audio = models.FileField(upload_to='chat_audio/', null=True, blank=True)
     likes = models.ManyToManyField(User, related_name='liked_messages', blank=True)
     dislikes = models.ManyToManyField(User, related_name='disliked_messages', blank=True)
+    like_count = models.PositiveIntegerField(default=0) # Maintained by chat.votes alongside the M2Ms
+    dislike_count = models.PositiveIntegerField(default=0)
     reply_to = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='replies')
     is_deleted = models.BooleanField(default=False)
     hidden_by = models.ManyToManyField(User, related_name='hidden_messages', blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination for room history walks (room, timestamp, id) backwards
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+            # Site-wide time ranges (rollup high-water mark, retention)
+            models.Index(fields=['timestamp'], name='chat_msg_ts_idx'),
+        ]
+
     def __str__(self): return f"{self.user.username}: {self.content[:20]}"
 
+# "Clear history for me" watermark: messages at or before cleared_at are hidden for this user in this room
+class HistoryClear(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='history_clears')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='history_clears')
+    cleared_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'room')
+
+    def __str__(self): return f"{self.user.username} cleared {self.room.name} @ {self.cleared_at}"
+
+# Chunked media uploads (images / voice notes) spooled to disk before they reach a Message
+class MediaUpload(models.Model):
+    KIND_CHOICES = [('image', 'Image'), ('audio', 'Voice Note')]
+    token = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='media_uploads')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    extension = models.CharField(max_length=10)
+    size = models.PositiveIntegerField() # Declared total size in bytes
+    received = models.PositiveIntegerField(default=0)
+    stored_name = models.CharField(max_length=255, blank=True) # Set once the last chunk lands
+    created_at = models.DateTimeField(auto_now_add=True)
+    def __str__(self): return f"{self.user.username} - {self.kind} ({self.received}/{self.size})"
+
+# Transactional outbox: side effects of a write, stored in the same transaction and run by `manage.py run_outbox`
+class OutboxJob(models.Model):
+    STATUS_CHOICES = [('pending', 'Pending'), ('done', 'Done'), ('dead', 'Dead')]
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=120, unique=True) # Enqueueing the same key twice is a no-op
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=timezone.now) # Pushed back on each failed attempt
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['run_after'], condition=models.Q(status='pending'), name='chat_outbox_pending_idx')]
+
+    def __str__(self): return f"{self.kind} [{self.status}] {self.idempotency_key}"
+
+# Write-behind counter batches already applied to Profile (see counters.flush): a retried batch is skipped
+class CounterFlush(models.Model):
+    batch_id = models.CharField(max_length=32, unique=True)
+    users = models.PositiveIntegerField(default=0)
+    applied_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self): return f"{self.batch_id} ({self.users} users)"
+
+# XP / aura gained per user per day (losses not counted): what the windowed leaderboards are rebuilt from
+class DailyGain(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_gains')
+    day = models.DateField()
+    xp = models.PositiveIntegerField(default=0)
+    aura = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'day')
+        indexes = [models.Index(fields=['day'], name='chat_dailygain_day_idx')]
+
+    def __str__(self): return f"{self.user_id} on {self.day}: +{self.xp} XP, +{self.aura} aura"
+
 class MusicSuggestion(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     song_name = models.CharField(max_length=100); artist_name = models.CharField(max_length=100); link = models.URLField(max_length=500); timestamp = models.DateTimeField(auto_now_add=True)
@@ -124,17 +210,39 @@ class SiteConfig(models.Model):
     streak_recover_cost = models.IntegerField(default=3) # Ads needed
     streak_bonus_7_day = models.IntegerField(default=500)  # Configurable Reward
     streak_bonus_30_day = models.IntegerField(default=2000)
-    def save(self, *args, **kwargs): self.pk = 1; super(SiteConfig, self).save(*args, **kwargs)
+    def save(self, *args, **kwargs):
+        self.pk = 1; super(SiteConfig, self).save(*args, **kwargs)
+        invalidate_site_config()
     @classmethod
     def get_solo(cls):
-        obj, created = cls.objects.get_or_create(pk=1)
-        if created: obj.subscription_packages = {"Pilot": {"price": 100, "xp_mult": 2}, "Ace": {"price": 250, "xp_mult": 3}, "Commander": {"price": 500, "xp_mult": 4}}; obj.save()
+        """ Cached copy (see solo_cache.py): no query in steady state, safe to mutate and save """
+        return _site_config_cache.get()
+    @classmethod
+    def load_solo(cls):
+        obj = cls.objects.select_related('default_track').filter(pk=1).first()
+        if obj is None:
+            obj, created = cls.objects.get_or_create(pk=1)
+            if created: obj.subscription_packages = {"Pilot": {"price": 100, "xp_mult": 2}, "Ace": {"price": 250, "xp_mult": 3}, "Commander": {"price": 500, "xp_mult": 4}}; obj.save()
         return obj
 
+_site_config_cache = SoloCache('siteconfig', SiteConfig.load_solo)
+
+def invalidate_site_config():
+    # Local copy now, other workers once the change is committed
+    _site_config_cache.drop_local()
+    transaction.on_commit(_site_config_cache.invalidate)
+
+# The cached config carries its default_track, so track edits must refresh it too
+@receiver([post_save, post_delete], sender=MusicTrack)
+def refresh_config_track(sender, instance, **kwargs): invalidate_site_config()
+@receiver(post_delete, sender=SiteConfig)
+def refresh_deleted_config(sender, instance, **kwargs): invalidate_site_config()
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created: Profile.objects.create(user=instance, display_name=instance.username)
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    try: instance.profile.save()
+    # Only make sure the profile exists: a full re-save here would overwrite XP/aura flushed by chat.counters
+    try: instance.profile
     except Profile.DoesNotExist: Profile.objects.create(user=instance, display_name=instance.username)
\ No newline at end of file
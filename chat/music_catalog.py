@@ -0,0 +1,35 @@
+# Music library as one cached, versioned JSON document served by /music/catalog/
+import hashlib
+import json
+from django.core.cache import cache
+from .models import MusicTrack
+
+META_KEY = "music:catalog:meta" # {'version', 'counts'}: read on every page render
+BODY_KEY = "music:catalog:body" # Serialized document: read only by the endpoint
+TIMEOUT = 24 * 3600 # Safety net; changes invalidate explicitly
+GENRES = [key for key, _ in MusicTrack.CATEGORY_CHOICES]
+
+def track_data(t):
+    return {'id': t.id, 'title': t.title, 'artist': t.artist, 'url': t.audio_url, 'cover': t.cover_image.url if t.cover_image else ''}
+
+def build():
+    """ Rebuilds and caches the document. Returns (meta, body) """
+    library = {genre: [] for genre in GENRES}
+    for t in MusicTrack.objects.all().order_by('-timestamp'):
+        if t.category in library: library[t.category].append(track_data(t))
+    body = json.dumps({'library': library}, separators=(',', ':'))
+    meta = {'version': hashlib.sha1(body.encode()).hexdigest()[:16], 'counts': {g: len(tracks) for g, tracks in library.items()}}
+    cache.set_many({META_KEY: meta, BODY_KEY: body}, TIMEOUT)
+    return meta, body
+
+def meta():
+    return cache.get(META_KEY) or build()[0]
+
+def body():
+    """ (version, serialized document) """
+    cached = cache.get_many([META_KEY, BODY_KEY])
+    if len(cached) == 2: return cached[META_KEY]['version'], cached[BODY_KEY]
+    m, b = build()
+    return m['version'], b
+
+def invalidate(): cache.delete_many([META_KEY, BODY_KEY])
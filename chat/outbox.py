@@ -0,0 +1,102 @@
+# Transactional outbox: jobs stored with the write, run at least once by `manage.py run_outbox`
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Min
+from django.utils import timezone
+from .models import OutboxJob
+
+MAX_ATTEMPTS = 5
+BASE_BACKOFF = 2 # seconds, doubled per attempt
+LEASE = getattr(settings, 'OUTBOX_LEASE', 300) # seconds a claimed job is left to its worker
+
+HANDLERS = {}
+
+def handler(kind):
+    """ Registers fn(payload) as the processor for jobs of `kind` """
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enabled(): return getattr(settings, 'OUTBOX_ENABLED', True)
+
+def once(key, timeout=86400):
+    """ True the first time `key` is seen: guards a handler's external effect against a rerun """
+    return cache.add(f"outbox:once:{key}", 1, timeout)
+
+def release(key):
+    """ Undoes once() after the effect failed, so the retry performs it """
+    cache.delete(f"outbox:once:{key}")
+
+# --- PRODUCER ---
+def enqueue(jobs):
+    """
+    jobs: [(kind, payload, idempotency_key)]. One INSERT; keys already queued are skipped.
+    With OUTBOX_ENABLED off the handlers run inline instead (dev without a worker).
+    """
+    if not enabled():
+        for kind, payload, _ in jobs: HANDLERS[kind](payload)
+        return
+    OutboxJob.objects.bulk_create(
+        [OutboxJob(kind=kind, payload=payload, idempotency_key=key) for kind, payload, key in jobs],
+        ignore_conflicts=True,
+    )
+
+# --- WORKER ---
+class LeaseLost(Exception):
+    """ The job was claimed again while it ran; its writes are rolled back """
+
+def _claim(batch_size):
+    """ Leases up to `batch_size` due jobs to this worker; the row locks last only this transaction """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            OutboxJob.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', run_after__lte=now).order_by('id')[:batch_size]
+        )
+        lease = now + timedelta(seconds=LEASE)
+        OutboxJob.objects.filter(id__in=[job.id for job in jobs]).update(run_after=lease, attempts=F('attempts') + 1)
+    for job in jobs: job.run_after, job.attempts = lease, job.attempts + 1
+    return jobs
+
+def _run(job):
+    """ Runs one claimed job in its own transaction. Returns True when done """
+    mine = OutboxJob.objects.filter(id=job.id, status='pending', run_after=job.run_after) # Still our lease
+    try:
+        with transaction.atomic():
+            HANDLERS[job.kind](job.payload)
+            if not mine.update(status='done', processed_at=timezone.now()): # Lease ran out, another worker reran it
+                raise LeaseLost(job.id)
+        return True
+    except Exception:
+        mine.update(
+            last_error=traceback.format_exc()[-2000:],
+            status='dead' if job.attempts >= MAX_ATTEMPTS else 'pending',
+            run_after=timezone.now() + timedelta(seconds=BASE_BACKOFF * 2 ** (job.attempts - 1)),
+        )
+        return False
+
+def process_batch(batch_size=100):
+    """ Runs up to `batch_size` due jobs. Returns (done, failed) """
+    done = failed = 0
+    for job in _claim(batch_size):
+        if _run(job): done += 1
+        else: failed += 1
+    return done, failed
+
+# --- METRICS ---
+def queue_stats():
+    """ {'pending': n, 'dead': n, 'lag_seconds': age of the oldest pending job} """
+    pending = OutboxJob.objects.filter(status='pending')
+    oldest = pending.aggregate(oldest=Min('created_at'))['oldest']
+    return {
+        'pending': pending.count(),
+        'dead': OutboxJob.objects.filter(status='dead').count(),
+        'lag_seconds': (timezone.now() - oldest).total_seconds() if oldest else 0.0,
+    }
+
+def purge_done(older_than):
+    return OutboxJob.objects.filter(status='done', processed_at__lt=older_than).delete()[0]
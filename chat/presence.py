@@ -0,0 +1,139 @@
+# Last-seen touches batched in Redis (flushed by flush_counters) and live per-socket online sets
+from datetime import datetime, timezone as dt_timezone
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField, Case, DateTimeField, F, Value, When
+from django.utils import timezone
+from redis import RedisError, ResponseError
+from .models import Profile
+from .redis_client import get_redis
+
+SEEN_KEY = "presence:seen"
+PROCESSING_KEY = "presence:processing"
+ONLINE_KEY = "presence:online" # user -> expiry, sockets and page views
+HEARTBEAT = getattr(settings, 'PRESENCE_HEARTBEAT', 20) # seconds between socket heartbeats
+SOCKET_TTL = 3 * HEARTBEAT # A socket missing three heartbeats is gone
+PAGE_TTL = getattr(settings, 'PRESENCE_PAGE_TTL', 300) # A page view keeps a user "online" this long
+
+def _conns_key(user_id): return f"presence:conns:{user_id}"
+def _room_key(room_name): return f"presence:room:{room_name}"
+
+# --- WRITES ---
+def touch(user_id, is_mobile=None):
+    """ is_mobile=None (sockets) leaves the stored device flag alone """
+    now = timezone.now()
+    device = '-' if is_mobile is None else int(is_mobile)
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(SEEN_KEY, user_id, f"{now.timestamp():.0f}:{device}")
+        if is_mobile is not None: pipe.zadd(ONLINE_KEY, {user_id: time.time() + PAGE_TTL}, gt=True) # Page views count as online
+        pipe.execute()
+    except RedisError as e:
+        print(f"Presence store unavailable, writing through: {e}")
+        fields = {'last_activity': now}
+        if is_mobile is not None: fields['is_mobile'] = is_mobile
+        Profile.objects.filter(user_id=user_id).update(**fields)
+
+# --- FLUSH ---
+def _parse(raw):
+    """ {b'12': b'1700000000:1'} -> {12: (datetime, True|False|None)} """
+    seen = {}
+    for user_id, value in raw.items():
+        ts, device = value.decode().split(':')
+        seen[int(user_id)] = (datetime.fromtimestamp(int(ts), tz=dt_timezone.utc), None if device == '-' else device == '1')
+    return seen
+
+def _apply_batch(seen):
+    updates = {'last_activity': Case(
+        *[When(user_id=uid, then=Value(ts)) for uid, (ts, _) in seen.items()],
+        default=F('last_activity'), output_field=DateTimeField(),
+    )}
+    devices = [When(user_id=uid, then=Value(mobile)) for uid, (_, mobile) in seen.items() if mobile is not None]
+    if devices:
+        updates['is_mobile'] = Case(*devices, default=F('is_mobile'), output_field=BooleanField())
+    Profile.objects.filter(user_id__in=list(seen)).update(**updates)
+
+def flush(batch_size=500):
+    """ Writes all pending last-seen stamps into Profile. Returns the number of users touched """
+    r = get_redis()
+    if not r.exists(PROCESSING_KEY): # A previous flush that died before committing is retried first
+        try: r.rename(SEEN_KEY, PROCESSING_KEY)
+        except ResponseError: return 0 # Nobody seen since the last flush
+    seen = _parse(r.hgetall(PROCESSING_KEY))
+    items = list(seen.items())
+    with transaction.atomic():
+        for i in range(0, len(items), batch_size):
+            _apply_batch(dict(items[i:i + batch_size]))
+    r.delete(PROCESSING_KEY)
+    return len(seen)
+
+# --- LIVE ROOMS ---
+# Join / heartbeat: KEYS = conns, room, online; ARGV = "room|channel", user id, expires, now, conns TTL
+# Returns {1 if the user just appeared in the room, room count}
+_JOIN_LUA = """
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[4])
+local joined = redis.call('ZSCORE', KEYS[2], ARGV[2]) == false and 1 or 0
+redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[2])
+redis.call('ZADD', KEYS[3], 'GT', ARGV[3], ARGV[2])
+return {joined, redis.call('ZCARD', KEYS[2])}
+"""
+
+# Leave: KEYS = conns, room; ARGV = "room|channel", user id, now, "room|"
+# The user only leaves the room when none of their other live sockets are in it
+_LEAVE_LUA = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local in_room = false
+for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    if string.sub(member, 1, #ARGV[4]) == ARGV[4] then in_room = true end
+end
+local left = 0
+if not in_room then left = redis.call('ZREM', KEYS[2], ARGV[2]) end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3])
+return {left, redis.call('ZCARD', KEYS[2])}
+"""
+_scripts = {}
+
+def _script(name, source):
+    if name not in _scripts: _scripts[name] = get_redis().register_script(source)
+    return _scripts[name]
+
+def join(room_name, user_id, channel_name):
+    """ Socket opened or heartbeat. Returns (joined, room_count) """
+    now = time.time()
+    joined, count = _script('join', _JOIN_LUA)(
+        keys=[_conns_key(user_id), _room_key(room_name), ONLINE_KEY],
+        args=[f"{room_name}|{channel_name}", user_id, now + SOCKET_TTL, now, SOCKET_TTL],
+    )
+    return bool(joined), count
+
+heartbeat = join
+
+def leave(room_name, user_id, channel_name):
+    """ Socket closed. Returns (left, room_count) """
+    left, count = _script('leave', _LEAVE_LUA)(
+        keys=[_conns_key(user_id), _room_key(room_name)],
+        args=[f"{room_name}|{channel_name}", user_id, time.time(), f"{room_name}|"],
+    )
+    return bool(left), count
+
+def _count(key):
+    pipe = get_redis().pipeline()
+    pipe.zremrangebyscore(key, '-inf', time.time())
+    pipe.zcard(key)
+    return pipe.execute()[1]
+
+def room_count(room_name): return _count(_room_key(room_name))
+def online_count(): return _count(ONLINE_KEY)
+
+def room_counts(room_names):
+    """ {room: online users} in one round-trip """
+    now = time.time()
+    pipe = get_redis().pipeline()
+    for name in room_names:
+        pipe.zremrangebyscore(_room_key(name), '-inf', now); pipe.zcard(_room_key(name))
+    results = pipe.execute()
+    return {name: results[i * 2 + 1] for i, name in enumerate(room_names)}
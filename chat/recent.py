@@ -0,0 +1,69 @@
+# Per-room ring buffer of recent serialized messages in Redis, trusted only once filled from the database
+import json
+from django.conf import settings
+from .redis_client import get_redis
+
+RECENT_SIZE = getattr(settings, 'CHAT_RECENT_BUFFER_SIZE', 50)
+RECENT_TTL = getattr(settings, 'CHAT_RECENT_BUFFER_TTL', 86400) # seconds after the room's last message or fill
+
+def _key(room_name): return f"chat:recent:{room_name}"
+def _warm_key(room_name): return f"chat:recent:{room_name}:warm"
+
+# Merge fields into a buffered entry atomically; no-op if it already scrolled out
+_MERGE_LUA = """
+local found = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])
+if #found == 0 then return 0 end
+local entry = cjson.decode(found[1])
+for k, v in pairs(cjson.decode(ARGV[2])) do entry[k] = v end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[1], cjson.encode(entry))
+return 1
+"""
+_merge_script = None
+
+# KEYS = buffer, warm flag; ARGV = size, ttl, then id / entry pairs. Returns 0 if already warm
+_FILL_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return 0 end
+for i = 3, #ARGV, 2 do
+    if #redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[i], ARGV[i]) == 0 then redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1]) end
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[1]) + 1))
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+_fill_script = None
+
+def push(room_name, msg_data):
+    pipe = get_redis().pipeline()
+    pipe.zadd(_key(room_name), {json.dumps(msg_data): msg_data['id']})
+    pipe.zremrangebyrank(_key(room_name), 0, -(RECENT_SIZE + 1))
+    pipe.expire(_key(room_name), RECENT_TTL); pipe.expire(_warm_key(room_name), RECENT_TTL) # A still-cold room stays cold
+    pipe.execute()
+
+def update(room_name, msg_id, **changes):
+    global _merge_script
+    if _merge_script is None: _merge_script = get_redis().register_script(_MERGE_LUA)
+    _merge_script(keys=[_key(room_name)], args=[msg_id, json.dumps(changes)])
+
+def read(room_name):
+    """ Buffered messages oldest first, or None on a cold buffer """
+    pipe = get_redis().pipeline()
+    pipe.exists(_warm_key(room_name))
+    pipe.zrange(_key(room_name), 0, -1)
+    warm, entries = pipe.execute()
+    if not warm: return None
+    return [json.loads(e) for e in entries]
+
+def fill(room_name, messages):
+    """ Warm the buffer from the database, keeping anything pushed meanwhile. False if it was warm already """
+    global _fill_script
+    if _fill_script is None: _fill_script = get_redis().register_script(_FILL_LUA)
+    args = [RECENT_SIZE, RECENT_TTL]
+    for m in messages: args += [m['id'], json.dumps(m)]
+    return bool(_fill_script(keys=[_key(room_name), _warm_key(room_name)], args=args))
+
+def forget_all():
+    r = get_redis()
+    keys = list(r.scan_iter("chat:recent:*"))
+    if keys: r.delete(*keys)
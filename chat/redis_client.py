@@ -0,0 +1,11 @@
+import redis
+from django.conf import settings
+
+_client = None
+
+def get_redis():
+    """ Shared Redis connection (same server as the channel layer), created lazily per process """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(getattr(settings, 'REDIS_URL', 'redis://127.0.0.1:6379/0'))
+    return _client
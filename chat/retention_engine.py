@@ -1,7 +1,11 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery
 from django.utils import timezone
 from .models import UserStreak, DailyActivity, Profile
 from decimal import Decimal
 from .models import SiteConfig
+from . import counters
 
 # --- MULTIPLIER LOGIC ---
 def get_streak_multiplier(days):
@@ -25,66 +29,90 @@ def get_streak_multiplier(days):
     return 1.0
 
 # --- CORE UTILS ---
-def get_or_create_daily(user):
-    """ Get today's tracking row """
-    today = timezone.now().date()
+def get_or_create_daily(user, day=None):
+    """ Get today's (or `day`'s) tracking row """
+    today = day or timezone.now().date()
     daily, created = DailyActivity.objects.get_or_create(user=user, date=today)
     return daily
 
-def update_streak(user):
-    """ Call this when user sends a message (The trigger for keeping streak) """
-    streak, _ = UserStreak.objects.get_or_create(user=user)
-    today = timezone.now().date()
-    
-    if streak.last_action_date == today:
-        return # Already counted today
-    
-    # Check logic
-    if streak.last_action_date:
-        delta = (today - streak.last_action_date).days
-        if delta == 1:
-            # Consecutive day - Increment
-            streak.current_streak += 1
-            
-            # 🔥 NEW: CHECK FOR MILESTONE REWARDS
-            config = SiteConfig.get_solo()
-            
-            if streak.current_streak == 7:
-                grant_xp(user, config.streak_bonus_7_day, source="🔥 7-Day Streak Bonus")
-            
-            elif streak.current_streak == 30:
-                grant_xp(user, config.streak_bonus_30_day, source="🔥🔥 30-Day Legend Bonus")
-                # Optional: Add Aura too if you want
-                user.profile.aura += 100 
-                user.profile.save()
+def claim_daily_flag(user, flag, day=None, **conditions):
+    """
+    Flips one of today's boolean flags (login_claimed, booster_claimed...) from False to True.
+    A single conditional UPDATE, so of two racing requests exactly one wins.
+    """
+    daily = get_or_create_daily(user, day)
+    return DailyActivity.objects.filter(pk=daily.pk, **{flag: False}, **conditions).update(**{flag: True}) == 1
+
+def claim_daily_quota(user, counter, limit):
+    """ Increments one of today's counters only while it is below `limit`. True if the slot was taken """
+    daily = get_or_create_daily(user)
+    return DailyActivity.objects.filter(pk=daily.pk, **{f"{counter}__lt": limit}).update(**{counter: F(counter) + 1}) == 1
 
-        elif delta > 1:
-            # Streak Broken
-            streak.current_streak = 1 
-    else:
-        streak.current_streak = 1 # First time ever
+def update_streak(user, day=None):
+    """ Call this when user sends a message (The trigger for keeping streak) """
+    today = day or timezone.now().date()
+    with transaction.atomic():
+        UserStreak.objects.get_or_create(user=user)
+        # Row lock: two tabs sending at midnight must not both extend the streak
+        streak = UserStreak.objects.select_for_update().get(user=user)
+        
+        if streak.last_action_date and streak.last_action_date >= today:
+            return # Already counted today (or a late outbox job for an older day)
         
-    streak.last_action_date = today
-    if streak.current_streak > streak.highest_streak:
-        streak.highest_streak = streak.current_streak
-    streak.save()
+        # Check logic
+        if streak.last_action_date:
+            delta = (today - streak.last_action_date).days
+            if delta == 1:
+                # Consecutive day - Increment
+                streak.current_streak += 1
+                
+                # 🔥 NEW: CHECK FOR MILESTONE REWARDS
+                config = SiteConfig.get_solo()
+                
+                if streak.current_streak == 7:
+                    grant_reward(user, xp=config.streak_bonus_7_day, source="🔥 7-Day Streak Bonus")
+                
+                elif streak.current_streak == 30:
+                    # Optional: Add Aura too if you want
+                    grant_reward(user, xp=config.streak_bonus_30_day, aura=100, source="🔥🔥 30-Day Legend Bonus")
+
+            elif delta > 1:
+                # Streak Broken
+                streak.current_streak = 1 
+        else:
+            streak.current_streak = 1 # First time ever
+            
+        streak.last_action_date = today
+        if streak.current_streak > streak.highest_streak:
+            streak.highest_streak = streak.current_streak
+        streak.save()
 
 # --- REWARD FUNCTIONS ---
+def reward_multiplier(user):
+    """ Streak multiplier plus daily booster, read in one query """
+    today = timezone.now().date()
+    streak_days, boosted = User.objects.filter(pk=user.pk).annotate(
+        streak_days=Subquery(UserStreak.objects.filter(user=OuterRef('pk')).values('current_streak')[:1]),
+        boosted=Exists(DailyActivity.objects.filter(user=OuterRef('pk'), date=today, booster_claimed=True)),
+    ).values_list('streak_days', 'boosted').first() or (0, False)
+
+    mult = get_streak_multiplier(streak_days or 0)
+    if boosted:
+        mult += 0.5 # Add 1.5x effect
+    return mult
+
+def grant_reward(user, xp=0, aura=0, source="Action", boosted=True):
+    """
+    The one way rewards are paid out (messages, login bonus, streak milestones, ads).
+    One SELECT for the multiplier, one atomic increment for the payout: no
+    read-modify-write of Profile, so concurrent grants never lose updates.
+    Returns the XP actually granted.
+    """
+    with transaction.atomic():
+        final_xp = int(xp * reward_multiplier(user)) if (xp > 0 and boosted) else xp
+        counters.add(user.id, xp=final_xp, aura=aura)
+    return final_xp
+
 def grant_xp(user, amount, source="Action"):
     """ Safe XP Granting with Multiplier """
-    profile = user.profile
-    streak, _ = UserStreak.objects.get_or_create(user=user)
-    
-    # Apply Multiplier
-    mult = get_streak_multiplier(streak.current_streak)
-    
-    # Check for Daily Booster Ad
-    daily = get_or_create_daily(user)
-    if daily.booster_claimed:
-        mult += 0.5 # Add 1.5x effect
-        
-    final_xp = int(amount * mult)
-    
-    profile.xp += final_xp
-    profile.save()
-    return final_xp
\ No newline at end of file
+    return grant_reward(user, xp=amount, source=source)
@@ -1,70 +1,90 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
 from django.contrib.auth import get_user_model
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-import re
-from .models import Message 
+from datetime import date
+from .models import Message, Profile, MusicTrack 
+from . import mentions, outbox, leaderboard, counters, music_catalog, geoip
 
 # --- NEW IMPORTS (RETENTION ENGINE) ---
-from .retention_engine import get_or_create_daily, update_streak, grant_xp
+from django.db.models import F
+from .models import DailyActivity, SiteConfig
+from .retention_engine import get_or_create_daily, update_streak, grant_reward, claim_daily_flag
 
 User = get_user_model()
 
+# Both features run off the send path: the post_save hook only queues outbox jobs
+# (same transaction as the message) and `manage.py run_outbox` executes them.
+@receiver(post_save, sender=Message)
+def queue_message_side_effects(sender, instance, created, **kwargs):
+    if not created: return
+    jobs = [('message_activity', {'user_id': instance.user_id, 'day': instance.timestamp.date().isoformat()}, f"activity:{instance.id}")]
+    if mentions.extract(instance.content):
+        jobs.append(('message_mentions', {'message_id': instance.id}, f"mentions:{instance.id}"))
+    outbox.enqueue(jobs)
+
 # ==========================================
-# 1. OLD FEATURE: MENTIONS NOTIFICATION (UNTOUCHED)
+# 1. OLD FEATURE: MENTIONS NOTIFICATION
 # ==========================================
-@receiver(post_save, sender=Message)
-def check_mentions(sender, instance, created, **kwargs):
-    if created:
-        content = instance.content
-        # Regex to find @username
-        mentions = re.findall(r'@(\w+)', content)
-        
-        if mentions:
-            channel_layer = get_channel_layer()
-            sender_name = instance.user.username
-            
-            for username in mentions:
-                try:
-                    target_user = User.objects.get(username=username)
-                    # We assume users listen to a group named 'user_{id}'
-                    # If your auth system uses a different group name, adjust here.
-                    group_name = f"user_{target_user.id}"
-                    
-                    async_to_sync(channel_layer.group_send)(
-                        group_name,
-                        {
-                            "type": "send_notification",
-                            "message": f"@{sender_name} mentioned you!",
-                            "sender": sender_name
-                        }
-                    )
-                except User.DoesNotExist:
-                    continue
+@outbox.handler('message_mentions')
+def check_mentions(payload):
+    instance = Message.objects.select_related('user').filter(id=payload['message_id']).first()
+    if not instance: return # Deleted before the worker got to it
+    # Regex to find @username (deduplicated), resolved in one indexed query
+    usernames = mentions.extract(instance.content)
+    
+    if usernames:
+        # We assume users listen to a group named 'user_{id}'
+        target_ids = sorted(set(mentions.resolve(usernames).values()))
+        key = f"mentions:{instance.id}"
+        if outbox.once(key): # A rerun of this job must not push twice
+            try: mentions.notify(target_ids, instance.user.username)
+            except Exception:
+                outbox.release(key) # Nothing was pushed: leave it to the retry
+                raise
 
 # ==========================================
 # 2. NEW FEATURE: DAILY XP & STREAKS (APPENDED)
 # ==========================================
-@receiver(post_save, sender=Message)
-def track_user_activity(sender, instance, created, **kwargs):
+@outbox.handler('message_activity')
+def track_user_activity(payload):
     """
-    Tracks streaks and daily message limits safely via Signals.
+    Tracks streaks and daily message limits for the day the message was sent.
     Works for both HTTP and WebSocket messages.
     """
-    if created and instance.user:
-        user = instance.user
-        
-        # A. Streak Update (Logic: Logged in + Sent Message = Streak Kept)
-        update_streak(user)
-        
-        # B. Daily Message Count & Bonus Logic
-        daily = get_or_create_daily(user)
-        daily.messages_sent_today += 1
-        
-        # Check Bonus (Target: 5 Messages)
-        if daily.messages_sent_today == 5 and not daily.msg_bonus_claimed:
-            grant_xp(user, 19, source="Daily Msg Bonus")
-            daily.msg_bonus_claimed = True
-            
-        daily.save()
\ No newline at end of file
+    user = User.objects.filter(id=payload['user_id']).first()
+    if not user: return
+    day = date.fromisoformat(payload['day'])
+    
+    # A. Streak Update (Logic: Logged in + Sent Message = Streak Kept)
+    update_streak(user, day=day)
+    
+    # B. Daily Message Count & Bonus Logic (atomic increment, no read-modify-write)
+    daily = get_or_create_daily(user, day=day)
+    DailyActivity.objects.filter(pk=daily.pk).update(messages_sent_today=F('messages_sent_today') + 1)
+    
+    # Check Bonus (Target: 5 Messages) - the conditional claim lets exactly one message win it
+    if claim_daily_flag(user, 'msg_bonus_claimed', day=day, messages_sent_today__gte=5):
+        grant_reward(user, xp=SiteConfig.get_solo().daily_msg_bonus_xp, source="Daily Msg Bonus")
+
+# ==========================================
+# 3. CITY LOOKUP (queued by ActiveUserMiddleware)
+# ==========================================
+@outbox.handler('resolve_city')
+def resolve_city(payload):
+    city = geoip.city_for(payload['ip'])
+    if city: Profile.objects.filter(user_id=payload['user_id'], city__in=['Unknown', '']).update(city=city)
+
+# Ranked index moves with the reward, flushed or not
+@receiver(counters.rewarded)
+def bump_leaderboard(sender, user_id, xp, aura, **kwargs):
+    leaderboard.bump(user_id, xp, aura)
+
+@receiver(post_delete, sender=Profile)
+def drop_from_leaderboard(sender, instance, **kwargs):
+    leaderboard.forget(instance.user_id)
+
+# Any track change (manage_music, admin) means a new catalog document
+@receiver([post_save, post_delete], sender=MusicTrack)
+def refresh_music_catalog(sender, instance, **kwargs):
+    music_catalog.invalidate(); transaction.on_commit(music_catalog.invalidate) # Again after commit, in case a reader rebuilt from the old rows
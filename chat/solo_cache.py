@@ -0,0 +1,57 @@
+# Per-worker cache for singleton rows (SiteConfig), reloaded when the shared version token changes
+import copy
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+
+TTL = getattr(settings, 'SITE_CONFIG_CACHE_TTL', 300)
+CHECK = getattr(settings, 'SITE_CONFIG_VERSION_CHECK', 1.0)
+
+class SoloCache:
+    def __init__(self, name, loader):
+        self.version_key = f"solo:{name}:version"
+        self.loader = loader
+        self._entry = None # (obj, version, loaded_at, check_at)
+        self._lock = threading.RLock() # The loader may save the row, which invalidates
+
+    def _shared_version(self):
+        try:
+            version = cache.get(self.version_key)
+            if version is None:
+                cache.add(self.version_key, uuid.uuid4().hex, None)
+                version = cache.get(self.version_key)
+            return version
+        except Exception as e: # Cache backend down: fall back to TTL-only expiry
+            print(f"Solo cache version check failed: {e}")
+            return None
+
+    def get(self):
+        if TTL <= 0: return self.loader()
+        now = time.monotonic()
+        entry = self._entry
+        if entry is None or now >= entry[3]:
+            with self._lock:
+                entry = self._entry
+                if entry is None or now >= entry[3]: entry = self._refresh(entry, now)
+        return copy.deepcopy(entry[0])
+
+    def _refresh(self, entry, now):
+        version = self._shared_version()
+        if entry and now - entry[2] < TTL and (version is None or version == entry[1]):
+            entry = (entry[0], entry[1], entry[2], now + CHECK)
+        else:
+            entry = (self.loader(), version, now, now + CHECK)
+        self._entry = entry
+        return entry
+
+    def drop_local(self):
+        """ Drops this worker's copy only; the next get() reloads it """
+        with self._lock: self._entry = None
+
+    def invalidate(self):
+        """ Drops this worker's copy and tells the others to reload """
+        self.drop_local()
+        try: cache.set(self.version_key, uuid.uuid4().hex, None)
+        except Exception as e: print(f"Solo cache invalidation failed: {e}")
@@ -0,0 +1,88 @@
+// AirSpace Service Worker (build {{ build_hash }}) - rendered by views.service_worker
+const BUILD = '{{ build_hash }}';
+const STATIC_CACHE = `airspace-static-${BUILD}`; // Precached app shell assets, replaced every deploy
+const MEDIA_CACHE = 'airspace-media-v2';           // Uploaded covers: unique names, survive deploys (v1 also held badges)
+const DATA_CACHE = 'airspace-data';                // Music catalog JSON (stale-while-revalidate)
+const KEEP = [STATIC_CACHE, MEDIA_CACHE, DATA_CACHE];
+const PRECACHE = {{ precache|safe }};
+const MEDIA_LIMIT = 300;
+
+// Chat pages, sockets, votes, uploads, history and anything per-user always hit the network
+const NETWORK_ONLY = [/^\/ws\//, /^\/chat\//, /^\/vote\//, /^\/upload\//, /^\/music\/favorites\//, /^\/admin\//, /^\/metrics\//];
+// Badges keep their names across edits, so they stay in the per-build STATIC_CACHE
+const IMMUTABLE_MEDIA = [/^\/media\/music_covers\//];
+
+self.addEventListener('install', (e) => {
+  // cache: 'reload' skips the HTTP cache so a new build never precaches an old file
+  e.waitUntil(
+    caches.open(STATIC_CACHE)
+      .then(cache => Promise.all(PRECACHE.map(url => cache.add(new Request(url, { cache: 'reload' })).catch(err => console.log('[SW] precache miss', url, err)))))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener('activate', (e) => {
+  e.waitUntil(
+    caches.keys()
+      .then(keys => Promise.all(keys.filter(k => k.startsWith('airspace-') && !KEEP.includes(k)).map(k => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
+});
+
+self.addEventListener('fetch', (e) => {
+  const req = e.request;
+  if (req.method !== 'GET') return;
+  const url = new URL(req.url);
+  if (url.origin !== self.location.origin) return; // CDN scripts, external audio: browser default
+  const path = url.pathname;
+
+  if (NETWORK_ONLY.some(r => r.test(path))) return;
+  if (IMMUTABLE_MEDIA.some(r => r.test(path))) { e.respondWith(cacheFirst(req, MEDIA_CACHE, true)); return; }
+  if (path.startsWith('/static/')) { e.respondWith(cacheFirst(req, STATIC_CACHE, false)); return; }
+  if (path === '/music/catalog/') { e.respondWith(staleWhileRevalidate(req, DATA_CACHE)); return; }
+  if (req.mode === 'navigate') { e.respondWith(fetch(req).catch(offlinePage)); return; }
+});
+
+async function cacheFirst(req, cacheName, trim) {
+  const cache = await caches.open(cacheName);
+  const hit = await cache.match(req);
+  if (hit) return hit;
+  const res = await fetch(req);
+  if (res.ok) {
+    await cache.put(req, res.clone());
+    if (trim) trimCache(cache, MEDIA_LIMIT);
+  }
+  return res;
+}
+
+async function staleWhileRevalidate(req, cacheName) {
+  const cache = await caches.open(cacheName);
+  const exact = await cache.match(req);
+  if (exact) return exact; // ?v=<version> documents never change
+  const hit = await cache.match(req, { ignoreSearch: true }); // An older version beats a blank player
+  const update = fetch(req).then(async res => {
+    if (res.ok) {
+      // One catalog entry only: drop older ?v= versions
+      const old = await cache.keys(req, { ignoreSearch: true });
+      await Promise.all(old.map(k => cache.delete(k)));
+      await cache.put(req, res.clone());
+    }
+    return res;
+  });
+  if (hit) { update.catch(() => {}); return hit; }
+  return update;
+}
+
+async function trimCache(cache, limit) {
+  const keys = await cache.keys();
+  if (keys.length > limit) await Promise.all(keys.slice(0, keys.length - limit).map(k => cache.delete(k)));
+}
+
+function offlinePage() {
+  return new Response(
+    '<!doctype html><meta name="viewport" content="width=device-width"><title>AirSpace | Offline</title>' +
+    '<body style="background:#0b0c10;color:#66fcf1;font-family:sans-serif;display:flex;align-items:center;justify-content:center;height:100vh;margin:0">' +
+    '<p>📡 Signal lost. Reconnect to rejoin the frequency.</p></body>',
+    { status: 503, headers: { 'Content-Type': 'text/html; charset=utf-8' } }
+  );
+}
@@ -1,3 +1,564 @@
-from django.test import TestCase
+import io
+import ipaddress
+import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Count, F, QuerySet
+from django.utils import timezone
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from redis import RedisError
+from . import counters, geoip, leaderboard, metrics, outbox, tiers
+from .uploads import UploadError, start_upload, append_chunk, claim_upload
+from .history import fetch_page, encode_cursor, decode_cursor
+from .models import Profile, DailyActivity, DailyGain, Message, Room, HistoryClear, OutboxJob, MediaUpload
+from .redis_client import get_redis
+from .signals import check_mentions
+from .retention_engine import grant_reward, claim_daily_flag, claim_daily_quota, reward_multiplier, get_or_create_daily
+
+
+def run_concurrently(target, workers):
+    """ Starts `workers` threads on a barrier so they hit the database together """
+    barrier = threading.Barrier(workers); errors = []
+    def worker():
+        try:
+            barrier.wait()
+            target()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return errors
+
+
+@override_settings(XP_WRITE_BEHIND=False)
+class RewardConcurrencyTests(TransactionTestCase):
+    """ Two tabs (or twenty) granting rewards at once must not lose updates """
+
+    def setUp(self):
+        self.user = User.objects.create_user('pilot', password='x')
+
+    def test_parallel_grants_are_not_lost(self):
+        errors = run_concurrently(lambda: grant_reward(self.user, xp=10, aura=3), workers=8)
+        self.assertEqual(errors, [])
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual((profile.xp, profile.aura), (80, 24))
+
+    def test_daily_flag_has_one_winner(self):
+        get_or_create_daily(self.user)
+        wins = []
+        errors = run_concurrently(lambda: wins.append(claim_daily_flag(self.user, 'login_claimed')), workers=6)
+        self.assertEqual(errors, [])
+        self.assertEqual(wins.count(True), 1)
+
+    def test_daily_quota_never_overshoots(self):
+        get_or_create_daily(self.user)
+        errors = run_concurrently(lambda: claim_daily_quota(self.user, 'xp_ads_watched', 5), workers=8)
+        self.assertEqual(errors, [])
+        self.assertEqual(DailyActivity.objects.get(user=self.user).xp_ads_watched, 5)
+
+
+@override_settings(XP_WRITE_BEHIND=False)
+class RewardTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pilot', password='x')
+
+    def test_multiplier_includes_booster(self):
+        self.assertEqual(reward_multiplier(self.user), 1.0)
+        claim_daily_flag(self.user, 'booster_claimed')
+        self.assertEqual(reward_multiplier(self.user), 1.5)
+        self.assertEqual(grant_reward(self.user, xp=10), 15)
+
+    def test_grant_is_two_statements(self):
+        with CaptureQueriesContext(connection) as ctx:
+            grant_reward(self.user, xp=10)
+        statements = [q['sql'] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(statements), 2) # multiplier SELECT + atomic UPDATE
+
+    def test_rolled_back_grant_pays_nothing(self):
+        xp = Profile.objects.get(user=self.user).xp
+        with mock.patch.object(counters.rewarded, 'send') as sent, self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                grant_reward(self.user, xp=10)
+                raise RuntimeError("rolled back")
+        self.assertEqual(Profile.objects.get(user=self.user).xp, xp)
+        sent.assert_not_called() # No leaderboard points either
+
+
+# Table scans that mean a hot query lost its index, per backend
+SEQ_SCAN = {
+    'postgresql': re.compile(r"Seq Scan on (\w+)"),
+    'sqlite': re.compile(r"SCAN (\w+)(?! USING)(?:\s|$)"),
+}
+HOT_TABLES = {'chat_message', 'chat_profile'}
+
+
+@skipUnless(connection.vendor in SEQ_SCAN, "EXPLAIN checks cover PostgreSQL and SQLite")
+class QueryPlanTests(TestCase):
+    """ Room history, leaderboard and dashboard queries must stay index-backed on the hot tables """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        users = User.objects.bulk_create([User(username=f"u{i}", password='!') for i in range(300)])
+        Profile.objects.bulk_create([Profile(
+            user=u, xp=i * 37 % 5000, aura=i * 11 % 900, last_activity=now - timedelta(hours=i),
+            city="Unknown" if i % 4 else f"City{i % 7}", subscription_tier="Free" if i % 10 else "Pilot",
+        ) for i, u in enumerate(users)])
+        cls.rooms = Room.objects.bulk_create([Room(name=f"room{i}") for i in range(5)])
+        Message.objects.bulk_create([Message(user=users[i % 300], room=cls.rooms[i % 5], content=f"m{i}") for i in range(2000)])
+        Message.objects.update(timestamp=now - timedelta(minutes=1)) # auto_now_add ignores bulk values
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor: cursor.execute("SET LOCAL enable_seqscan = off") # Seed is tiny: only a missing index can force a scan
+
+    def assertIndexed(self, qs):
+        plan = qs.explain()
+        scanned = set(SEQ_SCAN[connection.vendor].findall(plan)) & HOT_TABLES
+        self.assertFalse(scanned, f"Sequential scan on {scanned}:\n{qs.query}\n{plan}")
+
+    def test_room_history(self):
+        now = timezone.now()
+        qs = Message.objects.filter(room=self.rooms[0])
+        self.assertIndexed(qs.order_by('-timestamp', '-id')[:31])
+        self.assertIndexed(qs.filter(timestamp__lt=now).order_by('-timestamp', '-id')[:31])
+
+    def test_leaderboard_fallback(self):
+        for field in ('xp', 'aura'):
+            self.assertIndexed(Profile.objects.order_by(F(field).desc())[:10])
+
+    def test_dashboard(self):
+        now = timezone.now()
+        self.assertIndexed(Profile.objects.filter(last_activity__gte=now - timedelta(minutes=5)))
+        self.assertIndexed(Profile.objects.filter(last_activity__gte=now - timedelta(days=30)))
+        self.assertIndexed(Profile.objects.filter(xp__gte=1000))
+        self.assertIndexed(Profile.objects.filter(subscription_tier='Free', last_activity__gte=now - timedelta(days=1)))
+        self.assertIndexed(Profile.objects.exclude(subscription_tier='Free'))
+        self.assertIndexed(Profile.objects.exclude(city="Unknown").values('city').annotate(count=Count('id')).order_by('-count')[:5])
+        self.assertIndexed(Message.objects.filter(timestamp__lt=now - timedelta(minutes=5)).values('id')) # Rollup high-water mark
+
+
+@override_settings(XP_WRITE_BEHIND=False)
+class VoteRaceTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='x')
+        self.voter = User.objects.create_user('voter', password='x')
+        room = Room.objects.create(name='Lounge')
+        self.message = Message.objects.create(user=self.author, room=room, content='hi')
+        self.client.login(username='voter', password='x')
+
+    def test_duplicate_insert_is_a_no_op(self):
+        # State after the concurrent request won: the vote row and its count are already in
+        self.message.likes.add(self.voter)
+        Message.objects.filter(id=self.message.id).update(like_count=1)
+        aura_before = Profile.objects.get(user=self.author).aura
+        # Our request's DELETE ran before that insert, so it saw nothing and tries to insert too
+        with mock.patch.object(QuerySet, 'delete', return_value=(0, {})), mock.patch('chat.vote_feed.publish') as publish:
+            response = self.client.post(f'/vote/{self.message.id}/like/')
+        self.assertEqual(response.json(), {'likes_count': 1, 'dislikes_count': 0})
+        self.assertEqual(Profile.objects.get(user=self.author).aura, aura_before)
+        self.message.refresh_from_db()
+        self.assertEqual((self.message.like_count, self.message.likes.count()), (1, 1))
+        publish.assert_not_called()
+
+
+def redis_available():
+    try: return bool(get_redis().ping())
+    except RedisError: return False
+
+
+@skipUnless(redis_available(), "needs the Redis at REDIS_URL")
+@override_settings(XP_WRITE_BEHIND=True)
+class CounterFlushTests(TestCase):
+    def setUp(self):
+        self.redis = get_redis()
+        self.addCleanup(self.redis.delete, counters.PENDING_KEY, counters.PROCESSING_KEY, counters.BATCH_KEY, counters.LOCK_KEY)
+        self.redis.delete(counters.PENDING_KEY, counters.PROCESSING_KEY, counters.BATCH_KEY, counters.LOCK_KEY)
+        self.user = User.objects.create_user('flusher', password='x')
+        self.xp = Profile.objects.get(user=self.user).xp
+        self.redis.hincrby(counters.PENDING_KEY, f"xp:{self.user.id}", 40)
+
+    def current_xp(self): return Profile.objects.get(user=self.user).xp
+
+    def test_flush_applies_and_clears(self):
+        self.assertEqual(counters.flush(), 1)
+        self.assertEqual(self.current_xp(), self.xp + 40)
+        self.assertFalse(self.redis.exists(counters.PROCESSING_KEY, counters.BATCH_KEY, counters.LOCK_KEY))
+
+    def test_retry_after_crash_past_commit_does_not_reapply(self):
+        # The UPDATE commits, then the worker dies before dropping the batch from Redis
+        with mock.patch.object(type(self.redis), 'delete', side_effect=RedisError("connection lost")):
+            with self.assertRaises(RedisError): counters.flush()
+        self.assertEqual(self.current_xp(), self.xp + 40)
+        self.assertEqual(counters.pending_many([self.user.id]), {}) # Batch is in the row already, not pending too
+        self.redis.hincrby(counters.PENDING_KEY, f"xp:{self.user.id}", 5) # Arrived meanwhile, waits for the next flush
+        self.assertEqual(counters.flush(), 0)
+        self.assertEqual(self.current_xp(), self.xp + 40)
+        self.assertEqual(counters.flush(), 1)
+        self.assertEqual(self.current_xp(), self.xp + 45)
+
+    def test_retry_after_crash_before_commit_applies_once(self):
+        with mock.patch.object(counters, '_apply_batch', side_effect=RuntimeError("killed")):
+            with self.assertRaises(RuntimeError): counters.flush()
+        self.assertEqual(self.current_xp(), self.xp)
+        self.assertEqual(counters.pending_many([self.user.id]), {self.user.id: {'xp': 40, 'aura': 0}})
+        self.assertEqual(counters.flush(), 1)
+        self.assertEqual(self.current_xp(), self.xp + 40)
+
+    def test_rolled_back_grant_stages_nothing(self):
+        with mock.patch.object(counters.rewarded, 'send') as sent, self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                counters.add(self.user.id, xp=7)
+                raise RuntimeError("rolled back")
+            counters.add(self.user.id, aura=3)
+        self.assertEqual(counters.pending_many([self.user.id]), {self.user.id: {'xp': 40, 'aura': 3}})
+        sent.assert_called_once_with(sender=None, user_id=self.user.id, xp=0, aura=3)
+
+    def test_gains_are_flushed_and_rebuild_the_windows(self):
+        self.redis.delete(leaderboard.bucket_key('xp', 'day'))
+        self.addCleanup(self.redis.delete, *(leaderboard.bucket_key(f, w) for f in leaderboard.KEYS for w in leaderboard.WINDOWS))
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.add(self.user.id, xp=15, aura=-3) # A loss is not a gain
+        counters.flush()
+        gain = DailyGain.objects.get(user=self.user, day=timezone.localdate())
+        self.assertEqual((gain.xp, gain.aura), (15, 0))
+        self.redis.delete(leaderboard.bucket_key('xp', 'day')) # Redis lost the window
+        leaderboard.rebuild_windows()
+        self.assertEqual(leaderboard.top_window('xp', 'day', 1), [(self.user.id, 15)])
+
+    def test_concurrent_flush_backs_off(self):
+        self.redis.set(counters.LOCK_KEY, "other", ex=counters.LOCK_TTL)
+        self.assertEqual(counters.flush(), 0)
+        self.assertEqual(self.current_xp(), self.xp)
+        self.assertEqual(self.redis.get(counters.LOCK_KEY), b"other") # Not released by the loser
+
+
+class MetricsTests(TestCase):
+    def test_track_attributes_queries_to_its_label(self):
+        count_before, queries_before = metrics.ws_queries.get('test_track')
+        with metrics.track(metrics.ws_latency, metrics.ws_queries, metrics.ws_db_time) as scope:
+            scope.label = 'test_track' # Set late, like the view name
+            User.objects.count(); Room.objects.count()
+        User.objects.count() # Outside the scope: not counted
+        self.assertEqual(scope.queries, 2)
+        self.assertEqual(metrics.ws_queries.get('test_track'), (count_before + 1, queries_before + 2))
+        self.assertEqual(metrics.ws_latency.get('test_track')[0], count_before + 1)
+
+    def test_render_prometheus_text(self):
+        hist = metrics.Histogram('test_render_seconds', "Test histogram", ['view'], buckets=(0.1, 1))
+        counter = metrics.Counter('test_render_total', "Test counter", ['view'])
+        self.addCleanup(lambda: [metrics._metrics.remove(m) for m in (hist, counter)])
+        hist.observe(0.05, 'a"b'); hist.observe(0.5, 'a"b')
+        counter.inc('x', amount=3)
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE test_render_seconds histogram', lines)
+        self.assertIn('test_render_seconds_bucket{view="a\\"b",le="0.1"} 1', lines)
+        self.assertIn('test_render_seconds_bucket{view="a\\"b",le="1"} 2', lines)
+        self.assertIn('test_render_seconds_bucket{view="a\\"b",le="+Inf"} 2', lines)
+        self.assertIn('test_render_seconds_count{view="a\\"b"} 2', lines)
+        self.assertIn('test_render_total{view="x"} 3', lines)
+        self.assertTrue(any(line.startswith('airspace_threadpool_queue_depth{executor="request"}') for line in lines))
+
+    @mock.patch.object(metrics, 'TOKEN', 'secret')
+    def test_endpoint_needs_staff_or_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404) # Local address alone is not enough
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret', REMOTE_ADDR='10.0.0.9').status_code, 404)
+        User.objects.create_user('ops', password='x', is_staff=True)
+        self.client.login(username='ops', password='x')
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    def test_pool_gauge_survives_missing_internals(self):
+        from asgiref.sync import SyncToAsync
+        with mock.patch.object(SyncToAsync, 'single_thread_executor', object()), \
+             mock.patch.object(SyncToAsync, 'context_to_thread_executor', None):
+            self.assertNotIn(('thread_sensitive',), metrics._pool_depth())
+            self.assertNotIn(('request',), metrics._pool_depth())
+            self.assertIn('# TYPE airspace_threadpool_queue_depth gauge', metrics.render())
+        with mock.patch.object(metrics.pool_depth, 'func', side_effect=AttributeError("renamed")):
+            self.assertIn('# TYPE airspace_threadpool_queue_depth gauge', metrics.render())
+
+
+class HistoryClearTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader', password='x')
+        self.room = Room.objects.create(name='Lounge')
+        self.now = timezone.now()
+        self.msgs = []
+        for i in range(5):
+            m = Message.objects.create(user=self.user, room=self.room, content=str(i))
+            Message.objects.filter(pk=m.pk).update(timestamp=self.now + timedelta(seconds=i))
+            self.msgs.append(m)
+
+    def visible(self): return [m['message'] for m in fetch_page('Lounge', self.user)['messages']]
+
+    def test_watermark_hides_messages_up_to_and_including_it(self):
+        HistoryClear.objects.create(user=self.user, room=self.room, cleared_at=self.now + timedelta(seconds=2))
+        self.assertEqual(self.visible(), ['3', '4'])
+        self.msgs[4].hidden_by.add(self.user) # "Delete for me" still applies after the watermark
+        self.assertEqual(self.visible(), ['3'])
+        other = User.objects.create_user('other', password='x')
+        self.assertEqual([m['message'] for m in fetch_page('Lounge', other)['messages']], ['0', '1', '2', '3', '4'])
+
+
+class HistoryClearMigrationTests(TransactionTestCase):
+    before, after = [('chat', '0013_message_room_timestamp_index')], [('chat', '0014_historyclear')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_clear_history_rows_become_watermarks(self):
+        apps = self.migrate(self.before)
+        User, Room, Message = (apps.get_model(*name) for name in (('auth', 'User'), ('chat', 'Room'), ('chat', 'Message')))
+        cleared, mixed, tie = (User.objects.create(username=name) for name in ('cleared', 'mixed', 'tie'))
+        room = Room.objects.create(name='Lounge')
+        now = timezone.now()
+        msgs = []
+        for i, second in enumerate([0, 1, 2, 3, 3, 4]): # Messages 3 and 4 share a timestamp
+            m = Message.objects.create(user=cleared, room=room, content=str(i))
+            Message.objects.filter(pk=m.pk).update(timestamp=now + timedelta(seconds=second))
+            msgs.append(m)
+        for m in msgs[:3] + msgs[5:]: m.hidden_by.add(cleared) # Cleared up to 2, then deleted 5 for themselves
+        msgs[2].hidden_by.add(mixed) # Only a "delete for me": message 0 is still visible
+        for m in msgs[:4]: m.hidden_by.add(tie) # 4 is visible at 3's timestamp, so the watermark stops at 2
+
+        apps = self.migrate(self.after)
+        HistoryClear, Hidden = apps.get_model('chat', 'HistoryClear'), apps.get_model('chat', 'Message').hidden_by.through
+        self.assertEqual(dict(HistoryClear.objects.values_list('user__username', 'cleared_at')),
+                         {'cleared': now + timedelta(seconds=2), 'tie': now + timedelta(seconds=2)})
+        self.assertEqual(sorted(Hidden.objects.values_list('user__username', 'message__content')),
+                         [('cleared', '5'), ('mixed', '2'), ('tie', '3')])
+
+
+@override_settings(XP_WRITE_BEHIND=False, OUTBOX_ENABLED=True)
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('worker', password='x')
+        self.xp = Profile.objects.get(user=self.user).xp
+        self.fail = True
+        @outbox.handler('test_reward')
+        def reward(payload): # A DB write and a reward, then possibly a crash
+            grant_reward(self.user, xp=payload['xp'], boosted=False)
+            if self.fail: raise RuntimeError("handler failed")
+        self.addCleanup(outbox.HANDLERS.pop, 'test_reward')
+        outbox.enqueue([('test_reward', {'xp': 10}, 'reward:1')])
+        self.job = OutboxJob.objects.get(idempotency_key='reward:1')
+
+    def process(self, run=None):
+        with mock.patch.object(counters.rewarded, 'send') as sent, self.captureOnCommitCallbacks(execute=True):
+            result = (run or outbox.process_batch)()
+        return result, sent
+
+    def current_xp(self): return Profile.objects.get(user=self.user).xp
+
+    def test_failed_job_rolls_back_and_retries(self):
+        (done, failed), sent = self.process()
+        self.assertEqual((done, failed), (0, 1))
+        self.assertEqual(self.current_xp(), self.xp) # The grant went with the rollback
+        sent.assert_not_called()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.attempts), ('pending', 1))
+        self.assertGreater(self.job.run_after, timezone.now()) # Backing off
+        self.assertIn("handler failed", self.job.last_error)
+
+        OutboxJob.objects.filter(id=self.job.id).update(run_after=timezone.now())
+        self.fail = False
+        (done, failed), sent = self.process()
+        self.assertEqual((done, failed), (1, 0))
+        self.assertEqual(self.current_xp(), self.xp + 10) # Paid exactly once
+        sent.assert_called_once()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.attempts), ('done', 2))
+
+    def test_lost_lease_rolls_back(self):
+        self.fail = False
+        job, = outbox._claim(10)
+        self.assertEqual(outbox.process_batch(), (0, 0)) # Leased: other workers skip it
+        # The lease ran out and another worker claimed the job before this one finished
+        OutboxJob.objects.filter(id=job.id).update(run_after=timezone.now() + timedelta(minutes=1))
+        ok, sent = self.process(lambda: outbox._run(job))
+        self.assertFalse(ok)
+        self.assertEqual(self.current_xp(), self.xp)
+        sent.assert_not_called()
+        self.assertEqual(OutboxJob.objects.get(id=job.id).status, 'pending') # Left to its new owner
+
+    def test_parked_after_max_attempts(self):
+        OutboxJob.objects.filter(id=self.job.id).update(attempts=outbox.MAX_ATTEMPTS - 1)
+        self.process()
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.attempts), ('dead', outbox.MAX_ATTEMPTS))
+
+    def test_failed_mention_push_is_retried(self):
+        author = User.objects.create_user('author', password='x')
+        message = Message.objects.create(user=author, room=Room.objects.create(name='Lounge'), content='hi @worker')
+        outbox.release(f"mentions:{message.id}"); self.addCleanup(outbox.release, f"mentions:{message.id}") # Ids repeat across test runs
+        with mock.patch('chat.mentions.notify', side_effect=RuntimeError("layer down")):
+            with self.assertRaises(RuntimeError): check_mentions({'message_id': message.id})
+        with mock.patch('chat.mentions.notify') as notify:
+            check_mentions({'message_id': message.id}); check_mentions({'message_id': message.id})
+        notify.assert_called_once_with([self.user.id], 'author')
+
+
+class UploadTests(TestCase):
+    """ Chunked uploads: in-order chunks, declared size, owner-only, claimed once """
+    def setUp(self):
+        self.media = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, self.media, True)
+        settings = override_settings(MEDIA_ROOT=self.media, CHAT_UPLOAD_SPOOL_DIR=os.path.join(self.media, 'spool'), CHAT_UPLOAD_CHUNK_BYTES=4)
+        settings.enable(); self.addCleanup(settings.disable)
+        self.user = User.objects.create_user('pilot', password='x')
+        self.other = User.objects.create_user('intruder', password='x')
+        self.upload = start_upload(self.user, 'audio', 6, 'ogg')
+
+    def append(self, data, offset=0, user=None):
+        return append_chunk(user or self.user, self.upload.token, offset, io.BytesIO(data), len(data))
+
+    def assertRefused(self, status, func, *args, **kwargs):
+        with self.assertRaises(UploadError) as ctx: func(*args, **kwargs)
+        self.assertEqual(ctx.exception.status, status)
+
+    def finish(self):
+        self.append(b'abcd')
+        with self.captureOnCommitCallbacks(execute=True): return self.append(b'ef', offset=4)
+
+    def test_chunks_must_continue_at_the_received_offset(self):
+        self.append(b'abcd')
+        self.assertRefused(409, self.append, b'ef', offset=2)
+        self.assertRefused(409, self.append, b'ef', offset=6)
+        self.assertEqual(MediaUpload.objects.get(id=self.upload.id).received, 4)
+
+    def test_size_limits(self):
+        self.assertRefused(413, start_upload, self.user, 'audio', 5 * 1024 * 1024 + 1, 'ogg')
+        self.assertRefused(413, self.append, b'abcde') # Larger than CHAT_UPLOAD_CHUNK_BYTES
+        self.append(b'abcd')
+        self.assertRefused(413, self.append, b'efg', offset=4) # Past the declared size
+
+    def test_only_the_owner_can_append_or_claim(self):
+        self.assertRefused(404, self.append, b'abcd', user=self.other)
+        self.finish()
+        self.assertIsNone(claim_upload(self.other, self.upload.token))
+        self.assertTrue(MediaUpload.objects.filter(id=self.upload.id).exists())
+
+    def test_finished_upload_is_claimed_once(self):
+        upload = self.finish()
+        field = Message._meta.get_field('audio')
+        self.assertTrue(upload.stored_name.startswith('chat_audio/voice_'))
+        with field.storage.open(upload.stored_name) as f: self.assertEqual(f.read(), b'abcdef')
+        self.assertIsNone(claim_upload(self.user, 'nope'))
+        self.assertEqual(claim_upload(self.user, self.upload.token), ('audio', upload.stored_name))
+        self.assertIsNone(claim_upload(self.user, self.upload.token))
+        self.assertRefused(404, self.append, b'ef', offset=4)
+
+    def test_rolled_back_last_chunk_stores_nothing(self):
+        self.append(b'abcd')
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.append(b'ef', offset=4)
+                raise RuntimeError("save_message failed")
+        self.assertEqual(callbacks, [])
+        self.assertFalse(os.path.exists(os.path.join(self.media, 'chat_audio')))
+        self.assertEqual(MediaUpload.objects.get(id=self.upload.id).received, 4)
+        self.append(b'ef', offset=4) # The spool is intact, so the client can resend
+
+
+class HistoryPagingTests(TestCase):
+    """ Keyset pages: (timestamp, id) cursors, ties broken by id, nothing skipped or repeated """
+    def setUp(self):
+        self.user = User.objects.create_user('reader', password='x')
+        room = Room.objects.create(name='Lounge')
+        now = timezone.now()
+        self.msgs = []
+        for i, offset in enumerate([0, 1, 2, 2, 3]): # Messages 2 and 3 share a timestamp
+            m = Message.objects.create(user=self.user, room=room, content=str(i))
+            Message.objects.filter(pk=m.pk).update(timestamp=now + timedelta(seconds=offset, microseconds=123457))
+            m.refresh_from_db(); self.msgs.append(m)
+
+    def page(self, before=None):
+        page = fetch_page('Lounge', self.user, before=before, limit=2)
+        return [m['message'] for m in page['messages']], page['next_cursor']
+
+    def test_cursor_round_trip(self):
+        m = self.msgs[3]
+        self.assertEqual(decode_cursor(encode_cursor(m)), (m.timestamp, m.id))
+        for bad in (None, '', 'abc', '12', '1_2_3', 'x_1'): self.assertIsNone(decode_cursor(bad))
+
+    def test_pages_walk_back_across_a_timestamp_tie(self):
+        self.assertEqual(self.page(), (['3', '4'], encode_cursor(self.msgs[3])))
+        self.assertEqual(self.page(encode_cursor(self.msgs[3])), (['1', '2'], encode_cursor(self.msgs[1])))
+        self.assertEqual(self.page(encode_cursor(self.msgs[1])), (['0'], None))
+
+    def test_cursor_is_exclusive_and_bad_cursors_return_nothing(self):
+        self.assertEqual(self.page(encode_cursor(self.msgs[0])), ([], None))
+        self.assertEqual(self.page('garbage'), ([], None))
+
+
+class GeoIPTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp(); self.addCleanup(shutil.rmtree, tmp, True)
+        self.path = os.path.join(tmp, 'cities.bin')
+        ip = ipaddress.ip_address
+        self.counts = geoip.write_db(self.path, [
+            (ip('10.0.0.0'), ip('10.0.0.255'), 'Lahore'),
+            (ip('1.0.0.0'), ip('1.0.0.255'), 'Karachi'), # Out of order: write_db sorts
+            (ip('10.0.2.0'), ip('10.0.2.255'), 'Lahore'),
+            (ip('::ffff:20.0.0.0'), ip('::ffff:20.0.0.9'), 'Dubai'), # IPv4-mapped: stored as IPv4
+            (ip('2001:db8::'), ip('2001:db8::ffff'), 'Berlin'),
+            (ip('30.0.0.9'), ip('30.0.0.0'), 'Backwards'), # Start after end: skipped
+        ])
+        self.db = geoip.GeoDB(self.path)
+
+    def test_write_db_counts_and_shares_names(self):
+        self.assertEqual(self.counts, (4, 1))
+        self.assertEqual(self.db.names, ['Lahore', 'Karachi', 'Dubai', 'Berlin'])
+        self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+    def test_lookup_bounds_and_gaps(self):
+        for addr, city in [('10.0.0.0', 'Lahore'), ('10.0.0.255', 'Lahore'), ('10.0.1.7', None), ('10.0.2.1', 'Lahore'),
+                           ('1.0.0.9', 'Karachi'), ('0.255.255.255', None), ('255.0.0.1', None), ('20.0.0.5', 'Dubai'),
+                           ('::ffff:10.0.0.7', 'Lahore'), ('2001:db8::1', 'Berlin'), ('2001:db9::', None), ('::1', None),
+                           ('30.0.0.5', None), ('not an ip', None)]:
+            with self.subTest(addr=addr): self.assertEqual(self.db.lookup(addr), city)
+
+    def test_rejects_other_files_and_missing_db(self):
+        with open(self.path, 'wb') as f: f.write(b'x' * 64)
+        with self.assertRaises(ValueError): geoip.GeoDB(self.path)
+        with mock.patch.object(geoip, '_db', None), override_settings(GEOIP_DB_PATH=self.path + '.missing'):
+            self.assertIsNone(geoip.city_for('10.0.0.1'))
+
+
+class TierTests(TestCase):
+    def test_tier_data_boundaries(self):
+        self.assertEqual(tiers.tier_data(0), {'name': 'BRONZE', 'full': 'BRONZE', 'next_xp': 100, 'progress': 0})
+        self.assertEqual(tiers.tier_data(-50)['progress'], 0)
+        self.assertEqual(tiers.tier_data(99), {'name': 'BRONZE', 'full': 'BRONZE', 'next_xp': 100, 'progress': 99})
+        self.assertEqual(tiers.tier_data(100)['name'], 'GOLD')
+        self.assertEqual(tiers.tier_data(550)['progress'], 50)
+        self.assertEqual(tiers.tier_data(10**7), {'name': 'LEGEND', 'full': 'LEGEND', 'next_xp': 500000, 'progress': 100})
+
+    def test_histogram_matches_tier_name(self):
+        xps = [-1, 0, 99, 100, 999, 1000, 25000, 499999, 500000, 10**7]
+        for i, xp in enumerate(xps):
+            Profile.objects.filter(user=User.objects.create_user(f"pilot{i}", password='x')).update(xp=xp)
+        expected = {name: 0 for name in tiers.NAMES}
+        for xp in xps: expected[tiers.tier_name(xp)] += 1
+        hist = tiers.histogram(Profile.objects.all())
+        self.assertEqual([name for name, _ in hist], tiers.NAMES)
+        self.assertEqual(dict(hist), expected)
 
-# Create your tests here.
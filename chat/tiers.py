@@ -0,0 +1,38 @@
+# XP tiers, defined once: bisect lookups in Python and the same ladder as a Case/When for querysets
+from bisect import bisect_right
+from django.db.models import Case, CharField, Count, Value, When
+
+# (name, minimum XP), lowest first
+TIERS = [("BRONZE", 0), ("GOLD", 100), ("PLATINUM", 1000), ("DIAMOND", 5000), ("CROWN", 10000), ("ACE", 25000), ("MASTER", 50000), ("DOMINATOR", 100000), ("CONQUEROR", 200000), ("LEGEND", 500000)]
+NAMES = [name for name, _ in TIERS]
+THRESHOLDS = [xp for _, xp in TIERS]
+RANKS = TIERS[::-1] # Highest first, for the profile ladder
+
+def index_for(xp):
+    return max(bisect_right(THRESHOLDS, xp) - 1, 0) # Negative XP still reads as BRONZE
+
+def tier_name(xp): return NAMES[index_for(xp)]
+
+def tier_data(xp):
+    """ {'name', 'full', 'next_xp', 'progress'}; the top tier reports its own threshold and 100% """
+    i = index_for(xp)
+    prev_xp = THRESHOLDS[i]
+    if i + 1 < len(THRESHOLDS):
+        next_xp = THRESHOLDS[i + 1]
+        progress = int((xp - prev_xp) * 100 / (next_xp - prev_xp))
+    else:
+        next_xp, progress = prev_xp, 100
+    return {'name': NAMES[i], 'full': NAMES[i], 'next_xp': next_xp, 'progress': max(0, min(progress, 100))}
+
+# --- SQL SIDE ---
+def tier_case(field='xp'):
+    """ CASE expression giving the tier name of `field`, for .annotate(tier=tier_case()) """
+    return Case(
+        *[When(**{f"{field}__gte": xp}, then=Value(name)) for name, xp in RANKS[:-1]],
+        default=Value(NAMES[0]), output_field=CharField(),
+    )
+
+def histogram(queryset, field='xp'):
+    """ [(tier, count)] lowest tier first, from one GROUP BY over the queryset """
+    counts = dict(queryset.annotate(tier=tier_case(field)).order_by().values_list('tier').annotate(n=Count('pk')))
+    return [(name, counts.get(name, 0)) for name in NAMES]
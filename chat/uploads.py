@@ -0,0 +1,105 @@
+import os
+import secrets
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from .models import MediaUpload, Message
+
+# --- LIMITS ---
+DEFAULT_MAX_BYTES = {'image': 8 * 1024 * 1024, 'audio': 5 * 1024 * 1024}
+DEFAULT_CHUNK_BYTES = 256 * 1024
+ALLOWED_EXTENSIONS = {
+    'image': {'png', 'jpg', 'jpeg', 'gif', 'webp'},
+    'audio': {'webm', 'ogg', 'mp3', 'm4a', 'wav'},
+}
+COPY_BUFFER = 64 * 1024
+
+class UploadError(Exception):
+    def __init__(self, msg, status=400):
+        super().__init__(msg)
+        self.msg = msg; self.status = status
+
+def max_bytes(kind): return getattr(settings, 'CHAT_UPLOAD_MAX_BYTES', DEFAULT_MAX_BYTES)[kind]
+def chunk_bytes(): return getattr(settings, 'CHAT_UPLOAD_CHUNK_BYTES', DEFAULT_CHUNK_BYTES)
+
+def spool_path(upload):
+    spool_dir = getattr(settings, 'CHAT_UPLOAD_SPOOL_DIR', os.path.join(settings.MEDIA_ROOT, 'upload_spool'))
+    os.makedirs(spool_dir, exist_ok=True)
+    return os.path.join(spool_dir, f"{upload.token}.part")
+
+# --- UPLOAD LIFECYCLE ---
+def start_upload(user, kind, size, extension):
+    """ Validates the declared size up front so oversized files are refused before any byte is sent """
+    extension = (extension or '').lower().lstrip('.')
+    if kind not in ALLOWED_EXTENSIONS: raise UploadError("Unknown media type")
+    if extension not in ALLOWED_EXTENSIONS[kind]: raise UploadError("File type not allowed")
+    if size <= 0: raise UploadError("Empty file")
+    if size > max_bytes(kind): raise UploadError(f"File too large (max {max_bytes(kind) // (1024 * 1024)} MB)", status=413)
+    return MediaUpload.objects.create(token=secrets.token_urlsafe(24), user=user, kind=kind, extension=extension, size=size)
+
+def append_chunk(user, token, offset, stream, length):
+    """
+    Appends one chunk to the spool file. Chunks must arrive in order; a client that
+    lost track (dropped connection) reads `received` back and resumes from there.
+    """
+    with transaction.atomic():
+        try: upload = MediaUpload.objects.select_for_update().get(token=token, user=user)
+        except MediaUpload.DoesNotExist: raise UploadError("Unknown upload", status=404)
+
+        if upload.stored_name: raise UploadError("Upload already complete", status=409)
+        if offset != upload.received: raise UploadError("Offset mismatch", status=409)
+        if length <= 0 or length > chunk_bytes(): raise UploadError("Bad chunk size", status=413)
+        if upload.received + length > upload.size: raise UploadError("Chunk exceeds declared size", status=413)
+
+        written = 0
+        with open(spool_path(upload), 'ab') as spool:
+            spool.truncate(upload.received) # Drop any tail left by an interrupted chunk
+            while written < length:
+                piece = stream.read(min(COPY_BUFFER, length - written))
+                if not piece: break
+                spool.write(piece); written += len(piece)
+        if written != length: raise UploadError("Incomplete chunk", status=400)
+
+        upload.received += written
+        upload.save(update_fields=['received'])
+        # Move the file only once the last chunk has committed: a rollback must not orphan a stored copy
+        if upload.received == upload.size: transaction.on_commit(lambda: finish_upload(upload))
+        return upload
+
+def finish_upload(upload):
+    """ Moves the spooled file into the Message field's storage (runs in the HTTP worker, not the socket) """
+    field = Message._meta.get_field(upload.kind)
+    prefix = 'img' if upload.kind == 'image' else 'voice'
+    name = field.generate_filename(None, f"{prefix}_{upload.user_id}_{int(timezone.now().timestamp())}.{upload.extension}")
+    path = spool_path(upload)
+    with open(path, 'rb') as spool:
+        stored_name = field.storage.save(name, File(spool), max_length=field.max_length)
+    if not MediaUpload.objects.filter(pk=upload.pk, stored_name='').update(stored_name=stored_name):
+        field.storage.delete(stored_name) # Purged meanwhile: nothing will ever claim this copy
+        return
+    upload.stored_name = stored_name
+    os.remove(path)
+
+def claim_upload(user, token):
+    """
+    Hands a finished upload to save_message. Returns (kind, stored_name) or None.
+    Call it inside the transaction that saves the Message: the row is locked and
+    its delete only commits together with the Message that took the file.
+    """
+    upload = MediaUpload.objects.select_for_update().filter(token=token, user=user).exclude(stored_name='').first()
+    if not upload: return None
+    upload.delete()
+    return upload.kind, upload.stored_name
+
+def purge_stale(older_than):
+    """ Removes unfinished uploads (and their spool files) started before `older_than` """
+    count = 0
+    for upload in MediaUpload.objects.filter(created_at__lt=older_than):
+        if upload.stored_name:
+            Message._meta.get_field(upload.kind).storage.delete(upload.stored_name)
+        else:
+            try: os.remove(spool_path(upload))
+            except FileNotFoundError: pass
+        upload.delete(); count += 1
+    return count
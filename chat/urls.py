@@ -12,9 +12,12 @@ urlpatterns = [
     path('profile/', views.profile_view, name='profile'),
     path('membership/', views.membership_view, name='membership'),
     path('chat/<str:room_name>/', views.room, name='room'),
+    path('chat/<str:room_name>/history/', views.message_history, name='message_history'),
     
     # Logic
     path('vote/<int:message_id>/<str:vote_type>/', views.vote_message, name='vote_message'),
+    path('upload/start/', views.upload_start, name='upload_start'),
+    path('upload/<str:token>/', views.upload_chunk, name='upload_chunk'),
     
     # Admin / God Mode
     path('control-tower/', views.admin_dashboard, name='admin_dashboard'),
@@ -28,6 +31,8 @@ urlpatterns = [
     
     # --- NEW URLS ---
     path('toggle-fav/<int:track_id>/', views.toggle_music_fav, name='toggle_music_fav'),
+    path('music/catalog/', views.music_catalog_view, name='music_catalog'),
+    path('music/favorites/', views.music_favorites, name='music_favorites'),
     path('suggest-music/', views.suggest_music, name='suggest_music'),
     path('delete-suggestion/<int:suggestion_id>/', views.delete_suggestion, name='delete_suggestion'),
     path('leaderboard/', views.leaderboard_view, name='leaderboard'),
@@ -2,23 +2,31 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.utils.http import quote_etag
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
-from django.views.decorators.http import require_POST # Added for ad claim view
+from django.views.decorators.http import require_POST, require_http_methods, condition # Added for ad claim view
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone # Added for date handling
+from django.db import transaction
 import random
+import json
+from redis import RedisError
 
 # Import models
 from .models import (
     Message, Room, Profile, SiteConfig, MusicTrack, MusicSuggestion,
-    UserStreak, DailyActivity # Added new retention models
+    UserStreak, DailyActivity, # Added new retention models
+    MediaUpload
 )
 from .forms import ClaimIdentityForm, EditNameForm
+from .uploads import UploadError, start_upload, append_chunk, chunk_bytes
+from .history import fetch_page, recent_page, buffer_update, is_locked as room_is_locked, PAGE_SIZE
+from . import recent, counters, votes, vote_feed, leaderboard, tiers, music_catalog, assets, presence, metrics
 
 # Import retention engine logic
-from .retention_engine import get_or_create_daily, update_streak, grant_xp
+from .retention_engine import get_or_create_daily, update_streak, grant_reward, claim_daily_flag, claim_daily_quota
 
 # --- HELPERS ---
 def get_config(): return SiteConfig.get_solo()
@@ -34,14 +42,27 @@ def home(request):
     if not request.user.is_authenticated:
         create_guest_user(request)
         
-    top_profiles = Profile.objects.select_related('user').order_by('-xp')[:3]
+    top_profiles = leaderboard.top_profiles('xp', 3)
     return render(request, 'chat/home.html', {'top_profiles': top_profiles, 'hide_nav': False})
 
+LEADERBOARD_TABS = [('all', 'All Time'), ('day', 'Today'), ('week', 'This Week'), ('month', 'This Month')]
+
 @login_required(login_url='/')
 def leaderboard_view(request):
-    top_rank = Profile.objects.select_related('user').order_by('-xp')[:50]
-    top_aura = Profile.objects.select_related('user').order_by('-aura')[:50]
-    return render(request, 'chat/leaderboard.html', {'top_rank': top_rank, 'top_aura': top_aura, 'hide_nav': False})
+    # ?window=day|week|month reads that period's gain buckets; default is all-time
+    window = request.GET.get('window')
+    if window not in leaderboard.WINDOWS: window = None
+    top_rank = leaderboard.top_profiles('xp', 50, window)
+    top_aura = leaderboard.top_profiles('aura', 50, window)
+    # "Around me": my position plus a few pilots either side, without scanning the table
+    my_rank, around_me = None, []
+    try:
+        my_rank, nearby = leaderboard.around('xp', request.user.id, radius=3)
+        ranked = {p.user_id: p for p in leaderboard.profiles([(uid, score) for _, uid, score in nearby], 'xp')}
+        around_me = [(r, ranked[uid]) for r, uid, _ in nearby if uid in ranked]
+    except RedisError as e:
+        print(f"Leaderboard index unavailable: {e}")
+    return render(request, 'chat/leaderboard.html', {'top_rank': top_rank, 'top_aura': top_aura, 'my_rank': my_rank, 'around_me': around_me, 'window': window or 'all', 'window_tabs': LEADERBOARD_TABS, 'hide_nav': False})
 
 def logout_view(request): 
     logout(request)
@@ -50,56 +71,43 @@ def logout_view(request):
 
 @login_required(login_url='/')
 def room(request, room_name):
-    room_obj, _ = Room.objects.get_or_create(name=room_name)
-    chat_qs = Message.objects.filter(room=room_obj).order_by('-timestamp')[:50]
-    chat_history = reversed(chat_qs)
+    Room.objects.get_or_create(name=room_name)
     profile, _ = Profile.objects.get_or_create(user=request.user)
+    counters.merge_pending([profile])
     config = get_config()
     
-    is_locked = False; lock_message = ""
-    if room_name == "Announcements" and not request.user.is_staff:
-        if profile.xp < config.announcement_min_xp: 
-            is_locked = True
-            lock_message = f"🔒 LOCKED: Requires {config.announcement_min_xp} XP."
+    is_locked = False; lock_message = ""; history = {'messages': [], 'next_cursor': None}
+    if room_is_locked(request.user, profile, room_name, config):
+        is_locked = True
+        lock_message = f"🔒 LOCKED: Requires {config.announcement_min_xp} XP."
+    else:
+        history = recent_page(room_name, request.user)
+    try: room_online = presence.room_count(room_name) # The socket pushes live updates after this
+    except RedisError: room_online = None
             
     return render(request, 'chat/room.html', {
-        'room_name': room_name, 'chat_history': chat_history, 'profile': profile, 
-        'config': config, 'is_locked': is_locked, 'lock_message': lock_message, 'hide_nav': True 
+        'room_name': room_name, 'chat_history': history['messages'], 'next_cursor': history['next_cursor'], 'profile': profile, 
+        'config': config, 'is_locked': is_locked, 'lock_message': lock_message, 'room_online': room_online, 'hide_nav': True 
     })
 
+@login_required(login_url='/')
+def message_history(request, room_name):
+    """ Keyset-paginated scroll-back: ?before=<cursor> returns the next older page """
+    profile, _ = Profile.objects.get_or_create(user=request.user)
+    counters.merge_pending([profile])
+    if room_is_locked(request.user, profile, room_name, get_config()):
+        return JsonResponse({'error': 'Locked'}, status=403)
+    try: limit = int(request.GET.get('limit', PAGE_SIZE))
+    except ValueError: limit = PAGE_SIZE
+    return JsonResponse(fetch_page(room_name, request.user, before=request.GET.get('before'), limit=limit))
+
 @login_required(login_url='/')
 def profile_view(request):
     profile, _ = Profile.objects.get_or_create(user=request.user)
+    counters.merge_pending([profile])
     config = get_config()
-    ranks = [("LEGEND", 500000), ("CONQUEROR", 200000), ("DOMINATOR", 100000), ("MASTER", 50000), ("ACE", 25000), ("CROWN", 10000), ("DIAMOND", 5000), ("PLATINUM", 1000), ("GOLD", 100), ("BRONZE", 0)]
-    
-    current_tier = "BRONZE"; next_xp = 100; prev_xp = 0
-    found = False
-    
-    for r in ranks:
-        if profile.xp >= r[1]:
-            current_tier = r[0]
-            try:
-                idx = ranks.index(r)
-                if idx > 0:
-                    next_xp = ranks[idx - 1][1]
-                    prev_xp = r[1]
-                else:
-                    next_xp = r[1]
-            except ValueError:
-                pass 
-            found = True
-            break
-    
-    if not found: 
-        current_tier = "BRONZE"; next_xp = 100; prev_xp = 0
-        
-    denominator = next_xp - prev_xp
-    progress = 100
-    if denominator > 0:
-        progress = ((profile.xp - prev_xp) / denominator) * 100
-
-    tier_data = {'name': current_tier, 'full': current_tier, 'next_xp': next_xp, 'progress': int(progress)}
+    ranks = tiers.RANKS
+    tier_data = tiers.tier_data(profile.xp)
 
     if request.method == 'POST':
         if 'update_username' in request.POST:
@@ -113,17 +121,18 @@ def profile_view(request):
             return redirect('profile')
         if 'update_theme' in request.POST: 
             profile.current_theme = request.POST.get('theme_select')
-            profile.save()
+            profile.save(update_fields=['current_theme'])
             return redirect('profile')
         if 'update_picture' in request.POST and request.FILES.get('profile_picture'): 
             profile.profile_picture = request.FILES['profile_picture']
-            profile.save()
+            profile.save(update_fields=['profile_picture'])
         if 'update_name' in request.POST: 
             form = EditNameForm(request.POST, instance=profile)
             if form.is_valid(): 
+                # Only display_name is written; XP goes through the counter store like every other reward
+                form.save(commit=False).save(update_fields=['display_name'])
+                counters.add_xp(request.user.id, -100)
                 profile.xp -= 100
-                form.save()
-                profile.save()
 
     return render(request, 'chat/profile.html', {'profile': profile, 'tier_data': tier_data, 'config': config, 'ranks': ranks, 'hide_nav': False})
 
@@ -146,48 +155,44 @@ def membership_view(request):
 @csrf_exempt
 @login_required
 def vote_message(request, message_id, vote_type):
-    message = get_object_or_404(Message, id=message_id)
-    if message.user == request.user: return JsonResponse({'error': 'Self-vote'}, status=403)
-    profile = message.user.profile
+    message = get_object_or_404(Message.objects.select_related('room').only('id', 'user', 'room__name'), id=message_id)
+    if message.user_id == request.user.id: return JsonResponse({'error': 'Self-vote'}, status=403)
     config = get_config()
+    aura_delta = 0
+    kind = 'like' if vote_type == 'like' else 'dislike'
+    added, likes, dislikes = votes.toggle(message.id, request.user.id, kind)
+    if added is None: # Lost a race with our own duplicate click: no vote changed, so no aura and no broadcast
+        return JsonResponse({'likes_count': likes, 'dislikes_count': dislikes})
     
-    if vote_type == 'like': 
-        if request.user in message.likes.all(): 
-            message.likes.remove(request.user)
-            profile.aura -= config.aura_per_like
+    if kind == 'like': 
+        if not added: 
+            aura_delta -= config.aura_per_like
         else: 
-            message.likes.add(request.user)
-            
             # --- [NEW] Retention Logic: Aura Multiplier ---
             # Standard Aura
             aura_amount = config.aura_per_like
             
             # Check for first like of the day multiplier
             # Target is the message owner (receiver of the like)
-            daily_target = get_or_create_daily(message.user) 
-            
-            if not daily_target.first_like_received:
+            if claim_daily_flag(message.user, 'first_like_received'):
                 # Apply 2x Multiplier logic here (assuming standard is 5, making it 10)
                 # Or just add the EXTRA amount on top of standard config
                 extra_aura = aura_amount # Doubles it
-                profile.aura += extra_aura 
-                
-                daily_target.first_like_received = True
-                daily_target.save()
+                aura_delta += extra_aura
             
             # Add standard amount
-            profile.aura += aura_amount
+            aura_delta += aura_amount
             
     else: # Dislike
-        if request.user in message.dislikes.all(): 
-            message.dislikes.remove(request.user)
-            profile.aura += config.aura_per_dislike
+        if not added: 
+            aura_delta += config.aura_per_dislike
         else: 
-            message.dislikes.add(request.user)
-            profile.aura -= config.aura_per_dislike
+            aura_delta -= config.aura_per_dislike
             
-    profile.save()
-    return JsonResponse({'likes_count': message.likes.count()})
+    counters.add_aura(message.user_id, aura_delta)
+    buffer_update(message.room.name, message.id, likes=likes, dislikes=dislikes)
+    vote_feed.publish(message.room.name, message.id, likes, dislikes) # Coalesced live update for the room
+    return JsonResponse({'likes_count': likes, 'dislikes_count': dislikes})
 
 @csrf_exempt
 @login_required
@@ -202,6 +207,40 @@ def toggle_music_fav(request, track_id):
         status = 'added'
     return JsonResponse({'status': status})
 
+# --- SERVICE WORKER (site-wide scope, build-hashed; see assets.py) ---
+def service_worker(request):
+    response = render(request, 'chat/sw.js', {'build_hash': assets.build_hash(), 'precache': json.dumps(assets.precache_urls())}, content_type='application/javascript')
+    response['Cache-Control'] = 'no-cache' # Browsers must see a new build hash as soon as it ships
+    response['Service-Worker-Allowed'] = '/'
+    return response
+
+# --- METRICS (Prometheus text, this worker only; see metrics.py) ---
+def metrics_view(request):
+    if not metrics.ENABLED or not metrics.authorized(request):
+        return HttpResponse(status=404)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- MUSIC CATALOG (versioned document, see music_catalog.py) ---
+def _catalog_etag(request): return music_catalog.meta()['version']
+
+@condition(etag_func=_catalog_etag)
+def music_catalog_view(request):
+    version, body = music_catalog.body()
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = quote_etag(version)
+    # ?v=<current version> URLs never change content; anything else must revalidate
+    response['Cache-Control'] = 'public, max-age=31536000, immutable' if request.GET.get('v') == version else 'no-cache'
+    return response
+
+@login_required
+def music_favorites(request):
+    """ The user's favorite track ids, in the order they were added """
+    through = Profile.favorites.through
+    ids = list(through.objects.filter(profile__user=request.user).order_by('id').values_list('musictrack_id', flat=True))
+    response = JsonResponse({'ids': ids})
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 @login_required
 def suggest_music(request):
     if request.method=='POST': 
@@ -214,55 +253,79 @@ def suggest_music(request):
         messages.success(request, "Sent!")
     return redirect('home')
 
+# --- MEDIA UPLOADS (chunked, spooled to disk; the socket only receives the token) ---
+@login_required
+@require_POST
+def upload_start(request):
+    try:
+        upload = start_upload(request.user, request.POST.get('kind'), int(request.POST.get('size', 0)), request.POST.get('ext'))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'msg': 'Bad size'}, status=400)
+    except UploadError as e:
+        return JsonResponse({'status': 'error', 'msg': e.msg}, status=e.status)
+    return JsonResponse({'status': 'success', 'token': upload.token, 'chunk_size': chunk_bytes()})
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def upload_chunk(request, token):
+    if request.method == 'GET': # Resume support: where did we stop?
+        upload = get_object_or_404(MediaUpload, token=token, user=request.user)
+        return JsonResponse({'status': 'success', 'received': upload.received, 'size': upload.size, 'complete': bool(upload.stored_name)})
+    try:
+        offset = int(request.GET.get('offset', 0))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        upload = append_chunk(request.user, token, offset, request, length)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'msg': 'Bad offset'}, status=400)
+    except UploadError as e:
+        current = MediaUpload.objects.filter(token=token, user=request.user).values_list('received', flat=True).first()
+        return JsonResponse({'status': 'error', 'msg': e.msg, 'received': current}, status=e.status)
+    return JsonResponse({'status': 'success', 'received': upload.received, 'complete': bool(upload.stored_name)})
+
 # --- [NEW] AD REWARD SYSTEM ---
 @login_required
 @require_POST
 def claim_ad_reward(request, ad_type):
     """
     ad_type: 'xp', 'aura', 'booster', 'recover'
+    Every limit is enforced by a conditional UPDATE, so parallel claims can't exceed it.
     """
-    daily = get_or_create_daily(request.user)
-    streak, _ = UserStreak.objects.get_or_create(user=request.user)
-    
     if ad_type == 'xp':
-        if daily.xp_ads_watched >= 5:
+        if not claim_daily_quota(request.user, 'xp_ads_watched', 5):
             return JsonResponse({'status': 'error', 'msg': 'Daily limit reached'})
         
         # Grant 25 XP
-        grant_xp(request.user, 25, source="Ad Reward")
-        daily.xp_ads_watched += 1
-        daily.save()
+        grant_reward(request.user, xp=25, source="Ad Reward")
+        daily = get_or_create_daily(request.user)
         return JsonResponse({'status': 'success', 'msg': '+25 XP', 'new_count': daily.xp_ads_watched})
 
     elif ad_type == 'aura':
-        if daily.aura_ads_watched >= 7:
+        if not claim_daily_quota(request.user, 'aura_ads_watched', 7):
             return JsonResponse({'status': 'error', 'msg': 'Daily limit reached'})
         
-        request.user.profile.aura += 30
-        request.user.profile.save()
-        daily.aura_ads_watched += 1
-        daily.save()
+        grant_reward(request.user, aura=30, source="Ad Reward")
         return JsonResponse({'status': 'success', 'msg': '+30 Aura'})
 
     elif ad_type == 'booster':
-        if daily.booster_claimed:
+        if not claim_daily_flag(request.user, 'booster_claimed'):
             return JsonResponse({'status': 'error', 'msg': 'Already claimed today'})
         
-        daily.booster_claimed = True
-        daily.save()
         return JsonResponse({'status': 'success', 'msg': '1.5x XP Active!'})
 
     elif ad_type == 'recover':
         # Logic: Check if streak is broken but recoverable
-        streak.recovery_ads_watched += 1
-        if streak.recovery_ads_watched >= 3:
-            # Restore logic (reset last active date to today effectively saving streak)
-            streak.last_action_date = timezone.now().date()
-            streak.recovery_ads_watched = 0
+        with transaction.atomic():
+            UserStreak.objects.get_or_create(user=request.user)
+            streak = UserStreak.objects.select_for_update().get(user=request.user)
+            streak.recovery_ads_watched += 1
+            if streak.recovery_ads_watched >= 3:
+                # Restore logic (reset last active date to today effectively saving streak)
+                streak.last_action_date = timezone.now().date()
+                streak.recovery_ads_watched = 0
+                streak.save()
+                return JsonResponse({'status': 'success', 'msg': 'Streak Recovered!'})
+            
             streak.save()
-            return JsonResponse({'status': 'success', 'msg': 'Streak Recovered!'})
-        
-        streak.save()
         return JsonResponse({'status': 'progress', 'msg': f'{streak.recovery_ads_watched}/3 Watched'})
 
     return JsonResponse({'status': 'error'})
@@ -278,6 +341,8 @@ def delete_suggestion(request, suggestion_id):
 def clear_all_chats(request):
     if request.method == "POST":
         Message.objects.all().delete()
+        try: recent.forget_all()
+        except RedisError: pass
         messages.success(request, "All Chat History Cleared! Music & Users are safe.")
     return redirect('admin_dashboard')
 
@@ -306,11 +371,10 @@ def god_mode_action(request):
     if request.method == 'POST':
         action = request.POST.get('action')
         target = Profile.objects.get(user_id=request.POST.get('user_id'))
-        if action == 'give_xp': target.xp += int(request.POST.get('amount'))
-        elif action == 'give_aura': target.aura += int(request.POST.get('amount'))
-        elif action == 'gift_premium': target.subscription_tier = request.POST.get('pkg_name')
+        if action == 'give_xp': counters.add_xp(target.user_id, int(request.POST.get('amount')))
+        elif action == 'give_aura': counters.add_aura(target.user_id, int(request.POST.get('amount')))
+        elif action == 'gift_premium': target.subscription_tier = request.POST.get('pkg_name'); target.save(update_fields=['subscription_tier'])
         elif action == 'ban_user': target.user.is_active = False; target.user.save()
-        target.save()
         messages.success(request, "Done")
     return redirect('admin_dashboard')
 
@@ -0,0 +1,98 @@
+# Live vote counts, coalesced per message in Redis and flushed as one vote_update frame per window
+import asyncio
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from redis import RedisError
+from .frames import encode_frame
+from .redis_client import get_redis
+
+WINDOW = getattr(settings, 'CHAT_VOTE_COALESCE_MS', 250) / 1000
+PENDING_KEY = "votes:pending"
+STALE_AFTER = 60 # seconds; counts whose flush was lost with its worker are dropped after this
+
+def vote_frame(msg_id, likes, dislikes):
+    return encode_frame({'type': 'vote_update', 'msg_id': msg_id, 'likes': likes, 'dislikes': dislikes})
+
+def send_batch(batch):
+    """ batch: {(room_name, msg_id): (likes, dislikes)} -> one group_send per message """
+    channel_layer = get_channel_layer()
+    if channel_layer is None: return
+
+    async def dispatch():
+        await asyncio.gather(*(
+            channel_layer.group_send(f"chat_{room_name}", {'type': 'vote_update', 'frame': vote_frame(msg_id, *counts)})
+            for (room_name, msg_id), counts in batch.items()
+        ))
+    async_to_sync(dispatch)()
+
+_loop = None # The server's event loop, noted by the first socket
+
+def note_loop(loop):
+    global _loop
+    _loop = loop
+
+def server_loop():
+    """ The recorded event loop if it is still running, else None """
+    return _loop if _loop is not None and _loop.is_running() else None
+
+# Stores the newest counts and opens the window if none is open. KEYS = pending hash, window flag
+# ARGV = field, counts, window ms, stale ms. Returns 1 when this call opened the window
+_STAGE_LUA = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[3]) then return 1 end
+return 0
+"""
+_TAKE_LUA = """
+local counts = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return counts
+"""
+
+class VoteCoalescer:
+    def __init__(self, window=WINDOW, send=send_batch, key=PENDING_KEY, loop=None):
+        self.window = window
+        self.send = send
+        self.key, self.window_key = key, f"{key}:window"
+        self.loop = loop # Defaults to the server loop of the publishing request
+        self._tasks = set() # Scheduled flushes, referenced until done
+
+    def publish(self, room_name, msg_id, likes, dislikes):
+        loop = self.loop or server_loop()
+        if self.window <= 0 or loop is None:
+            self.send({(room_name, msg_id): (likes, dislikes)})
+            return
+        try:
+            opened = get_redis().eval(_STAGE_LUA, 2, self.key, self.window_key, f"{msg_id}|{room_name}", f"{likes}:{dislikes}",
+                                      int(self.window * 1000), STALE_AFTER * 1000)
+        except RedisError as e:
+            print(f"Vote coalescing unavailable, sending directly: {e}")
+            self.send({(room_name, msg_id): (likes, dislikes)})
+            return
+        if opened: loop.call_soon_threadsafe(loop.call_later, self.window, self._start_flush)
+
+    def _start_flush(self):
+        """ On the loop: the Redis round trip and the sends run in a thread, never on the loop itself """
+        task = asyncio.ensure_future(sync_to_async(self.flush, thread_sensitive=False)())
+        self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+
+    def take(self):
+        """ Removes and returns every pending update: {(room_name, msg_id): (likes, dislikes)} """
+        raw = get_redis().eval(_TAKE_LUA, 1, self.key)
+        batch = {}
+        for field, counts in zip(raw[::2], raw[1::2]):
+            msg_id, room_name = field.decode().split('|', 1)
+            likes, dislikes = counts.decode().split(':')
+            batch[(room_name, int(msg_id))] = (int(likes), int(dislikes))
+        return batch
+
+    def flush(self):
+        try:
+            batch = self.take()
+            if batch: self.send(batch)
+        except Exception as e: print(f"Vote broadcast error: {e}")
+
+coalescer = VoteCoalescer()
+
+def publish(room_name, msg_id, likes, dislikes): coalescer.publish(room_name, msg_id, likes, dislikes)
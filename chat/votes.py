@@ -0,0 +1,43 @@
+# Message votes with like_count / dislike_count kept in step with the M2Ms in one transaction
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from .models import Message
+
+FIELDS = {'like': ('likes', 'like_count'), 'dislike': ('dislikes', 'dislike_count')}
+
+def toggle(message_id, user_id, kind):
+    """
+    Adds the user's vote, or removes it if already there.
+    Returns (added, like_count, dislike_count); added is None when a concurrent
+    request from the same user won the insert, i.e. nothing changed.
+    """
+    m2m, col = FIELDS[kind]
+    through = getattr(Message, m2m).through
+    with transaction.atomic():
+        # The DELETE doubles as the existence check
+        added = not through.objects.filter(message_id=message_id, user_id=user_id).delete()[0]
+        if added:
+            try:
+                with transaction.atomic(): through.objects.create(message_id=message_id, user_id=user_id)
+            except IntegrityError:
+                added = None # A concurrent request from the same user inserted it first; nothing to count
+        if added is not None:
+            Message.objects.filter(id=message_id).update(**{col: F(col) + (1 if added else -1)})
+        likes, dislikes = Message.objects.filter(id=message_id).values_list('like_count', 'dislike_count').get()
+    return added, likes, dislikes
+
+def backfill(batch_size=1000):
+    """ Recomputes both counters from the M2M tables. Returns rows updated """
+    def total(m2m):
+        through = getattr(Message, m2m).through
+        return Coalesce(Subquery(
+            through.objects.filter(message_id=OuterRef('pk')).values('message_id')
+            .annotate(n=Count('id')).values('n')[:1]
+        ), 0)
+
+    updated = 0
+    ids = list(Message.objects.order_by('id').values_list('id', flat=True))
+    for i in range(0, len(ids), batch_size):
+        updated += Message.objects.filter(id__in=ids[i:i + batch_size]).update(like_count=total('likes'), dislike_count=total('dislikes'))
+    return updated
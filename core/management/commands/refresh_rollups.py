@@ -0,0 +1,25 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from core import rollups
+
+
+class Command(BaseCommand):
+    help = "Folds new messages into the analytics rollup tables the dashboards read (runs forever unless --once)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=getattr(settings, 'ROLLUP_INTERVAL', 60), help="Seconds between refreshes")
+        parser.add_argument('--batch-size', type=int, default=20000, help="Messages per transaction")
+        parser.add_argument('--rebuild', action='store_true', help="Drop the rollups and recount all history first")
+        parser.add_argument('--once', action='store_true', help="Refresh once and exit")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write(f"Rebuilt rollups from {rollups.rebuild(options['batch_size'])} messages")
+        while True:
+            close_old_connections()
+            counted = rollups.refresh(options['batch_size'])
+            if counted: self.stdout.write(f"Rolled up {counted} messages")
+            if options['once']: break
+            time.sleep(options['interval'])
@@ -0,0 +1,54 @@
+# Generated by Django 6.0 on 2026-10-18 19:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('chat', '0016_message_vote_counts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True)),
+                ('last_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MessageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('kind', models.CharField(choices=[('text', 'Text'), ('voice', 'Voice Note'), ('image', 'Image')], max_length=10)),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('mentions', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='chat.room')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('hour', 'room', 'kind'), name='core_msgrollup_bucket_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserDayRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='day_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'day'], name='core_userday_user_idx')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'user'), name='core_userday_bucket_uniq')],
+            },
+        ),
+    ]
@@ -1,3 +1,40 @@
 from django.db import models
+from django.contrib.auth.models import User
+from chat.models import Room
 
-# Create your models here.
+# --- ANALYTICS ROLLUPS ---
+# Filled incrementally by core.rollups (manage.py refresh_rollups) so the dashboards never scan Message
+
+# Messages per room / hour / type
+class MessageRollup(models.Model):
+    KIND_CHOICES = [('text', 'Text'), ('voice', 'Voice Note'), ('image', 'Image')]
+    hour = models.DateTimeField() # Start of the hour
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='rollups')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    messages = models.PositiveIntegerField(default=0)
+    mentions = models.PositiveIntegerField(default=0) # Messages containing '@'
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['hour', 'room', 'kind'], name='core_msgrollup_bucket_uniq')]
+
+    def __str__(self): return f"{self.hour:%Y-%m-%d %H}:00 {self.room.name} {self.kind}: {self.messages}"
+
+# Messages per user / day (top chatters, active users, spam pattern)
+class UserDayRollup(models.Model):
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='day_rollups')
+    messages = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'user'], name='core_userday_bucket_uniq')]
+        indexes = [models.Index(fields=['user', 'day'], name='core_userday_user_idx')]
+
+    def __str__(self): return f"{self.day} {self.user.username}: {self.messages}"
+
+# How far the rollups have got: every Message with id <= last_message_id is counted
+class RollupWatermark(models.Model):
+    name = models.CharField(max_length=30, unique=True)
+    last_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self): return f"{self.name} @ {self.last_message_id}"
@@ -0,0 +1,76 @@
+# Incremental message rollups: refresh() folds messages past the watermark with additive upserts
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value, CharField, Count, Q, Max
+from django.db.models.functions import TruncHour, TruncDate
+from django.utils import timezone
+from chat.models import Message
+from .models import MessageRollup, UserDayRollup, RollupWatermark
+
+WATERMARK = "messages"
+SETTLE = getattr(settings, 'ROLLUP_SETTLE', 60) # seconds
+
+# Voice notes and images take priority over any caption text
+KIND = Case(
+    When(audio__gt='', then=Value('voice')),
+    When(image__gt='', then=Value('image')),
+    default=Value('text'), output_field=CharField(),
+)
+
+def _watermark(lock=False):
+    qs = RollupWatermark.objects.select_for_update() if lock else RollupWatermark.objects
+    return qs.get_or_create(name=WATERMARK)[0]
+
+def _upsert(model, rows, key_fields, add_fields):
+    """ Adds rows' counts onto existing buckets and creates the missing ones: one read, two writes """
+    if not rows: return
+    candidates = model.objects.filter(**{f"{f}__in": {row[f] for row in rows} for f in key_fields}) # Superset, matched below
+    existing = {tuple(getattr(obj, f) for f in key_fields): obj for obj in candidates}
+    to_update, to_create = [], []
+    for row in rows:
+        obj = existing.get(tuple(row[f] for f in key_fields))
+        if obj:
+            for f in add_fields: setattr(obj, f, getattr(obj, f) + row[f])
+            to_update.append(obj)
+        else: to_create.append(model(**row))
+    if to_update: model.objects.bulk_update(to_update, add_fields)
+    if to_create: model.objects.bulk_create(to_create)
+
+def _fold(low, high):
+    """ Adds messages with low < id <= high to both rollups. Returns how many there were """
+    msgs = Message.objects.filter(id__gt=low, id__lte=high)
+    by_room = (msgs.annotate(bucket=TruncHour('timestamp'), type=KIND).values('bucket', 'room_id', 'type')
+               .annotate(n=Count('id'), at=Count('id', filter=Q(content__contains='@'))))
+    _upsert(MessageRollup, [{'hour': r['bucket'], 'room_id': r['room_id'], 'kind': r['type'], 'messages': r['n'], 'mentions': r['at']}
+                            for r in by_room], ('hour', 'room_id', 'kind'), ('messages', 'mentions'))
+    by_user = list(msgs.annotate(bucket=TruncDate('timestamp')).values('bucket', 'user_id').annotate(n=Count('id')))
+    _upsert(UserDayRollup, [{'day': r['bucket'], 'user_id': r['user_id'], 'messages': r['n']} for r in by_user],
+            ('day', 'user_id'), ('messages',))
+    return sum(r['n'] for r in by_user)
+
+def refresh(batch_size=20000):
+    """ Folds settled messages past the watermark into the rollups. Returns messages counted """
+    high = Message.objects.filter(timestamp__lt=timezone.now() - timedelta(seconds=SETTLE)).aggregate(m=Max('id'))['m'] or 0
+    counted = 0
+    while True:
+        with transaction.atomic():
+            mark = _watermark(lock=True) # One refresher at a time
+            mark.updated_at = timezone.now()
+            if mark.last_message_id >= high: mark.save(update_fields=['updated_at']); break # Up to date as of now
+            upper = min(mark.last_message_id + batch_size, high)
+            counted += _fold(mark.last_message_id, upper)
+            mark.last_message_id = upper; mark.save()
+    return counted
+
+def rebuild(batch_size=20000):
+    """ Drops both rollups and recounts all history """
+    with transaction.atomic():
+        _watermark(lock=True)
+        MessageRollup.objects.all().delete(); UserDayRollup.objects.all().delete()
+        RollupWatermark.objects.filter(name=WATERMARK).update(last_message_id=0, updated_at=None)
+    return refresh(batch_size)
+
+def as_of():
+    """ When the rollups were last brought up to date (None if never) """
+    return RollupWatermark.objects.filter(name=WATERMARK).values_list('updated_at', flat=True).first()
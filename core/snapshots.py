@@ -0,0 +1,57 @@
+# Stale-while-revalidate snapshots of the admin dashboards' context, one recomputation per key
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+TTL = getattr(settings, 'DASHBOARD_SNAPSHOT_TTL', 60) # seconds before a snapshot is recomputed
+KEEP = getattr(settings, 'DASHBOARD_SNAPSHOT_KEEP', 3600) # seconds a stale snapshot may still be served
+LOCK_TIMEOUT = 300 # A recomputation that died without releasing the lock blocks retries this long
+MISS_WAIT = getattr(settings, 'DASHBOARD_SNAPSHOT_MISS_WAIT', 10) # seconds to wait for another request's computation
+POLL_INTERVAL = 0.1
+
+def _keys(name): return f"snapshot:{name}", f"snapshot:{name}:lock"
+
+def _store(name, compute):
+    data = compute()
+    entry = {'data': data, 'at': time.time()}
+    try: cache.set(_keys(name)[0], entry, KEEP)
+    except Exception as e: print(f"Snapshot store failed for {name}: {e}")
+    return entry
+
+def _refresh(name, compute):
+    try: _store(name, compute)
+    except Exception as e: print(f"Snapshot refresh failed for {name}: {e}")
+    finally:
+        cache.delete(_keys(name)[1])
+        connection.close() # No request cycle will close this thread's connection
+
+def _fill(name, compute):
+    """ Computes a missing snapshot once: the lock holder stores it, everyone else waits for that """
+    key, lock_key = _keys(name)
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try: return _store(name, compute)
+        finally: cache.delete(lock_key)
+    deadline = time.monotonic() + MISS_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None: return entry
+    return None # Still computing: recomputing here too would be the stampede the lock prevents
+
+def get(name, compute, ttl=None):
+    """ Returns (data, age in seconds) for snapshot `name`, or (None, None) while another request is still computing it; compute() must return something picklable """
+    ttl = TTL if ttl is None else ttl
+    if ttl <= 0: return compute(), 0
+    key, lock_key = _keys(name)
+    try: entry = cache.get(key)
+    except Exception as e: # Cache backend down: compute inline like before
+        print(f"Snapshot cache unavailable: {e}")
+        return compute(), 0
+    if entry is None:
+        entry = _fill(name, compute)
+        if entry is None: return None, None
+    elif time.time() - entry['at'] > ttl and cache.add(lock_key, 1, LOCK_TIMEOUT):
+        threading.Thread(target=_refresh, args=(name, compute), daemon=True).start()
+    return entry['data'], int(time.time() - entry['at'])
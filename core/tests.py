@@ -1,3 +1,84 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from chat.models import Message, Room
+
+from . import rollups, snapshots
+from .models import MessageRollup, UserDayRollup, RollupWatermark
+
+LOCMEM = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'core-tests'}}
+
+
+@override_settings(CACHES=LOCMEM)
+class SnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_miss_is_computed_once_and_then_served(self):
+        compute = mock.Mock(return_value={'n': 1})
+        self.assertEqual(snapshots.get('t', compute), ({'n': 1}, 0))
+        self.assertEqual(snapshots.get('t', compute)[0], {'n': 1})
+        compute.assert_called_once()
+
+    def test_waiter_gets_a_placeholder_instead_of_computing(self):
+        cache.add(snapshots._keys('t')[1], 1, snapshots.LOCK_TIMEOUT) # Another request is computing it
+        compute = mock.Mock(return_value={'n': 1})
+        with mock.patch.object(snapshots, 'MISS_WAIT', 0.2):
+            self.assertEqual(snapshots.get('t', compute), (None, None))
+        compute.assert_not_called()
+
+    def test_waiter_gets_the_holders_result(self):
+        key, lock_key = snapshots._keys('t')
+        cache.add(lock_key, 1, snapshots.LOCK_TIMEOUT)
+        cache.set(key, {'data': {'n': 2}, 'at': 0})
+        self.assertEqual(snapshots._fill('t', mock.Mock())['data'], {'n': 2})
+
+
+class RollupTests(TestCase):
+    """ Folding past the watermark: counted once, added onto existing buckets, recounted by rebuild """
+    def setUp(self):
+        self.user = User.objects.create_user('pilot', password='x')
+        self.room = Room.objects.create(name='Lounge')
+        self.hour = timezone.localtime(timezone.now() - timedelta(hours=2)).replace(minute=0, second=0, microsecond=0) # Buckets follow TIME_ZONE
+
+    def post(self, content='hi', minutes=5, settled=True):
+        m = Message.objects.create(user=self.user, room=self.room, content=content)
+        if settled: Message.objects.filter(pk=m.pk).update(timestamp=self.hour + timedelta(minutes=minutes))
+        return m
+
+    def totals(self):
+        by_kind = {r.kind: (r.messages, r.mentions) for r in MessageRollup.objects.filter(room=self.room, hour=self.hour)}
+        return by_kind, sum(UserDayRollup.objects.filter(user=self.user).values_list('messages', flat=True))
+
+    def test_refresh_moves_the_watermark_and_is_idempotent(self):
+        self.post(); self.post('hey @pilot'); last = self.post()
+        self.assertEqual(rollups.refresh(batch_size=2), 3) # Two batches
+        self.assertEqual(RollupWatermark.objects.get(name=rollups.WATERMARK).last_message_id, last.id)
+        self.assertIsNotNone(rollups.as_of())
+        self.assertEqual(self.totals(), ({'text': (3, 1)}, 3))
+        self.assertEqual(rollups.refresh(), 0) # Nothing past the watermark: buckets untouched
+        self.assertEqual(self.totals(), ({'text': (3, 1)}, 3))
+
+    def test_new_messages_add_onto_existing_buckets(self):
+        self.post(); rollups.refresh()
+        self.post(minutes=30); self.post('@x', minutes=40)
+        self.assertEqual(rollups.refresh(), 2)
+        self.assertEqual(self.totals(), ({'text': (3, 1)}, 3))
+        self.assertEqual(MessageRollup.objects.count(), 1)
+
+    def test_unsettled_messages_wait_for_the_next_run(self):
+        self.post(); fresh = self.post(settled=False)
+        self.assertEqual(rollups.refresh(), 1)
+        self.assertLess(RollupWatermark.objects.get(name=rollups.WATERMARK).last_message_id, fresh.id)
+        with mock.patch.object(rollups, 'SETTLE', -60): self.assertEqual(rollups.refresh(), 1)
+
+    def test_rebuild_recounts_from_scratch(self):
+        self.post(); self.post(); gone = self.post(); rollups.refresh()
+        gone.delete() # Hard deletes are only subtracted by a rebuild
+        self.assertEqual(self.totals(), ({'text': (3, 0)}, 3))
+        self.assertEqual(rollups.rebuild(), 2)
+        self.assertEqual(self.totals(), ({'text': (2, 0)}, 2))
 
-# Create your tests here.
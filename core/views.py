@@ -6,14 +6,40 @@ from django.utils import timezone
 from datetime import timedelta
 import json
 import random 
-from chat.models import Profile, Message, Room, MusicTrack 
+from chat.models import Profile, Room, MusicTrack 
+from .models import MessageRollup, UserDayRollup
+from . import rollups, snapshots
+from chat import leaderboard, tiers, presence, metrics
+from redis import RedisError
+
+FILTERS = ('24H', '7D', '30D', 'LIFETIME')
 
 @user_passes_test(lambda u: u.is_superuser)
 def analytics_dashboard(request):
+    filter_type = request.GET.get('filter', '24H')
+    if filter_type not in FILTERS: filter_type = '24H'
+    # Served from a per-window snapshot, recomputed in the background once it is DASHBOARD_SNAPSHOT_TTL old
+    context, age = snapshots.get(f"super_dashboard:{filter_type}", lambda: _dashboard_context(filter_type))
+    if context is None: return render(request, 'snapshot_computing.html', status=503) # Another request is still computing it
+    context = {**context, 'snapshot_age': age}
+
+    # Live presence sets (sockets + recent page views) are O(1), so they are never snapshotted;
+    # the last_activity scan is only the fallback
+    try:
+        context['online_count'] = presence.online_count()
+        context['room_online'] = presence.room_counts(list(Room.objects.values_list('name', flat=True)))
+    except RedisError:
+        context['online_count'] = Profile.objects.filter(last_activity__gte=timezone.now() - timedelta(minutes=5)).count()
+        context['room_online'] = {}
+
+    # 5. SYSTEM HEALTH: measured by chat.metrics in this worker, also live
+    context.update(metrics.health())
+    return render(request, 'custom_analytics.html', context)
+
+def _dashboard_context(filter_type):
     # ==========================================
     # 🟢 PHASE 1: CORE VISIBILITY (UNTOUCHED)
     # ==========================================
-    filter_type = request.GET.get('filter', '24H')
     now = timezone.now()
     
     if filter_type == '24H': start_date = now - timedelta(hours=24)
@@ -22,17 +48,23 @@ def analytics_dashboard(request):
     elif filter_type == 'LIFETIME': start_date = now - timedelta(days=365*5)
     else: start_date = now - timedelta(hours=24)
 
-    msgs_qs = Message.objects.filter(timestamp__gte=start_date)
+    # Message stats come only from the rollups (core/rollups.py), so the page costs the same for any window
+    room_rollups = MessageRollup.objects.filter(hour__gte=start_date)
+    day_rollups = UserDayRollup.objects.filter(day__gte=timezone.localdate(start_date)) # Day buckets: 24H covers today + yesterday
+    totals = room_rollups.aggregate(
+        total=Sum('messages'), mentions=Sum('mentions'),
+        night=Sum('messages', filter=Q(hour__hour__gte=20)), learning=Sum('messages', filter=Q(room__name="Learning")),
+    )
 
-    online_count = Profile.objects.filter(last_activity__gte=now - timedelta(minutes=5)).count()
-    dau_count = Profile.objects.filter(last_activity__date=now.date()).count()
+    today_start = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0) # A range, so the index applies (unlike __date)
+    dau_count = Profile.objects.filter(last_activity__gte=today_start).count()
     revenue = 0 
     mau_count = Profile.objects.filter(last_activity__gte=now - timedelta(days=30)).count() or 1
     stickiness = round((dau_count / mau_count) * 100, 1)
-    total_msgs = msgs_qs.count()
+    total_msgs = totals['total'] or 0
     avg_session = 15
 
-    top_cities = Profile.objects.exclude(city="Unknown").values('city').annotate(count=Count('id')).order_by('-count')[:5]
+    top_cities = list(Profile.objects.exclude(city="Unknown").values('city').annotate(count=Count('id')).order_by('-count')[:5])
     
     gender_data = list(Profile.objects.values('gender').annotate(count=Count('id')))
     gender_dict = {item['gender']: item['count'] for item in gender_data if item['gender']}
@@ -46,48 +78,50 @@ def analytics_dashboard(request):
     premium_users = Profile.objects.exclude(subscription_tier='Free').count()
     subs_data = [free_users, premium_users]
 
-    peak_hours = list(msgs_qs.annotate(hour=ExtractHour('timestamp')).values('hour').annotate(count=Count('id')))
+    peak_hours = list(room_rollups.annotate(h=ExtractHour('hour')).values('h').annotate(count=Sum('messages')))
     hours_list = [0] * 24
-    for p in peak_hours: hours_list[p['hour']] = p['count']
+    for p in peak_hours: hours_list[p['h']] = p['count']
 
-    ranks = list(Profile.objects.values('subscription_tier').annotate(count=Count('id')))
-    rank_labels = [r['subscription_tier'] for r in ranks]
-    rank_values = [r['count'] for r in ranks]
+    # XP tier histogram, bucketed by the database in one GROUP BY
+    ranks = tiers.histogram(Profile.objects.all())
+    rank_labels = [name for name, _ in ranks]
+    rank_values = [count for _, count in ranks]
 
-    top_chatters = list(msgs_qs.values('user__username').annotate(count=Count('id')).order_by('-count')[:10])
+    top_chatters = list(day_rollups.values('user__username').annotate(count=Sum('messages')).order_by('-count')[:10])
     chat_labels = [u['user__username'] for u in top_chatters]
     chat_values = [u['count'] for u in top_chatters]
-    top_xp_users = Profile.objects.order_by('-xp')[:10]
-    top_aura_users = Profile.objects.order_by('-aura')[:10]
+    top_xp_users = leaderboard.top_profiles('xp', 10)
+    top_aura_users = leaderboard.top_profiles('aura', 10)
 
     # ==========================================
     # 🟡 PHASE 2: BEHAVIOR INTELLIGENCE
     # ==========================================
-    voice_msgs = msgs_qs.exclude(audio='').count()
-    image_msgs = msgs_qs.exclude(image='').count()
-    text_msgs = total_msgs - (voice_msgs + image_msgs)
+    kinds = dict(room_rollups.values_list('kind').annotate(Sum('messages')))
+    voice_msgs = kinds.get('voice', 0)
+    image_msgs = kinds.get('image', 0)
+    text_msgs = kinds.get('text', 0)
     msg_type_data = [text_msgs, voice_msgs, image_msgs]
 
-    room_stats = list(msgs_qs.values('room__name').annotate(count=Count('id')).order_by('-count'))
+    room_stats = list(room_rollups.values('room__name').annotate(count=Sum('messages')).order_by('-count'))
     room_labels = [r['room__name'] for r in room_stats]
     room_values = [r['count'] for r in room_stats]
 
-    mentions_count = msgs_qs.filter(content__icontains='@').count()
-    active_user_count = msgs_qs.values('user').distinct().count() or 1
+    mentions_count = totals['mentions'] or 0
+    active_user_count = day_rollups.values('user').distinct().count() or 1
     avg_msg_per_user = round(total_msgs / active_user_count, 1)
 
     power_users_count = Profile.objects.filter(xp__gte=1000).count()
     seven_days_ago = now - timedelta(days=7)
-    new_active_users = Profile.objects.filter(user__date_joined__gte=seven_days_ago, last_activity__date=now.date()).count()
+    new_active_users = Profile.objects.filter(user__date_joined__gte=seven_days_ago, last_activity__gte=today_start).count()
     
     silent_users = dau_count - active_user_count
     if silent_users < 0: silent_users = 0
     participation_data = [active_user_count, silent_users]
 
     users_with_favs = Profile.objects.annotate(fav_count=Count('favorites')).filter(fav_count__gt=0).values_list('user', flat=True)
-    multi_feature_count = msgs_qs.filter(user__in=users_with_favs).values('user').distinct().count()
+    multi_feature_count = day_rollups.filter(user__in=users_with_favs).values('user').distinct().count()
 
-    top_tracks = MusicTrack.objects.annotate(fav_count=Count('favorited_by')).order_by('-fav_count')[:5]
+    top_tracks = list(MusicTrack.objects.annotate(fav_count=Count('favorited_by')).order_by('-fav_count')[:5])
     genre_stats = list(MusicTrack.objects.filter(favorited_by__isnull=False).values('category').annotate(count=Count('favorited_by')).order_by('-count'))
     genre_labels = [g['category'] for g in genre_stats]
     genre_values = [g['count'] for g in genre_stats]
@@ -128,7 +162,7 @@ def analytics_dashboard(request):
     if total_msgs > (dau_3d_avg * 20): # Rough heuristic
         alerts.append({"type": "Activity Spike", "msg": "Unusual message volume detected.", "level": "warning"})
     # Spam Pattern (User sent > 50 msgs in 24h)
-    spammers = msgs_qs.values('user').annotate(c=Count('id')).filter(c__gt=50).count()
+    spammers = day_rollups.values('user').annotate(c=Sum('messages')).filter(c__gt=50).count()
     if spammers > 0:
         alerts.append({"type": "Spam Pattern", "msg": f"{spammers} users sent >50 msgs today.", "level": "critical"})
     # Voice Overuse
@@ -138,15 +172,15 @@ def analytics_dashboard(request):
     # 3. AUTOMATION SUGGESTIONS (Advanced)
     suggestions = []
     # "Many Bronze users active -> Offer Pilot promo"
-    active_free_users = Profile.objects.filter(subscription_tier='Free', last_activity__date=now.date()).count()
+    active_free_users = Profile.objects.filter(subscription_tier='Free', last_activity__gte=today_start).count()
     if active_free_users > 5:
         suggestions.append({"type": "Monetization", "msg": f"{active_free_users} active Free users. Push 'Pilot Tier' promo now.", "severity": "high"})
     # "Music usage high at night"
-    night_msgs = msgs_qs.filter(timestamp__hour__gte=20).count()
+    night_msgs = totals['night'] or 0
     if night_msgs > (total_msgs * 0.5):
         suggestions.append({"type": "Engagement", "msg": "Night activity is high. Push 'Late Night Lofi' banner.", "severity": "med"})
     # "Low engagement in Learning"
-    learning_msgs = msgs_qs.filter(room__name="Learning").count()
+    learning_msgs = totals['learning'] or 0
     if learning_msgs < 5:
         suggestions.append({"type": "Content", "msg": "Learning room is quiet. Auto-post a 'Fact of the Day'.", "severity": "low"})
 
@@ -160,7 +194,7 @@ def analytics_dashboard(request):
     # Logic: XP % 1000 >= 800
     # SQLite/Postgres specific, doing python filter for safety/simplicity
     close_to_level = 0
-    for p in Profile.objects.filter(last_activity__date=now.date()):
+    for p in Profile.objects.filter(last_activity__gte=today_start):
         if 800 <= (p.xp % 1000) <= 999:
             close_to_level += 1
 
@@ -169,19 +203,9 @@ def analytics_dashboard(request):
     arpu = round(revenue / total_users, 2)
     funnel_data = [total_users, dau_count, active_user_count, premium_users]
 
-    # 5. SYSTEM HEALTH
-    system_load = "Normal"
-    latency_ms = 45 
-    if total_msgs > 100: 
-        system_load = "Heavy"
-        latency_ms = 120
-    elif total_msgs > 500:
-        system_load = "Critical"
-        latency_ms = 300
-
     context = {
         # PHASE 1
-        'filter': filter_type, 'online_count': online_count, 'dau_count': dau_count, 'stickiness': stickiness, 'revenue': revenue,
+        'filter': filter_type, 'dau_count': dau_count, 'stickiness': stickiness, 'revenue': revenue,
         'total_msgs': total_msgs, 'avg_session': avg_session, 'top_cities': top_cities, 'top_xp_users': top_xp_users, 'top_aura_users': top_aura_users,
         'gender_labels': json.dumps(list(gender_dict.keys())), 'gender_values': json.dumps(list(gender_dict.values())),
         'platform_data': json.dumps(platform_data), 'subs_data': json.dumps(subs_data),
@@ -203,13 +227,12 @@ def analytics_dashboard(request):
         'alerts': alerts,               # NEW
         'arpu': arpu,
         'funnel_data': json.dumps(funnel_data),
-        'system_load': system_load,
-        'latency_ms': latency_ms,
         'best_cta_time': best_cta_time, # NEW
-        'close_to_level': close_to_level # NEW
+        'close_to_level': close_to_level, # NEW
+        'rollups_as_of': rollups.as_of(),
     }
 
-    return render(request, 'custom_analytics.html', context)
+    return context
 
 
 
@@ -1,29 +1,46 @@
 from django.contrib.auth.decorators import user_passes_test
 from django.shortcuts import render
 from django.contrib.auth import get_user_model
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.utils import timezone
 from datetime import timedelta
 import json
-from chat.models import Message, Profile, MusicTrack
+from chat.models import Profile, MusicTrack
+from .models import UserDayRollup
+from . import snapshots
+from chat import tiers, presence
+from redis import RedisError
 
 User = get_user_model()
+FILTER_ALIASES = {'24H': '1', '7D': '7', '30D': '30', 'LIFETIME': 'all'}
 
 @user_passes_test(lambda u: u.is_staff)
 def admin_analytics_dashboard(request):
-    now = timezone.now()
-    
     # --- 1. Filter Logic ---
     filter_type = request.GET.get('filter', '30')
+    filter_type = FILTER_ALIASES.get(filter_type, filter_type) # The template's buttons send 24H / 7D / ...
+    if filter_type != 'all' and not filter_type.isdigit(): filter_type = '30'
+
+    # Served from a per-filter snapshot (core/snapshots.py), recomputed in the background when stale
+    context, age = snapshots.get(f"admin_analytics:{filter_type}", lambda: _analytics_context(filter_type))
+    if context is None: return render(request, 'snapshot_computing.html', status=503) # Another request is still computing it
+    context = {**context, 'snapshot_age': age}
+
+    # --- 2. ONLINE USERS (Fix for '0 Online') ---
+    # Live presence set, never snapshotted; the 5 minute last_activity scan is the fallback
+    try: context['online_count'] = presence.online_count()
+    except RedisError:
+        online_threshold = timezone.now() - timedelta(minutes=5)
+        context['online_count'] = Profile.objects.filter(last_activity__gte=online_threshold).count()
+
+    return render(request, 'admin/analytics_dashboard.html', context)
+
+def _analytics_context(filter_type):
+    now = timezone.now()
     days = int(filter_type) if filter_type != 'all' else 3650
     start_date = now - timedelta(days=days)
     label_text = "Lifetime" if filter_type == 'all' else f"Last {days} Days"
 
-    # --- 2. ONLINE USERS (Fix for '0 Online') ---
-    # Logic: Anyone active in the last 5 minutes is "Online"
-    online_threshold = now - timedelta(minutes=5)
-    online_count = Profile.objects.filter(last_activity__gte=online_threshold).count()
-
     # --- 3. DAU / MAU (Growth) ---
     dau_count = Profile.objects.filter(last_activity__gte=now - timedelta(days=1)).count()
     mau_count = Profile.objects.filter(last_activity__gte=now - timedelta(days=30)).count()
@@ -33,8 +50,8 @@ def admin_analytics_dashboard(request):
 
     # --- 4. SPONSORSHIP DATA (Cities & Gender) ---
     # Top Cities (Excluding 'Unknown' to keep list clean)
-    city_stats = Profile.objects.exclude(city='Unknown')\
-        .values('city').annotate(count=Count('id')).order_by('-count')[:5]
+    city_stats = list(Profile.objects.exclude(city='Unknown')\
+        .values('city').annotate(count=Count('id')).order_by('-count')[:5])
     
     # Gender Split
     gender_stats = Profile.objects.values('gender').annotate(count=Count('id'))
@@ -46,15 +63,19 @@ def admin_analytics_dashboard(request):
         gender_data.append(item['count'])
 
     # --- 5. TOP TEXTERS ---
-    top_texters = Message.objects.filter(timestamp__gte=start_date)\
+    # Per-user daily rollups (core/rollups.py) instead of a GROUP BY over Message
+    top_texters = UserDayRollup.objects.filter(day__gte=timezone.localdate(start_date))\
         .values('user__username')\
-        .annotate(msg_count=Count('id'))\
+        .annotate(msg_count=Sum('messages'))\
         .order_by('-msg_count')[:10]
 
     # --- 6. MUSIC STATS ---
-    top_songs = MusicTrack.objects.annotate(likes=Count('favorited_by')).order_by('-likes')[:5]
+    top_songs = list(MusicTrack.objects.annotate(likes=Count('favorited_by')).order_by('-likes')[:5])
+
+    # --- 7. TIER SPREAD (one GROUP BY over a CASE on xp) ---
+    tier_stats = tiers.histogram(Profile.objects.all())
 
-    # --- 7. REVENUE ---
+    # --- 8. REVENUE ---
     premium_users = Profile.objects.exclude(subscription_tier='Free').count()
     # Assuming Rs. 1000 average per premium user
     total_revenue = premium_users * 1000 
@@ -64,7 +85,6 @@ def admin_analytics_dashboard(request):
         'selected_filter': filter_type,
         
         # KPIs
-        'online_count': online_count,
         'dau': dau_count,
         'mau': mau_count,
         'stickiness': stickiness,
@@ -78,10 +98,12 @@ def admin_analytics_dashboard(request):
         'gender_data': json.dumps(gender_data),
         'texter_labels': json.dumps([x['user__username'] for x in top_texters]),
         'texter_data': json.dumps([x['msg_count'] for x in top_texters]),
+        'rank_labels': json.dumps([name for name, _ in tier_stats]),
+        'rank_values': json.dumps([count for _, count in tier_stats]),
         
         # Raw Lists for Tables
         'top_songs': top_songs,
         'city_list': city_stats,
     }
     
-    return render(request, 'admin/analytics_dashboard.html', context)
\ No newline at end of file
+    return context
\ No newline at end of file
@@ -1,9 +1,6 @@
-// AirSpace Service Worker
-self.addEventListener('install', (e) => {
-  console.log('[Service Worker] Installed');
+// Retired: the service worker is now served from /sw.js (views.service_worker) so it can
+// control the whole site. Browsers still holding this /static/ registration remove it here.
+self.addEventListener('install', () => self.skipWaiting());
+self.addEventListener('activate', (e) => {
+  e.waitUntil(self.registration.unregister());
 });
-
-self.addEventListener('fetch', (e) => {
-  // Filhal hum kuch cache nahi kar rahe taake Chat Real-time rahe
-  e.respondWith(fetch(e.request));
-});
\ No newline at end of file